@@ -16,27 +16,47 @@
        - GUI window
        - Excel 接触履歴　グラフ
        - matplotlib グラフ
+       - テキスト (--no_gui)
 
 """
+import gzip
 import json
+import lzma
 import sys  # process関係
 import traceback
+import zipfile
 from datetime import date, datetime, timedelta
+from functools import partial
 from pprint import pformat, pprint
 
-import matplotlib
 import numpy as np
 import pandas as pd
-from matplotlib import pylab as plt
-from openpyxl.comments import Comment
 
 import cocoaConfig as cc
-import cocoaGui as cg
+import cocoaMemory as cmem
+import cocoaPipeline as cpl
+import cocoaPlatform as cp
+import cocoaValidate as cv
 
 __author__ = "hyuasa"
 __version__ = "0.0.1"
 __date__ = "Aug 16 2022"
 
+# get_instance_scoresの距離区分 (TypicalAttenuationDbの上限値と表記)
+DISTANCE_DB_BOUNDS = [45, 59, 64]
+DISTANCE_LABELS = ['  ~1m', '1m~2m', '1m~3m', '2m~ ']
+DISTANCE_WEIGHTS = [1.0, 2.5, 1.3, 0.01]
+WEEKDAY_LABELS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# 期間移動合計の対象カラムと表示名
+ROLLING_COLUMNS = [(('sum', 'cocoa_score', 'cocoa_score'), 'COCOAスコア{}日計'),
+                   (('calc_score_sum', 'score', '算出スコア計'), '算出スコア{}日計'),
+                   (('exposure_minutes', 'duration', '接触時間計(分)'), '接触時間{}日計(分)')]
+
+# 集計の単位 (日毎の集計から週毎/月毎をまとめる) と週毎/月毎のdowの表記
+RESOLUTIONS = ('day', 'week', 'month')
+RESOLUTION_LABELS = {'week': '週', 'month': '月'}
+
 
 def exposure_minutes(s):
     """集計関数 aggfunc
@@ -59,72 +79,53 @@ def cocoa_score_sum(s):
     return np.sum(s)
 
 
-def get_instance_score(logger, si=None):
-    """ばく露距離に基づくスコア計算
+def get_instance_scores(logger, db, mindb, duration):
+    """ばく露距離に基づくスコア計算 スキャンインスタンスの配列をまとめて計算する
+
+    距離区分 TypicalAttenuationDb
+        ~45: immediate x1.0, ~59: near x2.5, ~64: medium x1.3, それ以上: other x0.01
 
     Args:
         Logger (logging): ロガー
-        si (scanInstances): スキャンインスタンス
+        db (ndarray): ばく露中の平均デシベル値
+        mindb (ndarray): ばく露中の最小デシベル値
+        duration (ndarray): ばく露時間 (秒)
 
     Returns:
-        int: db ばく露中の平均デシベル値 
-        int: duration ばく露時間 (秒)
-        str: str_dist 距離文字列表記
-        float: score ばく露距離考慮のduration値 COCOAスコアに近似
-        float: mindb_score: 最強の強度でばく露したと仮定したスコア
+        ndarray: str_dist 距離文字列表記
+        ndarray: score ばく露距離考慮のduration値 COCOAスコアに近似
+        ndarray: mindb_score: 最強の強度でばく露したと仮定したスコア
 
     """
-    db = si['TypicalAttenuationDb']
-    mindb = si['MinAttenuationDb']
-    duration = si['SecondsSinceLastScan']
-    if db <= 45:
-        # immediate
-        score = duration * 1.0
-        str_dist = '  ~1m'
-    elif db <= 59:
-        # near
-        score = duration * 2.5
-        str_dist = '1m~2m'
-    elif db <= 64:
-        # medium
-        str_dist = '1m~3m'
-        score = duration * 1.3
-    else:
-        # other
-        str_dist = '2m~ '
-        score = duration * 0.01
-    if mindb <= 45:
-        # immediate
-        mindb_score = duration * 1.0
-    elif mindb <= 59:
-        # near
-        mindb_score = duration * 2.5
-    elif mindb <= 64:
-        # medium
-        mindb_score = duration * 1.3
-    else:
-        # other
-        mindb_score = duration * 0.01
-    return db, duration, str_dist, score, mindb_score
+    dist_index = np.searchsorted(DISTANCE_DB_BOUNDS, db, side='left')
+    mindb_index = np.searchsorted(DISTANCE_DB_BOUNDS, mindb, side='left')
+    weights = np.array(DISTANCE_WEIGHTS)
+    str_dist = np.array(DISTANCE_LABELS, dtype=object)[dist_index]
+    score = duration * weights[dist_index]
+    mindb_score = duration * weights[mindb_index]
+    return str_dist, score, mindb_score
 
 
-def verify_and_build_dataframe(logger, exposure):
-    """Verify COCOA log and build dataframe
+def verify_cocoa_log(logger, exposure):
+    """Verify COCOA log
+
+    ヘッダ情報をcc.COCOA_LOG_INFORMATIONに設定する
 
     Args:
         logger (logging): ロガー
         exposure (list/dict): exposure_data.jsonを辞書形式で読み込んだもの
 
     Returns:
-        DataFrame : valid cocoa log dataframe
+        dict : cocoaPlatform.select_adapterで選んだアダプタ 正しいログでない場合はNone
 
     """
-    # verify cocoa log
-    result = False
     log_information = []
+    adapter = cp.select_adapter(exposure)
     try:
-        log_information.append(f"# of exprosure_windows: {len(exposure['exposure_windows'])}")
-        log_information.append(f"# of daily_summariese: {len(exposure['daily_summaries'])}")
+        if adapter is None:
+            raise KeyError('exposure_windows')
+        log_information.append(f"# of exprosure_windows: {len(cp.windows(adapter, exposure))}")
+        log_information.append(f"# of daily_summariese: {len(cp.summaries(adapter, exposure))}")
         log_information.append(f"app_version: {exposure['app_version']}")
         log_information.append(f"platform: {exposure['platform']}")
         log_information.append(f"platform_version: {exposure['platform_version']}")
@@ -132,17 +133,42 @@ def verify_and_build_dataframe(logger, exposure):
         log_information.append(f"device_type: {exposure['device_type']}")
         log_information.append(f"build_number: {exposure['build_number']}")
         log_information.append(f"en_version: {exposure['en_version']}")
-        result = True
+        log_information.append(f"adapter: {adapter['name']}")
     except KeyError as ke:
         log_information.append(f'正しいcocoa_logファイルではありません。{cc.COCOA_LOG}')
+        adapter = None
 
     cc.COCOA_LOG_INFORMATION = log_information
+    return adapter
+
+
+def verify_and_build_dataframe(logger, exposure):
+    """Verify COCOA log and build dataframe
+
+    Args:
+        logger (logging): ロガー
+        exposure (list/dict): exposure_data.jsonを辞書形式で読み込んだもの
+
+    Returns:
+        DataFrame : valid cocoa log dataframe
+
+    """
+    # verify cocoa log
+    result = verify_cocoa_log(logger, exposure) is not None
+    cc.COCOA_SCAN_INSTANCES = {}
+    cc.COCOA_DAILY_SUMMARIES = {}
 
     # build dataframe
     merge_df = None
     if result:
         # valid ccoa log then build cocoa Dataframs
-        merge_df = build_dfs(logger, exposure)
+        try:
+            merge_df = build_dfs(logger, exposure)
+        except ValueError as ve:
+            # cc.VALIDATION_FAIL_FAST で不正なレコードが有った
+            cc.COCOA_LOG_INFORMATION.append(f'不正なレコードが有ります: {ve}')
+            cc.NEED_VALID_COCOA_LOG = True
+            return None
         if len(merge_df) > 0:
             # valid dataframe of cocoa log
             cc.NEED_VALID_COCOA_LOG = False
@@ -157,6 +183,81 @@ def verify_and_build_dataframe(logger, exposure):
     return merge_df
 
 
+def build_scan_instance_columns(logger, exposure, adapter, report=None):
+    """exposure_windowsを1回だけ走査してスキャンインスタンスを列形式の配列にする
+
+    集計(pivot)やヒートマップはこの配列から計算するので、JSONを再走査する必要はない
+
+    Args:
+        logger (logging): ロガー
+        exposure (list/dict): exposure_data.jsonを辞書形式で読み込んだもの
+        adapter (dict): cocoaPlatform.select_adapterで選んだアダプタ
+        report (dict): cocoaValidate.new_reportの検証結果 不正なレコードを記録する
+
+    Returns:
+        dict : 列名をキーにしたnumpy配列
+            millis, db, mindb, duration, score, mindb_score, distance は
+            スキャンインスタンス毎、window_millis はexposure window毎
+
+    """
+    return add_instance_scores(logger, cp.scan_instance_columns(adapter, exposure, report))
+
+
+def add_instance_scores(logger, columns):
+    """列形式のスキャンインスタンス配列に distance, score, mindb_score を追加する
+
+    Args:
+        logger (logging): ロガー
+        columns (dict): millis, db, mindb, duration, window_millis の配列
+
+    Returns:
+        dict : distance, score, mindb_score を追加したcolumns
+
+    """
+    str_dist, score, mindb_score = get_instance_scores(
+        logger, columns['db'], columns['mindb'], columns['duration'])
+    columns['distance'] = str_dist
+    columns['score'] = score
+    columns['mindb_score'] = mindb_score
+    return columns
+
+
+def build_heatmap_data(logger, columns):
+    """時間帯別の接触時間(分)を2次元ビンで集計する
+
+    Note:
+        exposure windowのDateMillisSinceEpochの時刻精度で集計される
+        (日単位の丸めで出力される端末では0時に集中する)
+
+    Args:
+        logger (logging): ロガー
+        columns (dict): build_scan_instance_columnsで作成した列形式の配列
+
+    Returns:
+        DataFrame : hour_distance_df 時刻 x 距離 の接触時間(分)
+        DataFrame : weekday_hour_df 曜日 x 時刻 の接触時間(分)
+
+    """
+    t = pd.to_datetime(columns['millis'], unit='ms', utc=True).tz_convert(cc.TZ)
+    hours = np.asarray(t.hour, dtype=np.int64)
+    weekdays = np.asarray(t.dayofweek, dtype=np.int64)
+    dist_index = np.searchsorted(DISTANCE_DB_BOUNDS, columns['db'], side='left')
+    minutes = columns['duration'] / 60
+
+    n_dist = len(DISTANCE_LABELS)
+    hour_distance = np.bincount(hours * n_dist + dist_index, weights=minutes,
+                                minlength=24 * n_dist).reshape(24, n_dist)
+    weekday_hour = np.bincount(weekdays * 24 + hours, weights=minutes,
+                               minlength=7 * 24).reshape(7, 24)
+
+    hour_distance_df = pd.DataFrame(hour_distance, index=pd.Index(range(24), name='hour'),
+                                    columns=DISTANCE_LABELS)
+    weekday_hour_df = pd.DataFrame(weekday_hour, index=pd.Index(WEEKDAY_LABELS, name='dow'),
+                                   columns=list(range(24)))
+    return hour_distance_df, weekday_hour_df
+
+
+@cmem.profiled('build_dfs')
 def build_dfs(logger, exposure):
     """Build DataFrame from exposure_data.json
 
@@ -168,118 +269,556 @@ def build_dfs(logger, exposure):
         df : merge_df, daily_summary_df
 
     """
-    daily_summary = []
-    for ds in exposure['daily_summaries']:
-        t = pd.Timestamp(ds['DateMillisSinceEpoch'], unit='ms', tz=cc.TZ)
-        dt = str(t)[:10]
-        # print(dt, t.strftime('%a'), ds['DaySummary'])
-        duration = ds['DaySummary']['WeightedDurationSum']
-        data = {'date': dt, 'dow': t.strftime('%a'),
-                'cocoa_score': duration, 'pv': 'cocoa_score'}
-        daily_summary.append(data)
+    adapter = cp.select_adapter(exposure)
+    report = cv.new_report()
+    summary_columns = cp.daily_summary_columns(adapter, exposure, report)
+    columns = build_scan_instance_columns(logger, exposure, adapter, report)
+    cv.log_report(logger, report, cc.COCOA_LOG_INFORMATION)
+    return build_dfs_from_columns(logger, columns, summary_columns)
 
-    exposures = []
-    events = []
-    for ew in exposure['exposure_windows']:
-        t = pd.Timestamp(ew['DateMillisSinceEpoch'], unit='ms', tz=cc.TZ)
-        dt = str(t)[:10]
-        # print(dt)
-        dow = t.strftime("%a")
-        for si in ew['ScanInstances']:
-            # pprint(si)
-            db, duration, str_dist, score, mindb_score = get_instance_score(
-                logger, si=si)
-            data = {'date': dt, 'dow': dow, 'dt': t,
-                    'db': db,
-                    'distance': str_dist,
-                    'duration': duration,
-                    'score': score,
-                    'mindb_score': mindb_score}
-            exposures.append(data)
-        data = {'date': dt, 'dow': dow, 'contact_event': t, 'pv': 'contact'}
-        events.append(data)
-
-    daily_summary_df = pd.DataFrame(daily_summary)
-    exposures_df = pd.DataFrame(exposures)
-    events_df = pd.DataFrame(events)
-
-    # ex_pv not used so far
-    ex_pv = pd.pivot_table(exposures_df, index=['date', 'dow'],
-                           columns=['distance'],
-                           values=['score', 'duration'],
-                           aggfunc=[np.sum, exposure_minutes],
-                           fill_value=0,
-                           margins=True,
-                           margins_name='合計')
-
-    ex_pv.applymap('{:,.0f}'.format)
-    ex_pv = ex_pv.drop(labels=('sum', 'duration'), axis=1)
-    ex_pv = ex_pv.drop(labels=('exposure_minutes', 'score'), axis=1)
-
-    # exposure duration(min)
-    duration_pv = pd.pivot_table(exposures_df, index=['date', 'dow'],
-                                 columns=['distance'],
-                                 values=['duration'],
-                                 aggfunc=[exposure_minutes],
-                                 fill_value=0,
-                                 margins=True,
-                                 margins_name='接触時間計(分)')
-
-    # caluculated score
-    calculate_score_pv = pd.pivot_table(exposures_df, index=['date', 'dow'],
-                                        columns=['distance'],
-                                        values=['score'],
-                                        aggfunc=[calc_score_sum],
-                                        fill_value=0,
-                                        margins=True,
-                                        margins_name='算出スコア計')
-    # 接触回数
-    events_pv = pd.pivot_table(events_df, index=['date', 'dow'],
-                               columns=['pv'],
-                               values=['contact_event'],
-                               aggfunc=['count'])
-    # COCOAスコア
-    cocoa_score_pv = pd.pivot_table(daily_summary_df, index=['date', 'dow'],
-                                    columns=['pv'],
-                                    values=['cocoa_score'],
-                                    aggfunc=[np.sum])
-
-    # dfのマージ
+
+def build_dfs_from_columns(logger, columns, summary_columns):
+    """Build DataFrame from columnar arrays
+
+    Args:
+        logger (logging): ロガー
+        columns (dict): build_scan_instance_columnsで作成したスキャンインスタンスの列形式配列
+        summary_columns (dict): cocoaPlatform.daily_summary_columnsで作成したdaily summaryの列形式配列
+
+    Returns:
+        df : merge_df
+
+    """
+    cc.COCOA_SCAN_INSTANCES = columns
+    cc.COCOA_DAILY_SUMMARIES = summary_columns
+    daily_summary_df = build_daily_summary_frame(logger, summary_columns)
+    exposures_df = build_exposures_frame(logger, columns)
+    events_df = build_events_frame(logger, columns)
+
+    return merge_pivots(logger,
+                        build_duration_pivot(logger, exposures_df),
+                        build_events_pivot(logger, events_df),
+                        build_cocoa_score_pivot(logger, daily_summary_df),
+                        build_calculate_score_pivot(logger, exposures_df))
+
+
+def build_daily_summary_frame(logger, summary_columns):
+    """daily summaryの列形式配列を日付/曜日付きのDataFrameにする"""
+    t = pd.to_datetime(summary_columns['millis'], unit='ms', utc=True).tz_convert(cc.TZ)
+    daily_summary = {'date': t.strftime('%Y-%m-%d'), 'dow': t.strftime('%a'),
+                     'cocoa_score': summary_columns['cocoa_score'], 'pv': 'cocoa_score'}
+    return pd.DataFrame(daily_summary)
+
+
+def build_exposures_frame(logger, columns):
+    """スキャンインスタンスの列形式配列を日付/曜日付きのDataFrameにする"""
+    # 日付/曜日はスキャンインスタンス単位でなく配列でまとめて変換
+    t = pd.to_datetime(columns['millis'], unit='ms', utc=True).tz_convert(cc.TZ)
+    exposures = {'date': t.strftime('%Y-%m-%d'), 'dow': t.strftime('%a'),
+                 'db': columns['db'],
+                 'distance': columns['distance'],
+                 'duration': columns['duration'],
+                 'score': columns['score'],
+                 'mindb_score': columns['mindb_score']}
+    return pd.DataFrame(exposures)
+
+
+def build_events_frame(logger, columns):
+    """exposure windowの日時を日付/曜日付きのDataFrameにする"""
+    t = pd.to_datetime(columns['window_millis'], unit='ms', utc=True).tz_convert(cc.TZ)
+    events = {'date': t.strftime('%Y-%m-%d'), 'dow': t.strftime('%a'),
+              'contact_event': t, 'pv': 'contact'}
+    return pd.DataFrame(events)
+
+
+def build_duration_pivot(logger, exposures_df):
+    """exposure duration(min) 距離区分別の接触時間"""
+    return pd.pivot_table(exposures_df, index=['date', 'dow'],
+                          columns=['distance'],
+                          values=['duration'],
+                          aggfunc=[exposure_minutes],
+                          fill_value=0,
+                          margins=True,
+                          margins_name='接触時間計(分)')
+
+
+def build_calculate_score_pivot(logger, exposures_df):
+    """caluculated score 距離区分別の算出スコア"""
+    return pd.pivot_table(exposures_df, index=['date', 'dow'],
+                          columns=['distance'],
+                          values=['score'],
+                          aggfunc=[calc_score_sum],
+                          fill_value=0,
+                          margins=True,
+                          margins_name='算出スコア計')
+
+
+def build_events_pivot(logger, events_df):
+    """接触回数"""
+    return pd.pivot_table(events_df, index=['date', 'dow'],
+                          columns=['pv'],
+                          values=['contact_event'],
+                          aggfunc=['count'])
+
+
+def build_cocoa_score_pivot(logger, daily_summary_df):
+    """COCOAスコア"""
+    return pd.pivot_table(daily_summary_df, index=['date', 'dow'],
+                          columns=['pv'],
+                          values=['cocoa_score'],
+                          aggfunc=[np.sum])
+
+
+def merge_pivots(logger, duration_pv, events_pv, cocoa_score_pv, calculate_score_pv):
+    """集計表をマージして期間移動合計を追加する
+
+    Args:
+        logger (logging): ロガー
+        duration_pv (DataFrame): build_duration_pivot
+        events_pv (DataFrame): build_events_pivot
+        cocoa_score_pv (DataFrame): build_cocoa_score_pivot
+        calculate_score_pv (DataFrame): build_calculate_score_pivot
+
+    Returns:
+        df : merge_df
+
+    """
+    # dfのマージ (表は全ての集計が有る日だけ)
     merge_df = pd.merge(duration_pv, events_pv, on=('date', 'dow'))
     merge_df = pd.merge(merge_df, cocoa_score_pv, on=('date', 'dow'))
     merge_df = pd.merge(merge_df, calculate_score_pv, on=('date', 'dow'))
+    # 期間移動合計は結合前の集計から求め、片方の集計にしか無い日も含める
+    sources = {col: daily_series(pv, col) for pv in (duration_pv, cocoa_score_pv, calculate_score_pv)
+               for col, label in ROLLING_COLUMNS if col in pv.columns}
+    merge_df = add_rolling_aggregates(logger, merge_df, cc.ROLLING_WINDOWS, sources)
 
     return merge_df
 
 
-def read_cocoa_log(logger):
-    """Read Cocoa Log(json) to dict
+def build_daily_totals(logger, exposures_df, events_df, daily_summary_df):
+    """グラフに使う日毎の合計だけを距離区分の集計表を作らずに計算する
+
+    カラムはmerge_dfと同じ (接触回数, 接触時間計(分), COCOAスコア, 算出スコア計, 期間移動合計)
 
     Args:
         logger (logging): ロガー
+        exposures_df (DataFrame): build_exposures_frame
+        events_df (DataFrame): build_events_frame
+        daily_summary_df (DataFrame): build_daily_summary_frame
 
     Returns:
-        dict : exposure
+        df : 日毎の合計 (merge_dfのカラムの一部)
+
+    """
+    exposures = exposures_df.groupby(['date', 'dow'])
+    minutes = exposures['duration'].sum() / 60
+    calc_scores = exposures['score'].sum()
+    events = events_df.groupby(['date', 'dow'])['contact_event'].count()
+    cocoa_scores = daily_summary_df.groupby(['date', 'dow'])['cocoa_score'].sum()
+    totals_df = pd.DataFrame({
+        ('exposure_minutes', 'duration', '接触時間計(分)'): minutes,
+        ('calc_score_sum', 'score', '算出スコア計'): calc_scores})
+    totals_df = totals_df.join(events.rename(('count', 'contact_event', 'contact')), how='inner')
+    totals_df = totals_df.join(cocoa_scores.rename(('sum', 'cocoa_score', 'cocoa_score')), how='inner')
+    totals_df.columns = pd.MultiIndex.from_tuples(totals_df.columns)
+    # 期間移動合計は結合前の集計から求める (merge_pivots と同じ)
+    sources = {('exposure_minutes', 'duration', '接触時間計(分)'): minutes,
+               ('calc_score_sum', 'score', '算出スコア計'): calc_scores,
+               ('sum', 'cocoa_score', 'cocoa_score'): cocoa_scores}
+    return add_rolling_aggregates(logger, totals_df, cc.ROLLING_WINDOWS, sources)
+
+
+def rolling_sum_dense(days, values, window):
+    """日付が欠けた系列の期間移動合計を累積和で計算する
+
+    最初の日から最後の日までの連続した日付(欠けた日は0)上で累積和を取り、
+    cs[i] - cs[i-window] で各日を含む直近window日の合計を求める O(n)
+
+    Args:
+        days (ndarray): datetime64[D] の日付 (重複可)
+        values (ndarray): 日付毎の値
+        window (int): 移動合計の日数
+
+    Returns:
+        ndarray: daysの各要素に対応する移動合計
+
+    """
+    day_numbers = days.astype('datetime64[D]').astype(np.int64)
+    if len(day_numbers) == 0:
+        return np.zeros(0, dtype=np.float64)
+    offsets = day_numbers - day_numbers.min()
+    dense = np.bincount(offsets, weights=values, minlength=offsets.max()+1)
+    cs = np.concatenate([[0.0], np.cumsum(dense)])
+    ends = offsets + 1
+    starts = np.maximum(ends - window, 0)
+    return cs[ends] - cs[starts]
+
+
+def rolling_sum_at(days, values, target_days, window):
+    """日付が欠けた系列の期間移動合計を、系列に無い日も含むtarget_daysの各日について求める
+
+    Args:
+        days (ndarray): datetime64[D] の系列の日付 (重複可)
+        values (ndarray): 日付毎の値
+        target_days (ndarray): datetime64[D] の移動合計を求める日付
+        window (int): 移動合計の日数
+
+    Returns:
+        ndarray: target_daysの各要素に対応する移動合計
+
+    """
+    days = np.concatenate([days.astype('datetime64[D]'), target_days.astype('datetime64[D]')])
+    values = np.concatenate([values, np.zeros(len(target_days), dtype=np.float64)])
+    return rolling_sum_dense(days, values, window)[len(days) - len(target_days):]
+
+
+def daily_series(pv, col):
+    """集計表のカラムから日付の行だけを取り出す (pivot_tableのmarginsの合計行を除く)"""
+    series = pv[col]
+    dates = pd.to_datetime(series.index.get_level_values('date'), errors='coerce')
+    return series[dates.notna()]
+
+
+def add_rolling_aggregates(logger, merge_df, windows, sources=None):
+    """COCOAスコア、算出スコア、接触時間の期間移動合計カラムを追加する
+
+    移動合計は連続した日付(欠けた日は0)上で求める
+    sourcesを渡すとmerge_dfの結合で落ちた日(片方の集計にしか無い日)の値も合計に含める
+
+    Args:
+        logger (logging): ロガー
+        merge_df (DataFrame): build_dfsでマージしたDataFrame
+        windows (list of int): 移動合計の日数 ex: [7, 14, 28]
+        sources (dict): ROLLING_COLUMNSのカラムをキーにした結合前の日毎の値 (index: date, dow)
+                        default: merge_dfのカラム
+
+    Returns:
+        DataFrame : 移動合計カラムを追加したmerge_df
+
+    """
+    sources = sources or {}
+    days = pd.to_datetime(merge_df.index.get_level_values('date')).values
+    for window in windows:
+        for col, label in ROLLING_COLUMNS:
+            if col in sources:
+                source = sources[col]
+                merge_df[rolling_column(col, window, label)] = rolling_sum_at(
+                    pd.to_datetime(source.index.get_level_values('date')).values,
+                    source.to_numpy(dtype=np.float64), days, window)
+            else:
+                merge_df[rolling_column(col, window, label)] = rolling_sum_dense(
+                    days, merge_df[col].to_numpy(dtype=np.float64), window)
+    return merge_df
+
+
+def rolling_column(col, window, label):
+    """期間移動合計カラム名
+
+    Args:
+        col (tuple): 元になるmerge_dfのカラム
+        window (int): 移動合計の日数
+        label (str): 表示名
+
+    Returns:
+        tuple : merge_dfのカラム ex: ('rolling_sum', 'cocoa_score', 'COCOAスコア14日計')
+
+    """
+    return ('rolling_sum', col[1], label.format(window))
+
+
+def rollup_dataframe(logger, df, resolution):
+    """日毎の集計を週毎/月毎にまとめる (スキャンインスタンスからは集計し直さない)
+
+    期間移動合計カラムは期間内の最後の日の値 (期間末時点の直近N日計)、その他のカラムは期間内の合計
+
+    Args:
+        logger (logging): ロガー
+        df (DataFrame): merge_df または build_daily_totals (index: date, dow)
+        resolution (str): week/month
+
+    Returns:
+        DataFrame : dfと同じカラムの集計
+                    index date: 週の月曜日(YYYY-MM-DD) または 月(YYYY-MM), dow: RESOLUTION_LABELS
+
+    """
+    days = pd.to_datetime(df.index.get_level_values('date'))
+    if resolution == 'week':
+        keys = (days - pd.to_timedelta(days.dayofweek, unit='D')).strftime('%Y-%m-%d')
+    else:
+        keys = days.strftime('%Y-%m')
+    rolling = [col for col in df.columns if col[0] == 'rolling_sum']
+    totals = [col for col in df.columns if col[0] != 'rolling_sum']
+    grouped = df.groupby(keys.values, sort=True)
+    rollup_df = pd.concat([grouped[totals].sum(), grouped[rolling].last()], axis=1)[df.columns]
+    rollup_df.index = pd.MultiIndex.from_arrays(
+        [rollup_df.index, [RESOLUTION_LABELS[resolution]] * len(rollup_df)], names=['date', 'dow'])
+    logger.debug(f'rollup {resolution}: {len(df)} -> {len(rollup_df)} rows')
+    return rollup_df
+
+
+def build_rollups(logger, df):
+    """日毎の集計から 日/週/月 の3段階の集計を作る
+
+    Args:
+        logger (logging): ロガー
+        df (DataFrame): merge_df または build_daily_totals
+
+    Returns:
+        dict : RESOLUTIONSをキーにした集計 'day'はdfそのもの
+
+    """
+    rollups = {'day': df}
+    for resolution in RESOLUTIONS[1:]:
+        rollups[resolution] = rollup_dataframe(logger, df, resolution)
+    return rollups
+
+
+def select_resolution(df, resolution=None):
+    """表示/出力する集計の単位を選ぶ
+
+    autoの場合は期間(最初の日から最後の日までの日数)が cc.RESOLUTION_MAX_POINTS 個以下に
+    収まる一番細かい単位にする
+
+    Args:
+        df (DataFrame): 日毎の集計
+        resolution (str): auto/day/week/month default: cc.RESOLUTION
+
+    Returns:
+        str : day/week/month
+
+    """
+    resolution = resolution or cc.RESOLUTION
+    if resolution != 'auto':
+        return resolution
+    days = pd.to_datetime(df.index.get_level_values('date'))
+    span = (days.max() - days.min()).days + 1 if len(days) > 0 else 0
+    if span <= cc.RESOLUTION_MAX_POINTS:
+        return 'day'
+    if -(-span // 7) <= cc.RESOLUTION_MAX_POINTS:
+        return 'week'
+    return 'month'
+
+
+def open_cocoa_log_streams(filename):
+    """cocoa logファイルを開いてファイルオブジェクトを返すジェネレータ
+
+    .json.gz/.json.xz は伸長するファイルオブジェクト、.zip は含まれる*.jsonを1つずつ返す
+    一時ファイルには展開しないが、読む側(json.load)は伸長した内容を全てメモリに読み込んでから解析する
+
+    Args:
+        filename (str): cocoa log ファイル名
+
+    Yields:
+        str : ログ名 (zipの場合は ファイル名:メンバー名)
+        file object : 伸長したJSONを読むファイルオブジェクト
 
     """
-    exposure = {}
+    lower = filename.lower()
+    if lower.endswith('.gz'):
+        with gzip.open(filename, 'rb') as stream:
+            yield filename, stream
+    elif lower.endswith('.xz'):
+        with lzma.open(filename, 'rb') as stream:
+            yield filename, stream
+    elif lower.endswith('.zip'):
+        with zipfile.ZipFile(filename) as zf:
+            for member in zf.infolist():
+                name = member.filename
+                if member.is_dir() or not name.lower().endswith('.json') or name.startswith('__MACOSX/'):
+                    continue
+                with zf.open(member) as stream:
+                    yield f'{filename}:{name}', stream
+    else:
+        with open(filename, 'r') as stream:
+            yield filename, stream
+
+
+def read_cocoa_log_members(logger, filename=None):
+    """Read Cocoa Log(json, json.gz, json.xz, zip) to list of dict
+
+    圧縮されたログは一時ファイル無しでメモリ上に伸長し、ログ毎に全体をjson.loadする (逐次解析はしない)
+
+    Args:
+        logger (logging): ロガー
+        filename (str): cocoa log ファイル名 default: cc.COCOA_LOG
+
+    Returns:
+        list : (ログ名, exposure) のリスト zipの場合は複数
+
+    """
+    if filename is None:
+        filename = cc.COCOA_LOG
+    members = []
     try:
-        # logger.info(f'cocoa_log: {cc.COCOA_LOG}')
-        with open(cc.COCOA_LOG, 'r') as exposure_data:
-            exposure = json.load(exposure_data)
+        # logger.info(f'cocoa_log: {filename}')
+        for name, exposure_data in open_cocoa_log_streams(filename):
+            members.append((name, json.load(exposure_data)))
     except FileNotFoundError as e:
-        logger.info(f"ファイルが見つかりません。 {cc.COCOA_LOG}")
+        logger.info(f"ファイルが見つかりません。 {filename}")
         cc.NEED_VALID_COCOA_LOG = True
     except Exception as e:
         stack_trace = traceback.format_exc()
         logger.info(f"Catch Exception: {e}\nSTACK_TRACE:\n{stack_trace}")
-        cc.NEED_VALID_COCOA_LOG = True    
+        cc.NEED_VALID_COCOA_LOG = True
+    return members
+
+
+@cmem.profiled('read_cocoa_log')
+def read_cocoa_log(logger, filename=None):
+    """Read Cocoa Log(json, json.gz, json.xz, zip) to dict
+
+    zipに複数のexposure_data.jsonが含まれる場合は重複windowを除いて結合する
+
+    Args:
+        logger (logging): ロガー
+        filename (str): cocoa log ファイル名 default: cc.COCOA_LOG
+
+    Returns:
+        dict : exposure
+
+    """
+    exposures = [exposure for name, exposure in read_cocoa_log_members(logger, filename)]
+    if len(exposures) == 0:
+        return {}
+    if len(exposures) == 1:
+        return exposures[0]
+    try:
+        exposure, n_duplicated, n_skipped = merge_exposures(logger, exposures)
+    except KeyError as ke:
+        logger.info(f'正しいcocoa_logファイルではありません。{filename}')
+        exposure = {}
     return exposure
-    
+
+
+def dedup_records(records, fingerprint, seen):
+    """fingerprintが未出のレコードだけを返す hash setによる線形時間の重複除去
+
+    Args:
+        records (list): exposure_windows
+        fingerprint (function): レコードのキー関数
+        seen (set): 既出のキー 呼び出し側と共有され更新される
+
+    Returns:
+        list : 重複を除いたレコード
+
+    """
+    unique = []
+    for record in records:
+        key = fingerprint(record)
+        if key not in seen:
+            seen.add(key)
+            unique.append(record)
+    return unique
+
+
+def dedup_summaries(adapter, records, fingerprint, kept):
+    """同じ端末の同じ日のdaily summaryは1つにまとめる 後のエクスポートほど値が増えるので最大のものを残す
+
+    Args:
+        adapter (dict): アダプタ
+        records (list): daily_summaries
+        fingerprint (function): レコードのキー関数 (端末, 日付)
+        kept (dict): キーをキーにした残すレコード 呼び出し側と共有され更新される
+
+    Returns:
+        None
+
+    """
+    for record in records:
+        key = fingerprint(record)
+        if key not in kept or cp.summary_score(adapter, record) > cp.summary_score(adapter, kept[key]):
+            kept[key] = record
+    return
+
+
+def merge_exposures(logger, exposures):
+    """複数のexposure_data.jsonを重複windowを除いて1つにまとめる
+
+    daily summaryは端末と日付毎に1つ(値が最大のもの)にする 同じ端末の再エクスポートで同じ日を二重に数えない
+    先頭ログと同じアダプタ(キー名のバリアント)のログだけを結合し、他のバリアントのログは数えて除く
+
+    Args:
+        logger (logging): ロガー
+        exposures (list of dict): read_cocoa_logで読み込んだexposure
+
+    Returns:
+        dict : 先頭ログのヘッダ情報に重複除去したexposure_windows/daily_summariesを持つexposure
+        int : 除去したexposure_windowsの数
+        int : 結合しなかった(バリアントの異なる)ログの数
+
+    """
+    seen_windows = set()
+    kept_summaries = {}
+    windows = []
+    n_windows = 0
+    n_skipped = 0
+    adapter = cp.select_adapter(exposures[0])
+    if adapter is None:
+        raise KeyError('exposure_windows')
+    window_fingerprint = partial(cp.window_fingerprint, adapter)
+    for exposure in exposures:
+        if cp.select_adapter(exposure) is not adapter:
+            logger.info(f'skip log of another platform variant: {exposure.get("platform")}')
+            n_skipped += 1
+            continue
+        n_windows += len(cp.windows(adapter, exposure))
+        windows.extend(dedup_records(cp.windows(adapter, exposure), window_fingerprint, seen_windows))
+        summary_fingerprint = partial(cp.summary_fingerprint, adapter, device=cp.device_key(exposure))
+        dedup_summaries(adapter, cp.summaries(adapter, exposure), summary_fingerprint, kept_summaries)
+    merged = dict(exposures[0])
+    merged[adapter['keys']['windows']] = windows
+    merged[adapter['keys']['summaries']] = list(kept_summaries.values())
+    n_duplicated = n_windows - len(windows)
+    logger.info(f'merged {len(exposures) - n_skipped} logs: {len(windows)} windows, {n_duplicated} duplicated, '
+                f'{n_skipped} skipped')
+    return merged, n_duplicated, n_skipped
+
+
+def update_household_dataframe(logger, filenames):
+    """複数のCOCOAログ(世帯の複数端末、同一端末の再エクスポート)をまとめて集計する
+
+    Args:
+        logger (logging): ロガー
+        filenames (list of str): cocoa log ファイル名のリスト
+
+    Returns:
+        DataFrame : 重複を除いて結合したmerge_df 正しいログが無い場合はNone
+        dict : ログ名をキーにした端末毎のmerge_df
+
+    """
+    device_dfs = {}
+    exposures = []
+    members = []
+    for filename in filenames:
+        members.extend(read_cocoa_log_members(logger, filename))
+    for name, exposure in members:
+        device_df = verify_and_build_dataframe(logger, exposure)
+        if device_df is not None:
+            device_dfs[name] = device_df
+            exposures.append(exposure)
+        else:
+            logger.info(f'正しいcocoa_logファイルではありません。{name}')
+
+    if len(exposures) == 0:
+        cc.NEED_VALID_COCOA_LOG = True
+        return None, device_dfs
+
+    merged, n_duplicated, n_skipped = merge_exposures(logger, exposures)
+    merge_df = verify_and_build_dataframe(logger, merged)
+    cc.COCOA_LOG_INFORMATION.append(f"# of merged logs: {len(exposures) - n_skipped}")
+    cc.COCOA_LOG_INFORMATION.append(f"# of skipped logs (other platform variant): {n_skipped}")
+    cc.COCOA_LOG_INFORMATION.append(f"# of duplicated exposure_windows: {n_duplicated}")
+    return merge_df, device_dfs
+
 
 def update_dataframe(logger):
     """update Dataframe with current json file
 
+    cc.COCOA_LOGSに複数ファイルが指定されている場合やzipの場合は結合して集計し、
+    端末毎のDataFrameをcc.COCOA_DEVICE_DFSに保持する
+    1つのログは、ログより新しいスナップショット(cocoaSnapshot)が有ればJSONを読まずに集計する
+    集計結果はcocoaPipelineにメモ化され、ログが変わるまで再計算しない
+
     Args:
         logger (logging): ロガー
 
@@ -287,14 +826,15 @@ def update_dataframe(logger):
         DataFrame : valid cocoa log dataframe
 
     """
-    exposure = read_cocoa_log(logger)
-    merge_df = verify_and_build_dataframe(logger, exposure)
-    return merge_df
+    return cpl.stage(logger, 'merge_df')
 
 
 def main(logger):
     """Cocoa Log Checker Main
 
+    GUI, matplotlib, Excel(openpyxl)のモジュールは使うモードでだけimportする
+    (--no_gui の起動時間にこれらのimportを含めない)
+
     Args:
         logger (logging): ロガー
 
@@ -302,8 +842,52 @@ def main(logger):
         None
 
     """
-    merge_df = update_dataframe(logger)
-    cg.main(logger, merge_df)  # open gui
+    if cc.BATCH_LOGS:
+        # バッチはGUIを開かずにログ毎のExcelを作成して終了
+        import cocoaBatch as cb
+        cb.run_batch(logger, cc.BATCH_LOGS, jobs=cc.BATCH_JOBS)
+        return
+    if cc.WATCH_DIR:
+        # フォルダ監視はGUIを開かずに停止されるまで処理を続ける
+        import cocoaWatch as cw
+        cw.run_watch(logger, cc.WATCH_DIR, jobs=cc.BATCH_JOBS)
+        return
+    if cc.COMPARE_LOGS:
+        # 2つのログの差分を出力して終了
+        import cocoaCompare as ccmp
+        ccmp.run_compare(logger, *cc.COMPARE_LOGS)
+        return
+    if cc.CHART_FILE:
+        # グラフだけの出力は距離区分の集計表を作らない
+        import matplotlib
+        matplotlib.use('Agg')
+        import cocoaChart as ccht
+        resolution, totals_df = cpl.resolution_view(logger, 'totals_rollups')
+        if totals_df is not None:
+            ccht.draw_cocoa_charts(logger, totals_df, filename=cc.CHART_FILE)
+            logger.info(f'グラフが作成されました: {cc.CHART_FILE} ({resolution})')
+        else:
+            logger.info(f'正しいCOCOAログではありません: {cc.COCOA_LOG}')
+        return
+    if cc.EXPORT_FORMATS:
+        # データ出力はGUIを開かずに終了
+        import cocoaExport as cexp
+        merge_df = update_dataframe(logger)
+        if merge_df is not None:
+            for fmt in cc.EXPORT_FORMATS:
+                cexp.export_tables(logger, merge_df, cpl.stage(logger, 'score'),
+                                   cc.COCOA_LOG_INFORMATION, fmt)
+        else:
+            logger.info(f'正しいCOCOAログではありません: {cc.COCOA_LOG}')
+        return
+    if cc.TEXT_REPORT:
+        # 表、ログ情報、閾値越えの日を端末/ファイルに出力して終了
+        import cocoaText as ctxt
+        ctxt.run_text_report(logger, cc.TEXT_REPORT)
+        return
+    import cocoaGui as cg
+    cpl.stage(logger, 'parse')  # ヘッダ情報だけ読んでGUIを開き、集計はGUIで行う
+    cg.main(logger)  # open gui
     return
 
 
@@ -311,4 +895,7 @@ if __name__ == '__main__':
     logger = cc.create_logger()
     parser = cc.setup_args()
     cc.parse_args(parser)
-    main(logger)
+    try:
+        main(logger)
+    finally:
+        cmem.write_report(logger)
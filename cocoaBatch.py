@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Batch Report
+
+    複数のcocoa logから1ログ1ブックでExcelを作成する
+    ブック作成はプロセスプールで並列に実行する
+
+    各ワーカープロセスは cocoaExcel.TEMPLATE_CACHE (整形済みテンプレート)を
+    プロセス内で使い回すので、同じカラム構成のブックは2冊目から値の書き込みだけになる
+
+    詳細ブック(--excel_detail)やデータ出力(--export)は、ログを読んだワーカーが
+    スキャンインスタンスの列形式配列を共有メモリに置き(cocoaShared)、別のワーカーが
+    アタッチして並列に書き出す 配列はpickleしない
+
+    --reconcile の場合はワーカーがログ毎のスコアの突き合わせ結果(cocoaReconcile)を返し、
+    全ログ分を1つのブックにまとめる
+
+"""
+import logging
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cocoa
+import cocoaConfig as cc
+import cocoaExcel as cex
+import cocoaExport as cexp
+import cocoaReconcile as creco
+import cocoaShared as csm
+import cocoaStats as cstat
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+def log_stem(filename):
+    """ブック名に使うログファイル名の拡張子を除いた部分
+
+    Args:
+        filename (str): cocoa log ファイル名
+
+    Returns:
+        (str): ex: /path/exposure_data.json.gz -> exposure_data
+
+    """
+    stem = os.path.basename(filename)
+    for ext in ('.gz', '.xz', '.zip', '.json'):
+        if stem.lower().endswith(ext):
+            stem = stem[:-len(ext)]
+    return stem
+
+
+def init_worker(rolling_windows, excel_detail, export_formats=(), resolution='auto', stats_file=None,
+                reconcile=False, fail_fast=False, max_errors=20, log_levels=None):
+    """ワーカープロセスの初期化 親プロセスのコマンドライン設定を引き継ぐ
+
+    Args:
+        rolling_windows (list of int): cc.ROLLING_WINDOWS
+        excel_detail (bool): cc.EXCEL_DETAIL
+        export_formats (list of str): cc.EXPORT_FORMATS
+        resolution (str): cc.RESOLUTION
+        stats_file (str): cc.STATS_FILE 指定された場合はログ毎の統計を返す (ファイルへの追加は親プロセス)
+        reconcile (bool): cc.RECONCILE ログ毎のスコアの突き合わせ結果を返す
+        fail_fast (bool): cc.VALIDATION_FAIL_FAST レコードの検証はワーカーで行う
+        max_errors (int): cc.VALIDATION_MAX_ERRORS
+        log_levels (dict): cc.LOG_LEVELS
+
+    Returns:
+        None
+
+    """
+    cc.ROLLING_WINDOWS = rolling_windows
+    cc.EXCEL_DETAIL = excel_detail
+    cc.EXPORT_FORMATS = list(export_formats)
+    cc.RESOLUTION = resolution
+    cc.STATS_FILE = stats_file
+    cc.RECONCILE = reconcile
+    cc.VALIDATION_FAIL_FAST = fail_fast
+    cc.VALIDATION_MAX_ERRORS = max_errors
+    cc.LOG_LEVELS = dict(log_levels or {})
+    return
+
+
+def log_stats(merge_df):
+    """cc.STATS_FILE が指定されている場合は1つのログの統計を作る (ワーカープロセスで実行)"""
+    if cc.STATS_FILE is None:
+        return None
+    return cstat.update_stats(cstat.new_stats(), merge_df)
+
+
+def build_workbook(logger, filename, output_dir=None, detail=False):
+    """1つのcocoa logを読んでExcelブックを作成する (build_report と build_shared_report の共通部分)
+
+    Args:
+        logger (logging): ロガー
+        filename (str): cocoa log ファイル名
+        output_dir (str): Excelを作成するディレクトリ default: カレントディレクトリ
+        detail (bool): 詳細シートを同じブックに追加する
+
+    Returns:
+        (dict): cocoa log
+        (DataFrame): マージ後のDataFrame 正しいログでない場合はNone
+        (str): Excelファイル名の先頭
+        (str): 作成したExcelファイル名 正しいログでない場合はNone
+
+    """
+    cc.COCOA_LOG = filename
+    exposure = cocoa.read_cocoa_log(logger, filename)
+    merge_df = cocoa.verify_and_build_dataframe(logger, exposure)
+    basename = f'{cc.report_basename()}_{log_stem(filename)}'
+    if output_dir is not None:
+        basename = os.path.join(output_dir, basename)
+    if merge_df is None:
+        return exposure, None, basename, None
+    heatmaps = cocoa.build_heatmap_data(logger, cc.COCOA_SCAN_INSTANCES)
+    bookname = cex.create_cocoa_excel(logger, merge_df, heatmaps=heatmaps,
+                                      detail=cc.COCOA_SCAN_INSTANCES if detail else None,
+                                      basename=basename, rollups=cocoa.build_rollups(logger, merge_df))
+    return exposure, merge_df, basename, bookname
+
+
+def build_report(filename, output_dir=None):
+    """1つのcocoa logからExcelブックを作成する (ワーカープロセスで実行)
+
+    Args:
+        filename (str): cocoa log ファイル名
+        output_dir (str): Excelを作成するディレクトリ default: カレントディレクトリ
+
+    Returns:
+        (str): cocoa log ファイル名
+        (str): 作成したExcelファイル名 正しいログでない場合はNone
+        (dict): ログの統計 (cc.STATS_FILE が無い場合はNone)
+
+    """
+    # ワーカーはDEBUGFILEを上書きしないようにファイルハンドラ無しのロガーを使う
+    logger = logging.getLogger(__name__)
+    try:
+        exposure, merge_df, basename, bookname = build_workbook(logger, filename, output_dir,
+                                                                detail=cc.EXCEL_DETAIL)
+        if bookname is None:
+            return filename, None, None
+        stats = log_stats(merge_df)
+    except Exception as e:
+        stack_trace = traceback.format_exc()
+        logger.warning(f"Catch Exception: {e}\nSTACK_TRACE:\n{stack_trace}")
+        return filename, None, None
+    return filename, bookname, stats
+
+
+def build_shared_report(filename):
+    """1つのcocoa logからExcelブックを作成し、詳細/データ出力用に列形式配列を共有する (ワーカープロセスで実行)
+
+    Args:
+        filename (str): cocoa log ファイル名
+
+    Returns:
+        (str): cocoa log ファイル名
+        (str): 作成したExcelファイル名 正しいログでない場合はNone
+        (dict): 後続の出力に渡す handle(共有メモリ), merge_df, log_information, basename
+                詳細/データ出力が無い場合はNone
+        (dict): ログの統計 (cc.STATS_FILE が無い場合はNone)
+        (dict): スコアの突き合わせ結果 (cc.RECONCILE でない場合はNone)
+
+    """
+    logger = logging.getLogger(__name__)
+    shared = None
+    try:
+        exposure, merge_df, basename, bookname = build_workbook(logger, filename)
+        if bookname is None:
+            return filename, None, None, None, None
+        if cc.EXCEL_DETAIL or cc.EXPORT_FORMATS:
+            shared = {'handle': csm.share_columns(cc.COCOA_SCAN_INSTANCES), 'merge_df': merge_df,
+                      'log_information': cc.COCOA_LOG_INFORMATION, 'basename': basename}
+        stats = log_stats(merge_df)
+        reconcile = None
+        if cc.RECONCILE:
+            reconcile = creco.reconcile_log(filename, exposure, cc.COCOA_SCAN_INSTANCES, cc.COCOA_DAILY_SUMMARIES)
+    except Exception as e:
+        stack_trace = traceback.format_exc()
+        logger.warning(f"Catch Exception: {e}\nSTACK_TRACE:\n{stack_trace}")
+        if shared is not None:
+            # 親プロセスにハンドルを渡せないので、作成した共有メモリはここで解放する
+            csm.unlink_columns(shared['handle'])
+        return filename, None, None, None, None
+    return filename, bookname, shared, stats, reconcile
+
+
+def write_detail(handle, basename):
+    """共有メモリの列形式配列から詳細ブックを作成する (ワーカープロセスで実行)
+
+    Args:
+        handle (dict): cocoaShared.share_columnsのハンドル
+        basename (str): Excelファイル名の先頭
+
+    Returns:
+        list : 作成したファイル名
+
+    """
+    logger = logging.getLogger(__name__)
+    columns, blocks = csm.attach_columns(handle)
+    try:
+        bookname = cc.unique_filename(f'{basename}_{cc.COCOA_DETAIL_SHEET_NAME}', '.xlsx')
+        cex.create_detail_excel(logger, columns, bookname)
+        filenames = [bookname]
+    except Exception as e:
+        stack_trace = traceback.format_exc()
+        logger.warning(f"Catch Exception: {e}\nSTACK_TRACE:\n{stack_trace}")
+        filenames = []
+    finally:
+        del columns
+        csm.close_blocks(blocks)
+    return filenames
+
+
+def write_export(handle, merge_df, log_information, fmt, basename):
+    """共有メモリの列形式配列と集計結果をデータ出力する (ワーカープロセスで実行)
+
+    Args:
+        handle (dict): cocoaShared.share_columnsのハンドル
+        merge_df (DataFrame): マージ後のDataFrame
+        log_information (list of str): cc.COCOA_LOG_INFORMATION
+        fmt (str): csv/parquet/jsonl
+        basename (str): 出力ファイル名の先頭
+
+    Returns:
+        list : 出力したファイル名
+
+    """
+    logger = logging.getLogger(__name__)
+    columns, blocks = csm.attach_columns(handle)
+    try:
+        filenames = cexp.export_tables(logger, merge_df, columns, log_information, fmt, basename=basename)
+    except Exception as e:
+        stack_trace = traceback.format_exc()
+        logger.warning(f"Catch Exception: {e}\nSTACK_TRACE:\n{stack_trace}")
+        filenames = []
+    finally:
+        del columns
+        csm.close_blocks(blocks)
+    return filenames
+
+
+def run_batch(logger, filenames, jobs=None):
+    """cocoa logごとのExcelブック作成をプロセスプールで並列に実行する
+
+    Args:
+        logger (logging): ロガー
+        filenames (list of str): cocoa log ファイル名のリスト
+        jobs (int): ワーカープロセス数 Noneはcpu数
+
+    Returns:
+        dict : cocoa log ファイル名をキーにした作成したExcelファイル名 (失敗はNone)
+
+    """
+    logger.info(f'batch: {len(filenames)} logs, jobs: {jobs or os.cpu_count()}')
+    results = {}
+    handoffs = []
+    log_stats_list = []
+    reconciles = []
+    csm.ensure_tracker()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(cc.ROLLING_WINDOWS, cc.EXCEL_DETAIL, cc.EXPORT_FORMATS,
+                                       cc.RESOLUTION, cc.STATS_FILE, cc.RECONCILE, cc.VALIDATION_FAIL_FAST,
+                                       cc.VALIDATION_MAX_ERRORS, cc.LOG_LEVELS)) as executor:
+        try:
+            futures = [executor.submit(build_shared_report, filename) for filename in filenames]
+            for future in as_completed(futures):
+                filename, bookname, shared, stats, reconcile = future.result()
+                results[filename] = bookname
+                if bookname is None:
+                    logger.info(f'正しいCOCOAログではありません: {filename}')
+                    continue
+                if stats is not None:
+                    log_stats_list.append(stats)
+                if reconcile is not None:
+                    reconciles.append(reconcile)
+                logger.info(f'Excelファイルが作成されました: {bookname} <- {filename}')
+                if shared is None:
+                    continue
+                # 列形式配列はハンドルだけを渡し、後続のワーカーが共有メモリにアタッチする
+                tasks = []
+                if cc.EXCEL_DETAIL:
+                    tasks.append(executor.submit(write_detail, shared['handle'], shared['basename']))
+                for fmt in cc.EXPORT_FORMATS:
+                    tasks.append(executor.submit(write_export, shared['handle'], shared['merge_df'],
+                                                 shared['log_information'], fmt, shared['basename']))
+                handoffs.append((filename, shared['handle'], tasks))
+
+            for filename, handle, tasks in handoffs:
+                for task in tasks:
+                    for output in task.result():
+                        logger.info(f'出力されました: {output} <- {filename}')
+        finally:
+            # 途中で失敗しても共有メモリを残さない
+            for filename, handle, tasks in handoffs:
+                csm.unlink_columns(handle)
+    if cc.STATS_FILE is not None:
+        # ワーカー毎の統計は件数を足すだけでまとめられる
+        cstat.add_stats(logger, cc.STATS_FILE, log_stats_list)
+    if cc.RECONCILE:
+        bookname = creco.write_report(logger, reconciles)
+        if bookname is not None:
+            logger.info(f'スコアの突き合わせ結果が作成されました: {bookname}')
+    return results
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Benchmark
+
+    処理時間の計測 (各処理をrepeat回実行して最小値を表示する)
+
+    validate: JSONのデコードと列形式配列の作成(検証込み)の時間と、
+              そのうち検証(dtype/範囲の確認)にかかった時間と割合
+              不正な値が1つ有るログの列形式配列の作成(不正なwindowだけをレコード毎に検証)の時間と、
+              比較として全てのレコードを検証した場合(配列にできないログの処理)の時間
+    startup: --no_gui の起動時間(import)と全体の実行時間を別プロセスで計測し、
+             GUI/matplotlib/openpyxl がimportされていないことを確認する
+
+    Example:
+        python cocoaBenchmark.py validate -l exposure_data.json -n 5
+        python cocoaBenchmark.py startup -l exposure_data.json -n 5
+
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cocoa
+import cocoaPlatform as cp
+import cocoaValidate as cv
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+COCOA_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cocoa.py')
+HEAVY_MODULES = ('PySimpleGUI', 'tkinter', 'matplotlib', 'openpyxl')  # --no_gui でimportしないモジュール
+
+def setup_args():
+    """"コマンドライン引数設定
+
+    Args:
+        None
+
+    Returns:
+        (argparse): parser
+
+    """
+    parser = argparse.ArgumentParser(description='Cocoa Log Benchmark')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    validate = subparsers.add_parser('validate', help='overhead of record validation while parsing')
+    validate.add_argument('-l', '--cocoa_log', metavar='COCOA_LOGFILE', default='exposure_data.json',
+                          help='cocoa log file')
+    validate.add_argument('-n', '--repeat', type=int, default=5, help='repeat count (default: 5)')
+    startup = subparsers.add_parser('startup', help='cold start and total runtime of --no_gui')
+    startup.add_argument('-l', '--cocoa_log', metavar='COCOA_LOGFILE', default='exposure_data.json',
+                         help='cocoa log file')
+    startup.add_argument('-n', '--repeat', type=int, default=5, help='repeat count (default: 5)')
+    return parser
+
+
+def best_of(repeat, func, *args):
+    """funcをrepeat回実行して最短の時間(秒)と最後の結果を返す"""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def check_columns(adapter, columns, summary_columns):
+    """列形式配列の作成時に行うdtype/範囲の確認"""
+    return (cv.in_range(columns['window_millis'], cv.MILLIS_RANGE)
+            and cv.in_range(columns['db'], cv.ATTENUATION_RANGE)
+            and cv.in_range(columns['mindb'], cv.ATTENUATION_RANGE)
+            and cv.in_range(columns['duration'], cv.DURATION_RANGE)
+            and cv.in_range(summary_columns['millis'] // adapter['summary_millis_scale'],
+                            cv.summary_millis_range(adapter))
+            and cv.in_range(summary_columns['cocoa_score'], cv.WEIGHTED_DURATION_RANGE, kinds='iuf'))
+
+
+def extract_columns(adapter, exposure):
+    """列形式配列の作成 (検証込み)"""
+    report = cv.new_report(fail_fast=False)
+    return (cp.scan_instance_columns(adapter, exposure, report),
+            cp.daily_summary_columns(adapter, exposure, report))
+
+
+def with_invalid_value(adapter, exposure):
+    """最初のscan instanceのdbを範囲外にしたexposure (元のexposureは変更しない)"""
+    keys = adapter['keys']
+    ews = list(cp.windows(adapter, exposure))
+    for i, ew in enumerate(ews):
+        if ew[keys['scan_instances']]:
+            sis = list(ew[keys['scan_instances']])
+            sis[0] = dict(sis[0], **{keys['db']: -1})
+            ews[i] = dict(ew, **{keys['scan_instances']: sis})
+            break
+    return dict(exposure, **{keys['windows']: ews})
+
+
+def validate_records(adapter, exposure):
+    """全てのレコードの検証 (配列にできないログの処理)"""
+    report = cv.new_report(fail_fast=False)
+    cv.scan_instance_columns(adapter, cp.windows(adapter, exposure), report)
+    cv.daily_summary_columns(adapter, cp.summaries(adapter, exposure), report)
+    return report
+
+
+def benchmark_validate(logger, args):
+    """検証のオーバーヘッドを計測して表示する
+
+    Args:
+        logger (logging): ロガー
+        args (Namespace): コマンドライン引数
+
+    Returns:
+        None
+
+    """
+    decode, exposure = best_of(args.repeat, cocoa.read_cocoa_log, logger, args.cocoa_log)
+    adapter = cp.select_adapter(exposure)
+    if adapter is None:
+        print(f'正しいCOCOAログではありません: {args.cocoa_log}')
+        return
+    extract, (columns, summary_columns) = best_of(args.repeat, extract_columns, adapter, exposure)
+    check, valid = best_of(args.repeat, check_columns, adapter, columns, summary_columns)
+    invalid, (invalid_columns, invalid_summary_columns) = best_of(
+        args.repeat, extract_columns, adapter, with_invalid_value(adapter, exposure))
+    records, report = best_of(args.repeat, validate_records, adapter, exposure)
+    parse = decode + extract
+    print(f"log: {args.cocoa_log} scan instances: {len(columns['millis'])} windows: {len(columns['window_millis'])}")
+    print(f'json decode:          {decode * 1000:9.2f} ms')
+    print(f'columns (validated):  {extract * 1000:9.2f} ms')
+    print(f'  validation checks:  {check * 1000:9.2f} ms  {check / parse:6.2%} of parse')
+    print(f'columns (1 invalid):  {invalid * 1000:9.2f} ms  {invalid / parse:6.2%} of parse'
+          f' (per-record check of the invalid window only)')
+    print(f"per-record validator: {records * 1000:9.2f} ms  {records / parse:6.2%} of parse"
+          f" (used only when columns cannot be built, errors: {report['count']})")
+    return
+
+
+def run_child(command, cwd):
+    """子プロセスを実行して (経過時間(秒), -X importtimeの出力) を返す"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', *command], cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    return time.perf_counter() - start, result.stderr
+
+
+def import_profile(importtime):
+    """-X importtime の出力から import全体の時間(秒) と importされたHEAVY_MODULES を求める"""
+    total = 0
+    heavy = set()
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            total += int(cumulative_us)  # トップレベルのimport
+        if name.strip().split('.')[0] in HEAVY_MODULES:
+            heavy.add(name.strip().split('.')[0])
+    return total / 1e6, sorted(heavy)
+
+
+def benchmark_startup(logger, args):
+    """--no_gui の起動時間と実行時間を計測して表示する
+
+    子プロセスは一時フォルダで実行する (cocoa_log.txtを残さない)
+    2回目以降はログのスナップショットが有るのでJSONを読まない
+
+    Args:
+        logger (logging): ロガー
+        args (Namespace): コマンドライン引数
+
+    Returns:
+        None
+
+    """
+    cocoa_log = os.path.abspath(args.cocoa_log)
+    with tempfile.TemporaryDirectory() as cwd:
+        import_only = [run_child(['-c', f'import sys; sys.path.insert(0, {os.path.dirname(COCOA_SCRIPT)!r}); '
+                                  'import cocoa'], cwd) for i in range(args.repeat)]
+        runs = [run_child([COCOA_SCRIPT, '-l', cocoa_log, '--no_gui', os.devnull], cwd)
+                for i in range(args.repeat)]
+    cold, importtime = min(import_only)
+    imports, heavy = import_profile(importtime)
+    total, importtime = min(runs[1:] or runs)
+    run_imports, run_heavy = import_profile(importtime)
+    print(f'log: {args.cocoa_log} python: {sys.version.split()[0]} repeat: {args.repeat}')
+    print(f'cold start (import cocoa): {cold * 1000:9.2f} ms  imports {imports * 1000:9.2f} ms')
+    print(f'first --no_gui run:        {runs[0][0] * 1000:9.2f} ms')
+    print(f'--no_gui total:            {total * 1000:9.2f} ms  imports {run_imports * 1000:9.2f} ms')
+    print(f"gui/plot modules imported: {', '.join(sorted(set(heavy) | set(run_heavy))) or 'none'}")
+    return
+
+
+def main(args):
+    """Benchmark Main
+
+    Args:
+        args (Namespace): コマンドライン引数
+
+    Returns:
+        None
+
+    """
+    logger = logging.getLogger(__name__)
+    if args.benchmark == 'validate':
+        benchmark_validate(logger, args)
+    elif args.benchmark == 'startup':
+        benchmark_startup(logger, args)
+    return
+
+
+if __name__ == '__main__':
+    parser = setup_args()
+    main(parser.parse_args())
@@ -4,15 +4,20 @@
 
 """
 import cocoaConfig as cc
+import cocoaMemory as cmem
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import numpy as np
 from pprint import pformat, pprint
 from datetime import date, datetime, timedelta
+from functools import partial
 import warnings
 import traceback
 import sys  # process関係
 from os import TMP_MAX
 import json
+import re
 __author__ = "hyuasa"
 __version__ = "0.0.1"
 __date__ = "Aug 16 2022"
@@ -34,6 +39,20 @@ L_WIDTH = 0.4      # Scale Line Width
 L_STYLE = 'dashed'  # Scale Line Style
 F_MIN = 4          # X axis Font size
 F_NORMAL = 10      # Normal Font size
+HEATMAP_CMAP = 'Blues'  # Heatmap colormap
+Y_MARGIN = 1.05    # 埋め込みグラフのy軸上限 (最大値に対する比)
+MAX_X_LABELS = 31  # 埋め込みグラフのx軸ラベル数の上限 (多い場合は間引く)
+
+# COCOAチャートの4つの棒グラフ
+# (axesの位置, merge_dfのカラム, タイトル, y軸ラベル, 棒の色, タイトルの色, 移動合計の元カラム)
+COCOA_PANELS = [((0, 0), ('count', 'contact_event', 'contact'), 'COCOA 接触回数', ' 回数',
+                 COLOR_WASURENAGUSA, COLOR_RURIKON, None),
+                ((0, 1), ('exposure_minutes', 'duration', '接触時間計(分)'), 'COCOA 接触時間(分)', '分',
+                 COLOR_WASURENAGUSA, COLOR_RURIKON, 'duration'),
+                ((1, 0), ('sum', 'cocoa_score', 'cocoa_score'), 'COCOA スコア', 'ポイント',
+                 COLOR_KANZOUIRO, COLOR_KUROKAWACHA, 'cocoa_score'),
+                ((1, 1), ('calc_score_sum', 'score', '算出スコア計'), 'COCOA 算出スコア', 'Calc Score',
+                 COLOR_KANZOUIRO, COLOR_KUROKAWACHA, 'score')]
 
 
 def setup_bar_chart(axes, x_data, y_data, title='チャートタイトル',  y_label='', bar_color=COLOR_DEFAULT, title_color=COLOR_DEFAULT):
@@ -64,12 +83,54 @@ def setup_bar_chart(axes, x_data, y_data, title='チャートタイトル',  y_l
     return
 
 
-def draw_cocoa_charts(logger, df):
+def setup_line_overlay(axes, x_data, y_data, label='', line_color=COLOR_DEFAULT):
+    """draw line on secondary y axis
+
+    Args:
+        axes (AxesSubplot) : プロットエリア
+        x_data (list) : x軸データ
+        y_data (list) : y軸データ
+        label (str) : 第2y軸ラベル
+        line_color (matplotlib color str) : 線の色
+
+    Retuens:
+        None
+
+    """
+    twin = axes.twinx()
+    twin.plot(x_data, y_data, color=line_color, linewidth=1.0)
+    twin.set_ylabel(label, fontsize=F_MIN * 2, fontname=cc.FONT_FAMILY, color=line_color)
+    twin.tick_params(axis='y', labelsize=F_MIN * 2, colors=line_color)
+    return
+
+
+def rolling_series(df, level1, window):
+    """merge_dfから期間移動合計のカラムを探して値のリストを返す
+
+    Args:
+        df (DataFrame): merge_df
+        level1 (str): 元になるカラムの2段目の名前 cocoa_score/score/duration
+        window (int): 移動合計の日数
+
+    Returns:
+        (str) : 表示名 無い場合はNone
+        (list) : 値のリスト 無い場合はNone
+
+    """
+    for col in df.columns:
+        if col[0] == 'rolling_sum' and col[1] == level1 and re.search(rf'(?<!\d){window}日', col[2]):
+            return col[2], list(df[col].to_dict().values())
+    return None, None
+
+
+@cmem.profiled('draw_cocoa_charts')
+def draw_cocoa_charts(logger, df, filename=None):
     """draw chats
 
     Args:
         logger (logging): ロガー
         df (DataFrame): グラフを書くDataの入ったDataFrame
+        filename (str): 指定された場合はウィンドウを開かずに画像ファイルに保存する
 
     Returns:
         None
@@ -77,48 +138,242 @@ def draw_cocoa_charts(logger, df):
     """
     warnings.simplefilter('ignore', UserWarning)
 
-    # data for x axis and contact event count for y axis
-    contacts_dict = (df[('count', 'contact_event', 'contact')].to_dict())
-    x_axis = []
-    days = list(contacts_dict.keys())
-    for day in days:
-        x_axis.append(day[0])
-    a1_y_axis = list(contacts_dict.values())
-    # data exposure duraion for y axis
-    duration_dict = (
-        df[('exposure_minutes', 'duration', '接触時間計(分)')].to_dict())
-    a2_y_axis = list(duration_dict.values())
-    # data cocoa score for y axis
-    cocoa_score_dict = (df[('sum', 'cocoa_score', 'cocoa_score')].to_dict())
-    a3_y_axis = list(cocoa_score_dict.values())
-    # data calculated score for y axis
-    calclate_score_dict = (df[('calc_score_sum', 'score', '算出スコア計')].to_dict())
-    a4_y_axis = list(calclate_score_dict.values())
+    # data for x axis (日付)
+    x_axis = [index[0] for index in df.index]
 
     # create Figure and axes.
     fig, axes = plt.subplots(2, 2, figsize=(10.0, 6.0))   # 2行2列 1000x600ピクセル
     fig.suptitle('COCOA接触履歴 - スコア1350ポイント以上で濃厚接触アラート', fontname=cc.FONT_FAMILY)
-    fig.canvas.set_window_title('COCOA Exposure History')
-
-    # axes[0,0] cocoa contact event counts
-    setup_bar_chart(axes[0, 0], x_axis, a1_y_axis,
-                    bar_color=COLOR_WASURENAGUSA, title_color=COLOR_RURIKON,
-                    title='COCOA 接触回数', y_label=' 回数')
-    # axes[0,1] cocoa exposure duration
-    setup_bar_chart(axes[0, 1], x_axis, a2_y_axis,
-                    bar_color=COLOR_WASURENAGUSA, title_color=COLOR_RURIKON,
-                    title='COCOA 接触時間(分)', y_label='分')
-    # axes[1,0] cocoa score
-    setup_bar_chart(axes[1, 0], x_axis, a3_y_axis,
-                    bar_color=COLOR_KANZOUIRO, title_color=COLOR_KUROKAWACHA,
-                    title='COCOA スコア', y_label='ポイント')
-    # axes[1,0] calculated score
-    setup_bar_chart(axes[1, 1], x_axis, a4_y_axis,
-                    bar_color=COLOR_KANZOUIRO, title_color=COLOR_KUROKAWACHA,
-                    title='COCOA 算出スコア', y_label='Calc Score')
+    fig.canvas.manager.set_window_title('COCOA Exposure History')
+
+    # 接触回数, 接触時間(分), COCOAスコア, 算出スコア
+    for pos, col, title, y_label, bar_color, title_color, level1 in COCOA_PANELS:
+        setup_bar_chart(axes[pos], x_axis, list(df[col].to_dict().values()),
+                        bar_color=bar_color, title_color=title_color,
+                        title=title, y_label=y_label)
+
+    # rolling sums as line on secondary y axis
+    if len(cc.ROLLING_WINDOWS) > 0:
+        window = cc.ROLLING_WINDOWS[0]
+        for pos, col, title, y_label, bar_color, title_color, level1 in COCOA_PANELS:
+            if level1 is None:
+                continue
+            label, y_axis = rolling_series(df, level1, window)
+            if label is not None:
+                setup_line_overlay(axes[pos], x_axis, y_axis, label=label,
+                                   line_color=COLOR_RURIKON)
 
     # axes[1,1].axis('off')
     #pd.plotting.table(axes[0,0], df)
+    if filename is not None:
+        fig.savefig(filename)
+        plt.close(fig)
+    else:
+        plt.show()
+
+    return
+
+
+def setup_heatmap(fig, axes, df, title='チャートタイトル', x_label='', y_label='', cmap=HEATMAP_CMAP, title_color=COLOR_DEFAULT):
+    """draw heatmap
+
+    Args:
+        fig (Figure) : Figure
+        axes (AxesSubplot) : プロットエリア
+        df (DataFrame) : 行 x 列 の集計値
+        title (str) : チャートタイトル
+        x_label (str) : x軸ラベル
+        y_label (str) : y軸ラベル
+        cmap (str) : matplotlib colormap名
+        title_color (matplotlib color str) : タイトル文字の色
+
+    Retuens:
+        None
+
+    """
+    image = axes.imshow(df.values, aspect='auto', cmap=cmap)
+    axes.set_title(title, fontname=cc.FONT_FAMILY, color=title_color)
+    axes.set_xticks(range(len(df.columns)))
+    axes.set_xticklabels(df.columns, fontsize=F_MIN * 2, fontname=cc.FONT_FAMILY)
+    axes.set_yticks(range(len(df.index)))
+    axes.set_yticklabels(df.index, fontsize=F_MIN * 2)
+    axes.set_xlabel(x_label, fontsize=F_NORMAL, fontname=cc.FONT_FAMILY)
+    axes.set_ylabel(y_label, fontsize=F_NORMAL, fontname=cc.FONT_FAMILY)
+    fig.colorbar(image, ax=axes, label='分')
+    return
+
+
+@cmem.profiled('draw_heatmap_charts')
+def draw_heatmap_charts(logger, hour_distance_df, weekday_hour_df):
+    """draw heatmaps
+
+    Args:
+        logger (logging): ロガー
+        hour_distance_df (DataFrame): 時刻 x 距離 の接触時間(分)
+        weekday_hour_df (DataFrame): 曜日 x 時刻 の接触時間(分)
+
+    Returns:
+        None
+
+    """
+    warnings.simplefilter('ignore', UserWarning)
+
+    fig, axes = plt.subplots(1, 2, figsize=(12.0, 6.0),
+                             gridspec_kw={'width_ratios': [1, 3]})
+    fig.suptitle('COCOA接触時間帯 - 接触時間(分)', fontname=cc.FONT_FAMILY)
+    fig.canvas.manager.set_window_title('COCOA Exposure Heatmap')
+
+    setup_heatmap(fig, axes[0], hour_distance_df,
+                  title='時刻 x 距離', x_label='距離', y_label='時',
+                  title_color=COLOR_RURIKON)
+    setup_heatmap(fig, axes[1], weekday_hour_df,
+                  title='曜日 x 時刻', x_label='時', y_label='曜日',
+                  title_color=COLOR_RURIKON)
     plt.show()
 
     return
+
+
+def create_embedded_chart():
+    """GUIに埋め込むCOCOAチャート (pyplotのウィンドウを使わないFigure)
+
+    棒と移動合計の線はanimatedにして、描画時に背景とは別に描く (blit用)
+    canvasはGUIで FigureCanvasTkAgg を作成して設定する
+
+    Args:
+        None
+
+    Returns:
+        dict : figure, axes, bars(棒のRectangleのリスト), lines(移動合計の線), x(x軸の日付), background
+
+    """
+    fig = Figure(figsize=(10.0, 6.0))
+    axes = fig.subplots(2, 2)
+    fig.suptitle('COCOA接触履歴 - スコア1350ポイント以上で濃厚接触アラート', fontname=cc.FONT_FAMILY)
+    chart = {'figure': fig, 'axes': axes, 'bars': {}, 'lines': {}, 'x': None, 'background': None}
+    for pos, col, title, y_label, bar_color, title_color, level1 in COCOA_PANELS:
+        ax = axes[pos]
+        ax.set_title(title, fontname=cc.FONT_FAMILY, y=TPY, x=TPX, color=title_color)
+        ax.set_ylabel(y_label, fontsize=F_NORMAL, fontname=cc.FONT_FAMILY)
+        ax.grid(which="major", axis="y", color=COLOR_WASURENAGUSA, alpha=L_ALPHA,
+                linestyle=L_STYLE, linewidth=L_WIDTH)
+        if level1 is not None:
+            twin = ax.twinx()
+            twin.tick_params(axis='y', labelsize=F_MIN * 2, colors=COLOR_RURIKON)
+            line, = twin.plot([], [], color=COLOR_RURIKON, linewidth=1.0, animated=True)
+            chart['lines'][pos] = line
+    return chart
+
+
+def attach_chart_canvas(chart, canvas):
+    """埋め込みグラフにcanvasを設定し、描画毎に背景を保存して棒と線を描くようにする
+
+    Args:
+        chart (dict): create_embedded_chartで作成したグラフ
+        canvas (FigureCanvasAgg): FigureCanvasTkAgg等 copy_from_bboxができるcanvas
+
+    Returns:
+        None
+
+    """
+    chart['background'] = None
+    canvas.mpl_connect('draw_event', partial(on_chart_draw, chart))
+    return
+
+
+def on_chart_draw(chart, event):
+    """draw_event: animatedでない部分(軸, 目盛, タイトル)を背景として保存して棒と線を描く"""
+    canvas = chart['figure'].canvas
+    chart['background'] = canvas.copy_from_bbox(chart['figure'].bbox)
+    draw_animated(chart)
+    return
+
+
+def draw_animated(chart):
+    """棒と移動合計の線を描く"""
+    fig = chart['figure']
+    for bars in chart['bars'].values():
+        for rect in bars:
+            fig.draw_artist(rect)
+    for line in chart['lines'].values():
+        fig.draw_artist(line)
+    return
+
+
+def panel_top(values):
+    """埋め込みグラフのy軸上限"""
+    top = float(np.max(values)) if len(values) > 0 else 0.0
+    return top * Y_MARGIN if top > 0 else 1.0
+
+
+@cmem.profiled('update_embedded_chart')
+def update_embedded_chart(logger, chart, df):
+    """埋め込みグラフをdfの値に更新する
+
+    棒のartistは再利用して高さだけを変更する (日数が増えた場合だけ足りない棒を作る)
+    x軸(日付)が変わった場合は目盛を更新する (ラベルはMAX_X_LABELSまでに間引く)
+    y軸の上限も変わらなければ背景を再描画せずにblitする
+
+    Args:
+        logger (logging): ロガー
+        chart (dict): create_embedded_chartで作成したグラフ (canvas設定済み)
+        df (DataFrame): merge_df または cocoa.build_daily_totals
+
+    Returns:
+        bool : blitで更新した場合True 全体を再描画した場合False
+
+    """
+    x_axis = [index[0] for index in df.index]
+    positions = np.arange(len(x_axis))
+    same_x = chart['x'] == x_axis
+    redraw = not same_x or chart['background'] is None
+    window = cc.ROLLING_WINDOWS[0] if len(cc.ROLLING_WINDOWS) > 0 else None
+    for pos, col, title, y_label, bar_color, title_color, level1 in COCOA_PANELS:
+        ax = chart['axes'][pos]
+        values = df[col].to_numpy(dtype=np.float64)
+        # 棒はx軸の位置(日数)毎に作成済みのものを使い、足りない分だけ作る 余った棒は隠す
+        bars = chart['bars'].setdefault(pos, [])
+        if len(bars) < len(values):
+            bars.extend(ax.bar(positions[len(bars):], values[len(bars):], color=bar_color, animated=True))
+        for i, rect in enumerate(bars):
+            if i < len(values):
+                rect.set_height(values[i])
+            rect.set_visible(i < len(values))
+        if not same_x:
+            # 目盛の作成と描画が再描画の大半を占めるので、ラベルは間引く
+            stride = -(-len(x_axis) // MAX_X_LABELS) or 1
+            ax.set_xticks(positions[::stride])
+            ax.set_xticklabels(x_axis[::stride], fontsize=F_MIN, rotation=R_ANGLE, ha='right')
+            ax.set_xlim(-0.5, len(x_axis) - 0.5)
+        top = panel_top(values)
+        if ax.get_ylim() != (0.0, top):
+            ax.set_ylim(0.0, top)
+            redraw = True
+
+        line = chart['lines'].get(pos)
+        if line is None:
+            continue
+        label, y_axis = rolling_series(df, level1, window) if window is not None else (None, None)
+        line.set_visible(label is not None)
+        if label is None:
+            continue
+        line.set_data(positions, y_axis)
+        twin = line.axes
+        if twin.get_ylabel() != label:
+            twin.set_ylabel(label, fontsize=F_MIN * 2, fontname=cc.FONT_FAMILY, color=COLOR_RURIKON)
+            redraw = True
+        top = panel_top(y_axis)
+        if twin.get_ylim() != (0.0, top):
+            twin.set_ylim(0.0, top)
+            redraw = True
+    chart['x'] = x_axis
+
+    canvas = chart['figure'].canvas
+    if redraw:
+        canvas.draw()
+    else:
+        canvas.restore_region(chart['background'])
+        draw_animated(chart)
+        canvas.blit(chart['figure'].bbox)
+    return not redraw
+
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Compare
+
+    同じ端末の2つのcocoa log(前回と今回のエクスポート)の差分を求める
+
+    - exposure window: cocoaPlatform.window_fingerprint のsetの差で追加/削除を求める
+    - 日毎の集計: merge_df の (date, dow) をキーに外部結合し、追加/削除/値の変更を求める
+        追加: 今回だけに有る日  削除: 保存期間を過ぎて今回は無い日
+        変更: COMPARE_COLUMNS の値か、その日のwindowが変わった日
+
+    どちらもハッシュによる結合なので、ログの大きさに対して線形時間
+
+    結果は表(標準出力)と COCOA_LOG_CHECKER_YYYY-MM-DD-HHMM_compare.xlsx (今回の接触履歴と差分シート) に出力する
+
+"""
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import cocoa
+import cocoaConfig as cc
+import cocoaExcel as cex
+import cocoaPlatform as cp
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+# 比較する日毎の値: (merge_dfのカラム, 差分のカラム名)
+COMPARE_COLUMNS = [(('sum', 'cocoa_score', 'cocoa_score'), 'COCOAスコア'),
+                   (('calc_score_sum', 'score', '算出スコア計'), '算出スコア計'),
+                   (('exposure_minutes', 'duration', '接触時間計(分)'), '接触時間計(分)'),
+                   (('count', 'contact_event', 'contact'), '接触回数')]
+COMPARE_TOLERANCE = 1e-6  # これ以下の差は変更としない
+STATUS_ADDED = '追加'
+STATUS_REMOVED = '削除'
+STATUS_CHANGED = '変更'
+
+
+def window_fingerprints(exposure):
+    """exposure windowのfingerprintのset
+
+    Args:
+        exposure (dict): cocoa log
+
+    Returns:
+        set : cocoaPlatform.window_fingerprint (DateMillisSinceEpoch, (db, mindb, duration)のタプル)
+
+    """
+    adapter = cp.select_adapter(exposure)
+    fingerprint = partial(cp.window_fingerprint, adapter)
+    return {fingerprint(ew) for ew in cp.windows(adapter, exposure)}
+
+
+def diff_windows(old_fingerprints, new_fingerprints):
+    """追加/削除されたexposure window
+
+    Args:
+        old_fingerprints (set): 前回のログの window_fingerprints
+        new_fingerprints (set): 今回のログの window_fingerprints
+
+    Returns:
+        DataFrame : 状態, date, dow, time, scan_instances, 接触時間(分) 日時順
+
+    """
+    changes = [(STATUS_ADDED, fp) for fp in new_fingerprints - old_fingerprints]
+    changes += [(STATUS_REMOVED, fp) for fp in old_fingerprints - new_fingerprints]
+    changes.sort(key=lambda change: (change[1][0], change[0]))
+    millis = np.array([fp[0] for status, fp in changes], dtype=np.int64)
+    t = pd.to_datetime(millis, unit='ms', utc=True).tz_convert(cc.TZ)
+    return pd.DataFrame({'状態': [status for status, fp in changes],
+                         'date': t.strftime('%Y-%m-%d'), 'dow': t.strftime('%a'), 'time': t.strftime('%H:%M'),
+                         'scan_instances': [len(fp[1]) for status, fp in changes],
+                         '接触時間(分)': [sum(si[2] for si in fp[1]) / 60 for status, fp in changes]})
+
+
+def diff_days(old_df, new_df, window_df):
+    """日毎の集計の差分
+
+    Args:
+        old_df (DataFrame): 前回のログのmerge_df
+        new_df (DataFrame): 今回のログのmerge_df
+        window_df (DataFrame): diff_windows
+
+    Returns:
+        DataFrame : (date, dow)をindexに 状態, COMPARE_COLUMNS毎の(前回), (今回), (差), 追加window, 削除window
+                    変わらない日は含まない
+
+    """
+    cols = [col for col, label in COMPARE_COLUMNS]
+    labels = [label for col, label in COMPARE_COLUMNS]
+    old = old_df[cols].set_axis(labels, axis=1)
+    new = new_df[cols].set_axis(labels, axis=1)
+    joined = pd.merge(old, new, how='outer', left_index=True, right_index=True,
+                      suffixes=('(前回)', '(今回)'), indicator=True)
+    windows = window_df.groupby(['date', 'dow', '状態']).size().unstack(fill_value=0)
+    windows = windows.reindex(index=joined.index, columns=[STATUS_ADDED, STATUS_REMOVED], fill_value=0)
+
+    diff = pd.DataFrame(index=joined.index)
+    diff['状態'] = ''
+    changed = (windows.to_numpy() > 0).any(axis=1)
+    for label in labels:
+        before = joined[f'{label}(前回)']
+        after = joined[f'{label}(今回)']
+        diff[f'{label}(前回)'] = before
+        diff[f'{label}(今回)'] = after
+        diff[f'{label}(差)'] = after.fillna(0) - before.fillna(0)
+        changed |= (diff[f'{label}(差)'].abs() > COMPARE_TOLERANCE).to_numpy()
+    diff['追加window'] = windows[STATUS_ADDED]
+    diff['削除window'] = windows[STATUS_REMOVED]
+    indicator = joined['_merge'].to_numpy()
+    diff['状態'] = np.select([indicator == 'right_only', indicator == 'left_only', changed],
+                             [STATUS_ADDED, STATUS_REMOVED, STATUS_CHANGED], '')
+    return diff[diff['状態'] != ''].sort_index()
+
+
+def compare_summary(old_log, new_log, day_df, window_df):
+    """差分の件数
+
+    Args:
+        old_log (str): 前回のcocoa log
+        new_log (str): 今回のcocoa log
+        day_df (DataFrame): diff_days
+        window_df (DataFrame): diff_windows
+
+    Returns:
+        list of str : ログ情報と同じ形式の行
+
+    """
+    lines = [f'old: {old_log}', f'new: {new_log}']
+    for status in (STATUS_ADDED, STATUS_REMOVED):
+        lines.append(f"# of {status} exposure_windows: {(window_df['状態'] == status).sum()}")
+    for status in (STATUS_ADDED, STATUS_REMOVED, STATUS_CHANGED):
+        lines.append(f"# of {status} days: {(day_df['状態'] == status).sum()}")
+    return lines
+
+
+def read_merge_df(logger, filename):
+    """ログを読んで merge_df を作る
+
+    Args:
+        logger (logging): ロガー
+        filename (str): cocoa log ファイル名
+
+    Returns:
+        dict : exposure
+        DataFrame : merge_df 正しいログでない場合はNone
+
+    """
+    exposure = cocoa.read_cocoa_log(logger, filename)
+    return exposure, cocoa.verify_and_build_dataframe(logger, exposure)
+
+
+def run_compare(logger, old_log, new_log):
+    """2つのログの差分を表示してExcelに保存する
+
+    Args:
+        logger (logging): ロガー
+        old_log (str): 前回のcocoa log
+        new_log (str): 今回のcocoa log
+
+    Returns:
+        (str): 作成したExcelファイル名 正しいログでない場合はNone
+
+    """
+    old_exposure, old_df = read_merge_df(logger, old_log)
+    new_exposure, new_df = read_merge_df(logger, new_log)
+    for filename, df in ((old_log, old_df), (new_log, new_df)):
+        if df is None:
+            logger.info(f'正しいCOCOAログではありません: {filename}')
+            return None
+    window_df = diff_windows(window_fingerprints(old_exposure), window_fingerprints(new_exposure))
+    day_df = diff_days(old_df, new_df, window_df)
+    summary = compare_summary(old_log, new_log, day_df, window_df)
+    for line in summary:
+        logger.info(f'compare: {line}')
+    with pd.option_context('display.float_format', '{:,.1f}'.format, 'display.width', 200,
+                           'display.max_rows', None, 'display.max_columns', None,
+                           'display.unicode.east_asian_width', True):
+        print('\n'.join(summary))
+        print(day_df.to_string() if len(day_df) > 0 else '差分はありません')
+    bookname = cex.create_cocoa_excel(logger, new_df, basename=f'{cc.report_basename()}_compare',
+                                      extra_sheets={cc.COCOA_DIFF_SHEET_NAME: (day_df, True),
+                                                    cc.COCOA_DIFF_WINDOW_SHEET_NAME: (window_df, False)})
+    logger.info(f'Excelファイルが作成されました: {bookname}')
+    return bookname
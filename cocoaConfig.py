@@ -7,6 +7,9 @@ from datetime import date, datetime, timedelta
 import platform
 import os
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from ast import Store
 import argparse
 __author__ = "hyuasa"
@@ -16,11 +19,41 @@ __date__ = "Aug 16 2022"
 
 global COCOA_LOG
 DEBUGFILE = os.getenv('DEBUGFILE', default='cocoa_log.txt')
+LOG_MAX_BYTES = 5 * 1024 * 1024  # DEBUGFILEをローテーションするサイズ
+LOG_BACKUP_COUNT = 3  # ローテーションで残す世代 cocoa_log.txt.1 ~ .3
+LOG_LEVELS = {}  # モジュール毎のログレベル ex: {'cocoaExcel': logging.WARNING} see module_level_filter
+LOG_LISTENER = None  # create_loggerで開始したQueueListener
 COCOA_LOG = os.getenv('COCOA_LOG', default='exposure_data.json')
+COCOA_LOGS = []  # 結合して集計する複数のcocoa log
+COCOA_DEVICE_DFS = {}  # 結合時の端末(ファイル)毎のmerge_df
 COCOA_LOG_INFORMATION = []
+COCOA_SCAN_INSTANCES = {}  # スキャンインスタンスの列形式配列 cocoa.build_scan_instance_columns
+COCOA_DAILY_SUMMARIES = {}  # daily summaryの列形式配列 cocoaPlatform.daily_summary_columns
 NEED_VALID_COCOA_LOG = False
 COCOA_SCORE_THRESHOLD = 1350
+ROLLING_WINDOWS = [14]  # 期間移動合計の日数
+RESOLUTION = 'auto'  # 表/グラフ/Excelの集計単位 auto/day/week/month see cocoa.select_resolution
+RESOLUTION_MAX_POINTS = 92  # autoで選ぶ単位の期間内の行数の上限 (日毎は約3ヶ月まで)
+VALIDATION_MAX_ERRORS = 20  # 記録する不正レコードのエラー数 see cocoaValidate
+VALIDATION_FAIL_FAST = False  # 不正なレコードが有ればログ全体を不正とする (Falseは除いて集計)
 COCOA_EXPOSURE_SHEET_NAME = '接触履歴'
+COCOA_DAILY_SHEET_NAME = '接触履歴(日)'  # 接触履歴シートが週毎/月毎の場合の日毎の表
+COCOA_HOUR_DISTANCE_SHEET_NAME = '時刻別距離'
+COCOA_WEEKDAY_HOUR_SHEET_NAME = '曜日別時刻'
+COCOA_DETAIL_SHEET_NAME = '詳細'
+COCOA_DIFF_SHEET_NAME = '差分(日)'  # see cocoaCompare
+COCOA_DIFF_WINDOW_SHEET_NAME = '差分(window)'
+EXCEL_DETAIL = False  # スキャンインスタンス毎の詳細Bookも出力する
+EXPORT_FORMATS = []  # 起動時に出力する形式 csv/parquet/jsonl see cocoaExport
+BATCH_LOGS = []  # 1ログ1ブックで並列にExcelを作成するcocoa log see cocoaBatch
+BATCH_JOBS = None  # 並列プロセス数 Noneはcpu数
+WATCH_DIR = None  # 新しいcocoa logを自動で分析するフォルダ see cocoaWatch
+TEXT_REPORT = None  # GUIを開かずにテキストで出力する ('-'は標準出力) see cocoaText
+CHART_FILE = None  # GUIを開かずにグラフを保存する画像ファイル
+PROFILE_MEMORY = False  # 処理段階毎のメモリ使用量を計測する see cocoaMemory
+RECONCILE = False  # バッチでdaily summaryと算出スコアを突き合わせる see cocoaReconcile
+COMPARE_LOGS = []  # 差分を求める (前回, 今回) のcocoa log see cocoaCompare
+STATS_FILE = None  # 日毎の値の分布の統計ファイル バッチ/フォルダ監視で更新しGUIで参照する see cocoaStats
 SG_THEME = 'LightBlue2'
 SG_ALT_ROW_COLOR = '#eaf4fc'
 SG_HEADER_TEXT_COLOR = '#19448e'
@@ -53,6 +86,43 @@ def setup_args():
     parser = argparse.ArgumentParser(description='Cocoa Log Checker')
     parser.add_argument('-l', '--cocoa_log', metavar='COCOA_LOGFILE', required=False,
                         help='cocoa log file name')
+    parser.add_argument('-m', '--merge_logs', metavar='COCOA_LOGFILE', nargs='+', required=False,
+                        help='merge several cocoa log files, removing duplicated exposure windows')
+    parser.add_argument('-d', '--excel_detail', action='store_true',
+                        help='also export every scan instance to a detail excel book')
+    parser.add_argument('-e', '--export', metavar='FORMAT', nargs='+', required=False,
+                        choices=['csv', 'parquet', 'jsonl'],
+                        help='export tables as csv, parquet and/or jsonl files')
+    parser.add_argument('-b', '--batch', metavar='COCOA_LOGFILE', nargs='+', required=False,
+                        help='create one excel book per cocoa log in parallel, without gui')
+    parser.add_argument('-w', '--watch', metavar='DIRECTORY', required=False,
+                        help='watch a folder and create excel books for new cocoa logs, without gui')
+    parser.add_argument('-c', '--chart', metavar='IMAGEFILE', required=False,
+                        help='save cocoa charts to an image file (png, svg, pdf), without gui')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, required=False,
+                        help='number of worker processes for --batch/--watch (default: cpu count)')
+    parser.add_argument('--fail_fast', action='store_true',
+                        help='reject the whole log on the first invalid record (default: skip invalid records)')
+    parser.add_argument('--max_errors', metavar='N', type=int, required=False,
+                        help='number of invalid records reported with their json path (default: 20)')
+    parser.add_argument('-r', '--rolling_windows', metavar='DAYS', type=int, nargs='+', required=False,
+                        help='rolling sum windows in days (default: 14)')
+    parser.add_argument('--resolution', choices=['auto', 'day', 'week', 'month'], required=False,
+                        help='rows per day, week or month in table, charts and excel (default: auto by date range)')
+    parser.add_argument('--log_levels', metavar='MODULE=LEVEL', nargs='+', required=False,
+                        help='log level per module, ex: cocoaExcel=WARNING cocoaPipeline=DEBUG')
+    parser.add_argument('--profile_memory', '--profile-memory', action='store_true',
+                        help='report peak/retained memory and top allocation sites per stage (tracemalloc)')
+    parser.add_argument('--stats', metavar='STATSFILE', required=False,
+                        help='score distribution statistics, updated by --batch/--watch, shown as percentiles in gui')
+    parser.add_argument('--compare', metavar=('OLD_LOGFILE', 'NEW_LOGFILE'), nargs=2, required=False,
+                        help='compare two exports of the same device and save the differences, without gui')
+    parser.add_argument('--no_gui', '--no-gui', metavar='TEXTFILE', nargs='?', const='-', required=False,
+                        help='print the table, log information and score alerts to the terminal '
+                             '(or TEXTFILE), without gui')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='with --batch, compare daily cocoa scores with calculated scores and '
+                             'report anomalous days and devices')
     return parser
 
 
@@ -66,16 +136,118 @@ def parse_args(parser):
         None
 
     """
-    global COCOA_LOG, DRAW_GRAPH
+    global COCOA_LOG, COCOA_LOGS, DRAW_GRAPH, EXCEL_DETAIL, EXPORT_FORMATS, ROLLING_WINDOWS
+    global BATCH_LOGS, BATCH_JOBS, WATCH_DIR, CHART_FILE, TEXT_REPORT
+    global VALIDATION_MAX_ERRORS, VALIDATION_FAIL_FAST, RESOLUTION, LOG_LEVELS, PROFILE_MEMORY
+    global STATS_FILE, COMPARE_LOGS, RECONCILE
     args = parser.parse_args()
     if args.cocoa_log:
         COCOA_LOG = args.cocoa_log
+    if args.merge_logs:
+        COCOA_LOGS = args.merge_logs
+        COCOA_LOG = args.merge_logs[0]
+    if args.excel_detail:
+        EXCEL_DETAIL = True
+    if args.export:
+        EXPORT_FORMATS = args.export
+    if args.batch:
+        BATCH_LOGS = args.batch
+    if args.watch:
+        WATCH_DIR = args.watch
+    if args.chart:
+        CHART_FILE = args.chart
+    if args.no_gui:
+        TEXT_REPORT = args.no_gui
+    if args.jobs:
+        BATCH_JOBS = args.jobs
+    if args.rolling_windows:
+        for days in args.rolling_windows:
+            if days < 1:
+                parser.error(f'argument -r/--rolling_windows: must be 1 or more days: {days}')
+        ROLLING_WINDOWS = args.rolling_windows
+    if args.resolution:
+        RESOLUTION = args.resolution
+    if args.fail_fast:
+        VALIDATION_FAIL_FAST = True
+    if args.max_errors is not None:
+        VALIDATION_MAX_ERRORS = args.max_errors
+    if args.profile_memory:
+        PROFILE_MEMORY = True
+    if args.stats:
+        STATS_FILE = args.stats
+    if args.compare:
+        COMPARE_LOGS = args.compare
+    if args.reconcile:
+        RECONCILE = True
+    if args.log_levels:
+        for item in args.log_levels:
+            module, _, level = item.partition('=')
+            levelno = logging.getLevelName(level.upper())
+            if not module or not isinstance(levelno, int):
+                parser.error(f'argument --log_levels: invalid MODULE=LEVEL: {item}')
+            LOG_LEVELS[module] = levelno
     return
 
 
+def report_basename():
+    """出力ファイル名の先頭部分
+
+    Args:
+        None
+
+    Returns:
+        (str): COCOA_LOG_CHECKER_YYYY-MM-DD-HHMM
+
+    """
+    return 'COCOA_LOG_CHECKER_' + datetime.now(JST).strftime('%Y-%m-%d-%H%M')
+
+
+def unique_filename(basename, ext):
+    """他のプロセスと衝突しない出力ファイル名を確保する
+
+    ファイルを排他的に作成して名前を予約する 既に有る場合は -2, -3... を付ける
+
+    Args:
+        basename (str): ファイル名の先頭部分 ex: report_basename()
+        ext (str): 拡張子 ex: '.xlsx'
+
+    Returns:
+        (str): 予約した(空ファイルを作成した)ファイル名
+
+    """
+    n = 1
+    while True:
+        filename = basename + ext if n == 1 else f'{basename}-{n}{ext}'
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            n += 1
+
+
+def module_level_filter(record):
+    """LOG_LEVELSでモジュール毎に指定したレベル未満のレコードを捨てる (QueueHandlerのフィルタ)
+
+    ロガーは各モジュールに引数で渡す1つなので、レコードのモジュール名(ファイル名)で判定する
+
+    Args:
+        record (LogRecord): ログレコード
+
+    Returns:
+        bool : 出力する場合True
+
+    """
+    level = LOG_LEVELS.get(record.module)
+    return level is None or record.levelno >= level
+
+
 def create_logger():
     """ロギングオブジェクトを作成して返す
 
+    ロガーにはQueueHandlerだけを付け、ファイル(DEBUGFILE)とコンソールへの出力は
+    QueueListenerのスレッドで行う ファイルはLOG_MAX_BYTESでローテーションする
+    2回目以降の呼び出しは同じロガーを返す (ハンドラを重複させない)
+
     Args:
         None
 
@@ -83,26 +255,57 @@ def create_logger():
         (logger): logger
 
     """
+    global LOG_LISTENER
+
     # create logger
     logger = logging.getLogger(__name__)
+    if LOG_LISTENER is not None:
+        return logger
     logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '%(asctime)s :%(levelname)s: [%(filename)s: %(funcName)s] %(message)s', '%Y-%m-%d %H:%M:%S')
 
     # create file handler which logs DEBUG level messages
-    fh = logging.FileHandler(DEBUGFILE, 'w', 'utf-8')
+    fh = RotatingFileHandler(DEBUGFILE, 'a', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                             encoding='utf-8')
     fh.setLevel(logging.DEBUG)
-    fh_formatter = logging.Formatter(
-        '%(asctime)s :%(levelname)s: [%(filename)s: %(funcName)s] %(message)s', '%Y-%m-%d %H:%M:%S')
-    fh.setFormatter(fh_formatter)
+    fh.setFormatter(formatter)
 
     # create console handler with a INFO level
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
-    ch_formatter = logging.Formatter(
-        '%(asctime)s :%(levelname)s: [%(filename)s: %(funcName)s] %(message)s', '%Y-%m-%d %H:%M:%S')
-    ch.setFormatter(ch_formatter)
+    ch.setFormatter(formatter)
 
-    # add the handlers to the logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    # the logger only enqueues records, the listener thread writes them
+    log_queue = queue.SimpleQueue()
+    qh = QueueHandler(log_queue)
+    qh.addFilter(module_level_filter)
+    logger.addHandler(qh)
+    LOG_LISTENER = QueueListener(log_queue, fh, ch, respect_handler_level=True)
+    LOG_LISTENER.start()
+    atexit.register(stop_logger)
 
     return logger
+
+
+def stop_logger():
+    """QueueListenerを止めて、キューに残ったレコードを書き出してからハンドラを閉じる
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    """
+    global LOG_LISTENER
+    if LOG_LISTENER is None:
+        return
+    logger = logging.getLogger(__name__)
+    for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+        logger.removeHandler(handler)
+    LOG_LISTENER.stop()
+    for handler in LOG_LISTENER.handlers:
+        handler.close()
+    LOG_LISTENER = None
+    return
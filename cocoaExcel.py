@@ -8,12 +8,14 @@
 - Excel Bookを保管する
 
 """
+import io  # テンプレートBookのメモリ上での保管
 import json  # json
 import logging
 import os  # ファイルシステム系　path など
 import re  # 正規表現チェック
 import sys  # process関係
 import time  # sleep
+from copy import copy  # セルスタイルの複製
 from datetime import date, datetime, timedelta
 from datetime import timezone as dttz  # date time 関係
 from pprint import pformat, pprint  # format dump for List, Dictオブジェクト
@@ -22,13 +24,16 @@ import dateutil.parser  # date time 関係 python-dateutil
 import openpyxl
 import pandas as pd
 from openpyxl.comments import Comment
-from openpyxl.formatting.rule import Rule
+from openpyxl.formatting.rule import ColorScaleRule, Rule
 from openpyxl.styles import (Alignment, Border, Font, PatternFill, Protection,
                              Side)
 from openpyxl.styles.differential import DifferentialStyle
 from openpyxl.chart import Reference, BarChart, Series
+from openpyxl.cell import WriteOnlyCell
 
+import cocoa
 import cocoaConfig as cc
+import cocoaMemory as cmem
 
 __author__ = "hyuasa"
 __version__ = "0.0.1"
@@ -37,6 +42,14 @@ __date__ = "Aug 16 2022"
 # シート内最終グラフ位置
 CURRENT_GRAPH_POSITION = 0
 
+# 整形済みテンプレートBook (xlsx bytes) シート構成毎 see load_template
+TEMPLATE_CACHE = {}
+EXCEL_MAX_ROW = 1048576
+
+# スキャンインスタンス毎の詳細シート see create_detail_excel
+DETAIL_HEADINGS = ['date', 'db', 'mindb', 'duration', 'score', 'distance']
+DETAIL_CHUNK_ROWS = 65536
+
 # color constant see https://www.colordic.org/w
 COLOR_SHINBASHI = 'FFbce2e8'
 COLOR_KONPEKI = 'FF007bbb'
@@ -171,12 +184,13 @@ def add_comment_direct(logger, wb, sheetname, coordinate, comment):
     return wb
 
 
-def shape_exposure_sheet(logger, ws):
+def shape_exposure_sheet(logger, ws, format_maxrow=None):
     """接触履歴ワークシート整形関数
 
     Args:
         logger (logger): ロギングオブジェクト
         ws (Wroksheet): ワークシートオブジェクト
+        format_maxrow (int): 条件付き書式を適用する最終行 default: ws.max_row
 
     Return:
         None
@@ -201,23 +215,46 @@ def shape_exposure_sheet(logger, ws):
     dxf = DifferentialStyle(font=RED_FONT)
     rule = Rule(type='cellIs', operator='greaterThanOrEqual',
                 formula=[cc.COCOA_SCORE_THRESHOLD], dxf=dxf)
-    range_cocoa_score = ftitle(titles3, 'cocoa_score')['letter']+str(4)+':' + \
-        ftitle(titles3, 'cocoa_score')['letter']+str(maxrow)
-    ws.conditional_formatting.add(range_cocoa_score, rule)
-    range_calculate_score = ftitle(titles3, '算出スコア計')['letter']+str(4)+':' + \
-        ftitle(titles3, '算出スコア計')['letter']+str(maxrow)
-    ws.conditional_formatting.add(range_calculate_score, rule)
+    if format_maxrow is None:
+        format_maxrow = maxrow
+    for name in ('cocoa_score', '算出スコア計'):
+        letter = ftitle(titles3, name)['letter']
+        ws.conditional_formatting.add(letter+str(4)+':'+letter+str(format_maxrow), rule)
+        fill_cell_color(ws[letter+str(4)+':'+letter+str(maxrow)], COLOR_GEPPAKU)
 
     range_contact_duration = ftitle(titles3, '接触時間計(分)')['letter']+str(4)+':' + \
         ftitle(titles3, '接触時間計(分)')['letter']+str(maxrow)
-
-    fill_cell_color(ws[range_cocoa_score], COLOR_GEPPAKU)
-    fill_cell_color(ws[range_calculate_score], COLOR_GEPPAKU)
     fill_cell_color(ws[range_contact_duration], COLOR_GEPPAKU)
 
     return
 
 
+def shape_heatmap_sheet(logger, ws):
+    """時間帯ヒートマップのワークシート整形関数
+
+    Args:
+        logger (logger): ロギングオブジェクト
+        ws (Wroksheet): ワークシートオブジェクト
+
+    Return:
+        None
+    """
+    maxrow = ws.max_row
+    maxcolumn = ws.max_column
+    logger.info(f'maxcolumn: {maxcolumn} maxrow:{maxrow}')
+    ws.sheet_properties.tabColor = BAR_COLOR_MIZUIRO
+
+    # 接触時間(分)の色階調表示
+    rule = ColorScaleRule(start_type='min', start_color=COLOR_BLACK,
+                          end_type='max', end_color=COLOR_KONPEKI)
+    range_heatmap = 'B2:' + ws.cell(row=maxrow, column=maxcolumn).coordinate
+    ws.conditional_formatting.add(range_heatmap, rule)
+    for c in range(2, maxcolumn+1):
+        ws.column_dimensions[ws.cell(row=1, column=c).column_letter].width = 7
+
+    return
+
+
 def fill_cell_color(cell_range, color):
     """セル色設定
 
@@ -304,12 +341,13 @@ def save_to_excel_multi(logger, bookname=None, dfs=None, sheets=None, indexes=No
     return wb
 
 
-def shape_a_sheets(logger, wb):
+def shape_a_sheets(logger, wb, format_maxrow=None):
     """シート整形のメイン
 
     Args:
         logger (logger): ロギングオブジェクト
         wb (Workbook): Workbookオブジェクト
+        format_maxrow (int): 接触履歴シートの条件付き書式を適用する最終行 default: 各シートの最終行
 
     Returns:
         (Workbook): Workbookオブジェクト
@@ -318,9 +356,13 @@ def shape_a_sheets(logger, wb):
     for i in range(len(sheetnames)):
         ws = wb.worksheets[i]
 
-        if ws.title == cc.COCOA_EXPOSURE_SHEET_NAME:
+        if ws.title.startswith(cc.COCOA_EXPOSURE_SHEET_NAME):
+            # 端末毎のシート 接触履歴1, 接触履歴2... も同じ整形
+            shape_sheet_common(logger, ws)
+            shape_exposure_sheet(logger, ws, format_maxrow=format_maxrow)
+        elif ws.title in (cc.COCOA_HOUR_DISTANCE_SHEET_NAME, cc.COCOA_WEEKDAY_HOUR_SHEET_NAME):
             shape_sheet_common(logger, ws)
-            shape_exposure_sheet(logger, ws)
+            shape_heatmap_sheet(logger, ws)
         else:
             shape_sheet_common(logger, ws)
 
@@ -375,38 +417,299 @@ def add_chart(logger, wb, element, row=3, ctitle='', x_title='日付', y_title='
     return wb
 
 
-def create_cocoa_excel(logger, merge_df):
-    """create cocoa log Excel book
+def template_signature(dfs, sheets, indexes):
+    """テンプレートを共有できるかを判定するキー
+
+    接触履歴シートはカラム構成が同じなら行数によらず同じテンプレートを使う
 
     Args:
-        logger (logging): ロガー
-        merge_df (DataFrame): マージ後のDataFrame
+        dfs (list of dataframe): 抽出するデータフレームのリスト
+        sheets (list of str): 抽出先のシート名のリスト
+        indexes (list of boolian ): indexを含めて抽出するかどうか
 
     Returns:
-        None
+        (tuple): hash可能なキー
+    """
+    signature = []
+    for df, sheet, index in zip(dfs, sheets, indexes):
+        n_rows = None if sheet.startswith(cc.COCOA_EXPOSURE_SHEET_NAME) else len(df)
+        signature.append((sheet, tuple(df.columns), tuple(df.index.names), index, n_rows))
+    return tuple(signature)
 
+
+def build_template(logger, dfs, sheets, indexes):
+    """整形済みテンプレートBookを作成する
+
+    データの1行目をスタイルの見本行として書式、条件付き書式、コメント、グラフを設定する
+    条件付き書式はシート最終行まで、グラフは見本行を参照して作成し、
+    書き出し時に write_sheet_values, update_chart_rows でデータ行に合わせる
+
+    Args:
+        logger (logger): ロギングオブジェクト
+        dfs (list of dataframe): 抽出するデータフレームのリスト
+        sheets (list of str): 抽出先のシート名のリスト
+        indexes (list of boolian ): indexを含めて抽出するかどうか
+
+    Returns:
+        (bytes): テンプレートBookのxlsxデータ
     """
+    global CURRENT_GRAPH_POSITION
 
-    # Excel保管
-    bookname = 'COCOA_LOG_CHECKER_' + \
-        datetime.now(cc.JST).strftime('%Y-%m-%d-%H%M')+'.xlsx'
-    wb = save_to_excel_multi(logger, bookname=bookname,
-                             dfs=[merge_df],
-                             sheets=[cc.COCOA_EXPOSURE_SHEET_NAME],
-                             indexes=[True])
+    logger.info(f'build excel template: {sheets}')
+    prototypes = []
+    for df, sheet in zip(dfs, sheets):
+        if sheet.startswith(cc.COCOA_EXPOSURE_SHEET_NAME):
+            prototypes.append(df.iloc[:1])
+        else:
+            prototypes.append(df)
+    wb = save_to_excel_multi(logger, bookname=io.BytesIO(), dfs=prototypes,
+                             sheets=sheets, indexes=indexes)
     #　Excelシート整形
-    wb = shape_a_sheets(logger, wb)
+    wb = shape_a_sheets(logger, wb, format_maxrow=EXCEL_MAX_ROW)
     comment = Comment('スコア1350以上が濃厚接触アラート対象になるようです', 'cocoa_log_checker')
     wb = add_title_comment(
         logger, wb, cc.COCOA_EXPOSURE_SHEET_NAME, 3, 'cocoa_score', comment)
     wb = add_title_comment(
         logger, wb, cc.COCOA_EXPOSURE_SHEET_NAME, 3, '算出スコア計', comment)
+    CURRENT_GRAPH_POSITION = 0
     wb = add_chart(logger, wb, 'cocoa_score',
                    ctitle='COCOA Score', y_title='スコア')
     wb = add_chart(logger, wb, '算出スコア計',
                    ctitle='COCOA Calculated Score', y_title='スコア')
     wb = add_chart(logger, wb, 'contact', ctitle='接触回数', y_title='回数')
     wb = add_chart(logger, wb, '接触時間計(分)', ctitle='接触時間(分)', y_title='分')
+    CURRENT_GRAPH_POSITION = 0
+
+    template = io.BytesIO()
+    wb.save(template)
+    return template.getvalue()
+
+
+def load_template(logger, dfs, sheets, indexes):
+    """テンプレートBookを開く テンプレートはプロセス内でカラム構成毎に1回だけ作成する
+
+    Args:
+        logger (logger): ロギングオブジェクト
+        dfs (list of dataframe): 抽出するデータフレームのリスト
+        sheets (list of str): 抽出先のシート名のリスト
+        indexes (list of boolian ): indexを含めて抽出するかどうか
+
+    Returns:
+        (Workbook) : データ未記入のWorkbook object
+    """
+    signature = template_signature(dfs, sheets, indexes)
+    if signature not in TEMPLATE_CACHE:
+        TEMPLATE_CACHE[signature] = build_template(logger, dfs, sheets, indexes)
+    return openpyxl.load_workbook(io.BytesIO(TEMPLATE_CACHE[signature]))
+
+
+def write_sheet_values(logger, ws, df, index=True):
+    """テンプレートのシートにDataFrameの値だけを書き込む
+
+    pandasのto_excelと同じ位置に書き、スタイルはテンプレートの見本行(データ1行目)をコピーする
+
+    Args:
+        logger (logger): ロギングオブジェクト
+        ws (Wroksheet): テンプレートのワークシート
+        df (DataFrame): 書き込むデータ
+        index (boolian): indexを含めて書き込むかどうか
+
+    Returns:
+        None
+    """
+    logger.info(f'write {len(df)} rows to sheet: {ws.title}')
+    first_row = df.columns.nlevels + 1
+    if df.columns.nlevels > 1 and index:
+        first_row += 1  # index名の行
+    if index:
+        rows = [(list(i) if isinstance(i, tuple) else [i]) + v
+                for i, v in zip(df.index.tolist(), df.values.tolist())]
+    else:
+        rows = df.values.tolist()
+    styles = [cell._style for cell in ws[first_row]]
+    for r, values in enumerate(rows, start=first_row):
+        for c, value in enumerate(values, start=1):
+            cell = ws.cell(row=r, column=c, value=value)
+            cell._style = copy(styles[c-1])
+    return
+
+
+def update_chart_rows(logger, ws, n_rows):
+    """テンプレートのグラフの参照範囲と位置をデータ行数に合わせる
+
+    参照は見本行の列と開始行から、データ行数の Reference を作り直す
+
+    Args:
+        logger (logger): ロギングオブジェクト
+        ws (Wroksheet): 接触履歴ワークシート
+        n_rows (int): データ行数
+
+    Returns:
+        None
+    """
+    last_row = 4 + n_rows
+    for chart in ws._charts:
+        for series in chart.series:
+            for ref in (series.val.numRef, series.cat.numRef, series.cat.strRef):
+                if ref is not None:
+                    prototype = Reference(range_string=ref.f)
+                    ref.f = str(Reference(ws, min_col=prototype.min_col, min_row=prototype.min_row,
+                                          max_col=prototype.max_col, max_row=last_row))
+        chart.anchor._from.row += n_rows - 1
+    return
+
+
+def iter_detail_rows(columns, chunk=DETAIL_CHUNK_ROWS):
+    """スキャンインスタンスの列形式配列から詳細シートの行を順に返すジェネレータ
+
+    日時の文字列変換はchunk行ずつまとめて行い、全行分のリストは作らない
+
+    Args:
+        columns (dict): cocoa.build_scan_instance_columnsで作成した列形式の配列
+        chunk (int): 一度に変換する行数
+
+    Yields:
+        tuple: DETAIL_HEADINGSの順の値
+    """
+    n = len(columns['millis'])
+    for start in range(0, n, chunk):
+        sl = slice(start, start+chunk)
+        t = pd.to_datetime(columns['millis'][sl], unit='ms', utc=True).tz_convert(cc.TZ)
+        yield from zip(t.strftime('%Y-%m-%d %H:%M').tolist(),
+                       columns['db'][sl].tolist(),
+                       columns['mindb'][sl].tolist(),
+                       columns['duration'][sl].tolist(),
+                       columns['score'][sl].tolist(),
+                       columns['distance'][sl].tolist())
+
+
+def create_detail_excel(logger, columns, bookname, max_rows=EXCEL_MAX_ROW):
+    """スキャンインスタンス毎の詳細Bookを書き出す
+
+    openpyxlのwrite-onlyモードでセルオブジェクトを保持せずに行を流し込むので、
+    行数が増えてもメモリ使用量は増えない
+    シートの最大行数を超える場合は 詳細, 詳細2, ... のシートに分割する
+
+    Args:
+        logger (logger): ロギングオブジェクト
+        columns (dict): cocoa.build_scan_instance_columnsで作成した列形式の配列
+        bookname (str): Excelファイル名
+        max_rows (int): 1シートの最大行数(見出し行を含む)
+
+    Returns:
+        (int): 作成したシート数
+    """
+    logger.info(f"export {len(columns['millis'])} scan instances to book: {bookname}")
+    wb = openpyxl.Workbook(write_only=True)
+    ws = None
+    n_sheets = 0
+    row = max_rows
+    for values in iter_detail_rows(columns):
+        if row >= max_rows:
+            n_sheets += 1
+            ws = create_detail_sheet(wb, n_sheets)
+            row = 1
+        ws.append(values)
+        row += 1
+    if ws is None:
+        n_sheets += 1
+        create_detail_sheet(wb, n_sheets)
+    save_book(logger, wb, bookname)
+    return n_sheets
+
+
+def create_detail_sheet(wb, number):
+    """write-onlyの詳細シートを見出し行付きで追加する
+
+    Args:
+        wb (Workbook): write-onlyのWorkbookオブジェクト
+        number (int): シート番号 1から
+
+    Returns:
+        (Worksheet): write-onlyのワークシート
+    """
+    sheetname = cc.COCOA_DETAIL_SHEET_NAME if number == 1 else f'{cc.COCOA_DETAIL_SHEET_NAME}{number}'
+    ws = wb.create_sheet(sheetname)
+    ws.sheet_properties.tabColor = BAR_COLOR_MIZUIRO
+    ws.freeze_panes = 'A2'
+    ws.column_dimensions['A'].width = 18
+    headings = []
+    for heading in DETAIL_HEADINGS:
+        cell = WriteOnlyCell(ws, value=heading)
+        cell.font = NORMAL_FONT
+        cell.fill = TITLE_CELL
+        headings.append(cell)
+    ws.append(headings)
+    return ws
+
+
+@cmem.profiled('create_cocoa_excel')
+def create_cocoa_excel(logger, merge_df, heatmaps=None, device_dfs=None, detail=None, basename=None,
+                       rollups=None, extra_sheets=None):
+    """create cocoa log Excel book
+
+    Args:
+        logger (logging): ロガー
+        merge_df (DataFrame): マージ後のDataFrame
+        heatmaps (tuple): cocoa.build_heatmap_dataの(hour_distance_df, weekday_hour_df)
+            指定された場合は時間帯別シートを追加する
+        device_dfs (dict): ファイル名をキーにした端末毎のmerge_df
+            指定された場合は端末毎の接触履歴シートを追加する
+        detail (dict): cocoa.build_scan_instance_columnsの列形式配列
+            指定された場合はスキャンインスタンス毎の詳細Book(_詳細.xlsx)も作成する
+        basename (str): Excelファイル名の先頭 default: cc.report_basename()
+            同名のBookが有る場合は上書きせず -2, -3... を付ける
+        rollups (dict): cocoa.build_rollupsの日/週/月の集計
+            指定された場合は cocoa.select_resolution で選んだ単位を接触履歴シートとグラフにし、
+            週毎/月毎の場合は日毎の表を cc.COCOA_DAILY_SHEET_NAME シートに出力する
+        extra_sheets (dict): シート名をキーにした (DataFrame, indexを含めるか)
+            指定された場合はシートを追加する ex: cocoaCompare の差分シート
+
+    Returns:
+        (str): 作成したExcelファイル名
+
+    """
+
+    # Excel保管
+    if basename is None:
+        basename = cc.report_basename()
+    bookname = cc.unique_filename(basename, '.xlsx')
+    dfs = [merge_df]
+    sheets = [cc.COCOA_EXPOSURE_SHEET_NAME]
+    indexes = [True]
+    if rollups is not None:
+        resolution = cocoa.select_resolution(merge_df)
+        if resolution != 'day':
+            dfs = [rollups[resolution], merge_df]
+            sheets.append(cc.COCOA_DAILY_SHEET_NAME)
+            indexes.append(True)
+    if heatmaps is not None:
+        dfs.extend(heatmaps)
+        sheets.extend([cc.COCOA_HOUR_DISTANCE_SHEET_NAME,
+                      cc.COCOA_WEEKDAY_HOUR_SHEET_NAME])
+        indexes.extend([True, True])
+    device_sheets = {}
+    if device_dfs and len(device_dfs) > 1:
+        for i, (filename, device_df) in enumerate(device_dfs.items()):
+            sheetname = f'{cc.COCOA_EXPOSURE_SHEET_NAME}{i+1}'
+            device_sheets[sheetname] = filename
+            dfs.append(device_df)
+            sheets.append(sheetname)
+            indexes.append(True)
+    for sheetname, (df, index) in (extra_sheets or {}).items():
+        dfs.append(df)
+        sheets.append(sheetname)
+        indexes.append(index)
+    # 整形済みテンプレートに値だけを書き込む
+    wb = load_template(logger, dfs, sheets, indexes)
+    for df, sheet, index in zip(dfs, sheets, indexes):
+        write_sheet_values(logger, wb[sheet], df, index)
+    for sheetname, filename in device_sheets.items():
+        wb[sheetname]['A1'].value = filename
+    update_chart_rows(logger, wb[cc.COCOA_EXPOSURE_SHEET_NAME], len(dfs[0]))
     save_book(logger, wb, bookname)
+    if detail is not None:
+        # write-onlyのシートは通常のBookに追加できないので別Bookにする
+        create_detail_excel(logger, detail, bookname[:-len('.xlsx')] + f'_{cc.COCOA_DETAIL_SHEET_NAME}.xlsx')
 
     return bookname
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Export
+
+    Excel以外の形式(CSV, Parquet, JSON Lines)で集計結果を書き出す
+
+    出力ファイル:
+        <basename>_daily.<ext>           merge_df 日毎の集計
+        <basename>_scan_instances.<ext>  スキャンインスタンス毎の明細
+        <basename>_log_information.<ext> COCOA_LOG_INFORMATION (key, value)
+
+    merge_dfのカラム名:
+        3段のMultiIndexを '__' で連結して1段にする 前後の空白は除く
+        ex: ('exposure_minutes', 'duration', '  ~1m') -> 'exposure_minutes__duration__~1m'
+            ('sum', 'cocoa_score', 'cocoa_score')     -> 'sum__cocoa_score__cocoa_score'
+        index(date, dow)は先頭のカラムになる
+
+    Parquetはpandasのparquetエンジン(pyarrow等)が必要
+
+"""
+import pandas as pd
+
+import cocoaConfig as cc
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+EXPORT_FORMATS = ['csv', 'parquet', 'jsonl']
+COLUMN_SEPARATOR = '__'
+
+
+def flatten_columns(df):
+    """MultiIndexのカラムを '__' 区切りの1段のカラムにし、indexをカラムに戻す
+
+    Args:
+        df (DataFrame): merge_df
+
+    Returns:
+        DataFrame : カラムが1段のDataFrame
+
+    """
+    flat = df.copy()
+    flat.columns = [COLUMN_SEPARATOR.join(str(level).strip() for level in col if str(level).strip() != '')
+                    if isinstance(col, tuple) else str(col)
+                    for col in df.columns]
+    return flat.reset_index()
+
+
+def scan_instances_frame(columns):
+    """スキャンインスタンスの列形式配列を明細のDataFrameにする
+
+    Args:
+        columns (dict): cocoa.build_scan_instance_columnsで作成した列形式の配列
+
+    Returns:
+        DataFrame : date, db, mindb, duration, score, mindb_score, distance
+
+    """
+    return pd.DataFrame({
+        'date': pd.to_datetime(columns['millis'], unit='ms', utc=True).tz_convert(cc.TZ),
+        'db': columns['db'],
+        'mindb': columns['mindb'],
+        'duration': columns['duration'],
+        'score': columns['score'],
+        'mindb_score': columns['mindb_score'],
+        'distance': [str(d).strip() for d in columns['distance']]})
+
+
+def log_information_frame(log_information):
+    """COCOA_LOG_INFORMATIONの 'key: value' のリストを key, value のDataFrameにする
+
+    Args:
+        log_information (list of str): cc.COCOA_LOG_INFORMATION
+
+    Returns:
+        DataFrame : key, value
+
+    """
+    rows = []
+    for line in log_information:
+        key, sep, value = line.partition(': ')
+        rows.append({'key': key, 'value': value} if sep else {'key': '', 'value': line})
+    return pd.DataFrame(rows, columns=['key', 'value'])
+
+
+def write_frame(logger, df, filename, fmt):
+    """DataFrameを指定形式で書き出す
+
+    Args:
+        logger (logging): ロガー
+        df (DataFrame): 1段のカラムのDataFrame
+        filename (str): 出力ファイル名
+        fmt (str): csv/parquet/jsonl
+
+    Returns:
+        None
+
+    """
+    logger.info(f'export {len(df)} rows to: {filename}')
+    if fmt == 'csv':
+        df.to_csv(filename, index=False, encoding='utf-8')
+    elif fmt == 'parquet':
+        df.to_parquet(filename, index=False)
+    elif fmt == 'jsonl':
+        df.to_json(filename, orient='records', lines=True, force_ascii=False, date_format='iso')
+    else:
+        raise ValueError(f'unknown export format: {fmt}')
+    return
+
+
+def export_tables(logger, merge_df, columns, log_information, fmt, basename=None):
+    """merge_df, スキャンインスタンス明細, ログ情報を指定形式で書き出す
+
+    Args:
+        logger (logging): ロガー
+        merge_df (DataFrame): マージ後のDataFrame
+        columns (dict): cocoa.build_scan_instance_columnsの列形式配列 空の場合は明細を出力しない
+        log_information (list of str): cc.COCOA_LOG_INFORMATION
+        fmt (str): csv/parquet/jsonl
+        basename (str): 出力ファイル名の先頭 default: cc.report_basename()
+
+    Returns:
+        list : 出力したファイル名 parquetエンジンが無い場合は空
+
+    """
+    if basename is None:
+        basename = cc.report_basename()
+    tables = [('daily', flatten_columns(merge_df))]
+    if columns:
+        tables.append(('scan_instances', scan_instances_frame(columns)))
+    tables.append(('log_information', log_information_frame(log_information)))
+
+    filenames = []
+    for name, df in tables:
+        filename = f'{basename}_{name}.{fmt}'
+        try:
+            write_frame(logger, df, filename, fmt)
+        except ImportError as e:
+            logger.info(f'parquetの出力には pyarrow が必要です: {e}')
+            return []
+        filenames.append(filename)
+    return filenames
@@ -7,12 +7,14 @@ import json
 import sys  # process関係
 import traceback
 from datetime import date, datetime, timedelta
+from functools import partial
 from pprint import pformat, pprint
 
 import matplotlib
 import numpy as np
 import pandas as pd
 from matplotlib import pylab as plt
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from openpyxl.comments import Comment
 
 import PySimpleGUI as sg
@@ -21,6 +23,10 @@ import cocoa
 import cocoaChart as ccht
 import cocoaConfig as cc
 import cocoaExcel as cex
+import cocoaExport as cexp
+import cocoaMemory as cmem
+import cocoaPipeline as cpl
+import cocoaStats as cstat
 
 __author__ = "hyuasa"
 __version__ = "0.0.2"
@@ -47,12 +53,41 @@ def select_cocoa_log_filename(logger, window):
     dialogevent, dialogvalues = dialogwindow.read()
     dialogwindow.close()
     cc.COCOA_LOG = dialogvalues['-FILENAME-']
+    cc.COCOA_LOGS = []  # 複数ログの結合を解除
     window['-STATUS-'].update(f'選択されたCOCOAログ: {cc.COCOA_LOG}')
 
     return
 
 
-def refresh_window(logger, window):
+def select_export_format(logger, window):
+    """Select export format via dialog
+
+    Args:
+        logger (logging): ロガー
+        window (Window): GUI window instance
+
+    Returns:
+        (str) : csv/parquet/jsonl キャンセル時はNone
+
+    """
+    dialoglayout = [
+        [sg.Text("出力形式")],
+        [sg.Radio(fmt, 'FORMAT', key=fmt, default=(i == 0)) for i, fmt in enumerate(cexp.EXPORT_FORMATS)],
+        [sg.OK(), sg.Cancel()],
+    ]
+
+    dialogwindow = sg.Window("データ出力", dialoglayout)
+    dialogevent, dialogvalues = dialogwindow.read()
+    dialogwindow.close()
+    if dialogevent != 'OK':
+        return None
+    for fmt in cexp.EXPORT_FORMATS:
+        if dialogvalues[fmt]:
+            return fmt
+    return None
+
+
+def refresh_window(logger, window, chart):
     """refresh Table
        
        read data,
@@ -63,6 +98,7 @@ def refresh_window(logger, window):
     Args:
         logger (logging): ロガー
         window (Window): GUI window instance
+        chart (dict): 埋め込みグラフ (cocoaChart.create_embedded_chart)
 
     Returns:
         None
@@ -70,20 +106,46 @@ def refresh_window(logger, window):
     """
     merge_df = cocoa.update_dataframe(logger)
     if merge_df is not None:
-        headings, data = build_table_data(logger, merge_df)
+        resolution, view_df = table_view(logger)
+        headings, data = build_table_data(logger, view_df)
         # pprint(headings)
         # pprint(data)
         #window['-TABLE-'].update(values=data)
         #window['-STATUS-'].update(f'新しいCOCOAログを分析しました: {cc.COCOA_LOG}')
         window.close()  # close old window
-        window = create_window(logger, headings, data, f'REFRESH Data: {cc.COCOA_LOG}')
-        handle_events(logger, window, merge_df)
+        window = create_window(logger, headings, data, f'REFRESH Data: {cc.COCOA_LOG}', chart)
+        update_chart(logger, window, chart, view_df)
+        handle_events(logger, window, merge_df, chart)
 
     else:
         window['-STATUS-'].update(f'正しいCOCOAログではありません: {cc.COCOA_LOG}')
     return
 
 
+def table_view(logger):
+    """表とグラフに表示する集計 (cc.RESOLUTION の単位)
+
+    cc.STATS_FILE が有る場合は日毎の値が全体の何パーセンタイルかのカラムを追加する
+    (週毎/月毎は日毎の分布と比べられないので空欄)
+
+    Args:
+        logger (logging): ロガー
+
+    Returns:
+        str : day/week/month
+        DataFrame : 表示する集計 正しいログでない場合は (None, None)
+
+    """
+    resolution, view_df = cpl.resolution_view(logger)
+    if view_df is None or cc.STATS_FILE is None:
+        return resolution, view_df
+    percentiles = cstat.percentile_frame(cstat.load_stats(logger, cc.STATS_FILE), view_df)
+    if resolution != 'day':
+        percentiles[:] = np.nan
+    return resolution, pd.concat([view_df, percentiles], axis=1)
+
+
+@cmem.profiled('build_table_data')
 def build_table_data(logger, merge_df):
     """build table data
 
@@ -124,7 +186,7 @@ def build_table_data(logger, merge_df):
     for line in values:
         atoms = []
         for atom in line:
-            atoms.append('{:,.1f}'.format(atom))
+            atoms.append('' if pd.isna(atom) else '{:,.1f}'.format(atom))
         # print(atoms)
         line = atoms
         line.insert(0, dows[i])
@@ -135,14 +197,18 @@ def build_table_data(logger, merge_df):
     return headings, data
 
 
-def create_window(logger, headings, data, status_message):
+def create_window(logger, headings, data, status_message, chart):
     """create new window
 
+    表とグラフはタブで切り替える
+    グラフはウィンドウを作り直しても同じFigure(棒のartist)を新しいCanvasに埋め込んで使う
+
     Args:
         logger (logging): ロガー
         headings (list): tableカラムタイトル
         data (list): tableデータ 
         status_message (str): ステータスメッセージ
+        chart (dict): 埋め込みグラフ (cocoaChart.create_embedded_chart)
 
     Returns:
         (Window) : PySimpleGUI Window インスタンス
@@ -156,35 +222,107 @@ def create_window(logger, headings, data, status_message):
         [sg.Button(button_text='ファイル選択', key='-BUTTON_FILE-'),
          sg.Button(button_text='ログ情報', key='-BUTTON_LOGINFO-'),
          sg.Button(button_text='グラフ表示', key='-BUTTON_GRAPH-'),
+         sg.Button(button_text='時間帯表示', key='-BUTTON_HEATMAP-'),
          sg.Button(button_text='Excel保管', key='-BUTTON_EXCEL-'),
-         sg.Button(button_text='終了', key='-BUTTON_END-')],
-
-        [sg.Table(
-         headings=headings,
-         values=data,
-         auto_size_columns=False,
-         justification='right',
-         key='-TABLE-',
-         alternating_row_color=cc.SG_ALT_ROW_COLOR,
-         header_text_color=cc.SG_HEADER_TEXT_COLOR,
-         num_rows=min(25, len(data)),
-         col_widths=list(map(lambda x:len(x)+5, headings)))
+         sg.Button(button_text='データ出力', key='-BUTTON_EXPORT-'),
+         sg.Button(button_text='終了', key='-BUTTON_END-'),
+         sg.Text('集計単位'),
+         sg.Combo(['auto', 'day', 'week', 'month'], default_value=cc.RESOLUTION, key='-RESOLUTION-',
+                  readonly=True, enable_events=True)],
+
+        [sg.TabGroup([[
+         sg.Tab('表', [[sg.Table(
+             headings=headings,
+             values=data,
+             auto_size_columns=False,
+             justification='right',
+             key='-TABLE-',
+             alternating_row_color=cc.SG_ALT_ROW_COLOR,
+             header_text_color=cc.SG_HEADER_TEXT_COLOR,
+             num_rows=min(25, len(data)),
+             col_widths=list(map(lambda x:len(x)+5, headings)))]], key='-TAB_TABLE-'),
+         sg.Tab('グラフ', [[sg.Canvas(key='-CANVAS-', size=(1000, 600))]], key='-TAB_GRAPH-')]])
          ],
 
         [sg.StatusBar(status_message, size=(100), key='-STATUS-')]
     ]
 
-    window = sg.Window('COCOA Exposure History',  layout)
+    window = sg.Window('COCOA Exposure History',  layout, finalize=True)
+    embed_chart(logger, window, chart)
     return window 
 
 
-def handle_events(logger, window, merge_df):
+def embed_chart(logger, window, chart):
+    """グラフのFigureをウィンドウのCanvasに埋め込む
+
+    Args:
+        logger (logging): ロガー
+        window (Window) : PySimpleGUI Window インスタンス (finalize済み)
+        chart (dict): 埋め込みグラフ (cocoaChart.create_embedded_chart)
+
+    Returns:
+        None
+
+    """
+    canvas = FigureCanvasTkAgg(chart['figure'], window['-CANVAS-'].TKCanvas)
+    ccht.attach_chart_canvas(chart, canvas)
+    canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
+    return
+
+
+def show_resolution(logger, window, chart):
+    """集計単位(cc.RESOLUTION)を切り替えて表とグラフを更新する
+
+    日/週/月の集計はパイプラインにキャッシュされているので集計し直さない
+    表のカラムは単位によらず同じなのでウィンドウは作り直さない
+
+    Args:
+        logger (logging): ロガー
+        window (Window) : PySimpleGUI Window インスタンス
+        chart (dict): 埋め込みグラフ
+
+    Returns:
+        None
+
+    """
+    resolution, view_df = table_view(logger)
+    if view_df is None:
+        return
+    headings, data = build_table_data(logger, view_df)
+    window['-TABLE-'].update(values=data)
+    update_chart(logger, window, chart, view_df)
+    window['-STATUS-'].update(f'集計単位: {resolution} ({len(view_df)}行): {cc.COCOA_LOG}')
+    return
+
+
+def update_chart(logger, window, chart, merge_df):
+    """埋め込みグラフを集計結果に更新する 日付が同じなら棒の高さだけを変えて再描画する
+
+    Args:
+        logger (logging): ロガー
+        window (Window) : PySimpleGUI Window インスタンス
+        chart (dict): 埋め込みグラフ
+        merge_df (DataFrame): COCOAログDataFrame
+
+    Returns:
+        None
+
+    """
+    if merge_df is None:
+        return
+    blitted = ccht.update_embedded_chart(logger, chart, merge_df)
+    logger.debug(f'chart updated: {"blit" if blitted else "redraw"}')
+    return
+
+
+def handle_events(logger, window, merge_df, chart):
     """ Handling GUI events
 
     Args:
         logger (logging): ロガー
         window (Window) : PySimpleGUI Window インスタンス
         merge_df (DataFrame): COCOAログDataFrame
+        chart (dict): 埋め込みグラフ
 
     Returns:
         None
@@ -197,21 +335,65 @@ def handle_events(logger, window, merge_df):
         if event == sg.WINDOW_CLOSED or event == '-BUTTON_END-' or value['-MENU-'] == '閉じる':
             break
 
+        if event == '-AGGREGATED-':
+            # スレッドの集計が終わったら表を作って開き直す (表のカラムはupdateできない)
+            merge_df = value[event]
+            if merge_df is not None:
+                resolution, view_df = table_view(logger)
+                headings, data = build_table_data(logger, view_df)
+                window.close()
+                window = create_window(logger, headings, data, f'COCOAログを分析しました: {cc.COCOA_LOG}', chart)
+                update_chart(logger, window, chart, view_df)
+            else:
+                window['-STATUS-'].update(f'正しいCOCOAログではありません: {cc.COCOA_LOG}')
+            continue
+
+        if event == '-RESOLUTION-':
+            cc.RESOLUTION = value['-RESOLUTION-']
+            if merge_df is not None:
+                show_resolution(logger, window, chart)
+            continue
+
         if event == '-BUTTON_GRAPH-':
-            window['-STATUS-'].update(f'COCOAチャートをOpenします')
             if merge_df is not None:
-                ccht.draw_cocoa_charts(logger, merge_df)
-                window['-STATUS-'].update(f'COCOAチャートをCloseしました')
+                window['-TAB_GRAPH-'].select()
+                window['-STATUS-'].update(f'COCOAチャートを表示しました')
+            else:
+                window['-STATUS-'].update(f'正しいCOCOAログではありません')
+
+        if event == '-BUTTON_HEATMAP-':
+            window['-STATUS-'].update(f'COCOA時間帯チャートをOpenします')
+            if merge_df is not None:
+                hour_distance_df, weekday_hour_df = cpl.stage(logger, 'heatmaps')
+                ccht.draw_heatmap_charts(logger, hour_distance_df, weekday_hour_df)
+                window['-STATUS-'].update(f'COCOA時間帯チャートをCloseしました')
             else:
                 window['-STATUS-'].update(f'正しいCOCOAログではありません')
 
         if event == '-BUTTON_EXCEL-':
             if merge_df is not None:
-                bookname = cex.create_cocoa_excel(logger, merge_df)
+                heatmaps = cpl.stage(logger, 'heatmaps')
+                detail = cc.COCOA_SCAN_INSTANCES if cc.EXCEL_DETAIL else None
+                bookname = cex.create_cocoa_excel(logger, merge_df, heatmaps=heatmaps,
+                                                  device_dfs=cc.COCOA_DEVICE_DFS, detail=detail,
+                                                  rollups=cpl.stage(logger, 'rollups'))
                 window['-STATUS-'].update(f'Excelファイルが作成されました: {bookname}')
             else:
                 window['-STATUS-'].update(f'正しいCOCOAログではありません')
 
+        if event == '-BUTTON_EXPORT-':
+            if merge_df is not None:
+                fmt = select_export_format(logger, window)
+                if fmt is not None:
+                    filenames = cexp.export_tables(logger, merge_df, cc.COCOA_SCAN_INSTANCES,
+                                                   cc.COCOA_LOG_INFORMATION, fmt)
+                    if filenames:
+                        window['-STATUS-'].update(f'ファイルが作成されました: {", ".join(filenames)}')
+                    else:
+                        window['-STATUS-'].update(f'{fmt}の出力に必要なライブラリがありません')
+            else:
+                window['-STATUS-'].update(f'正しいCOCOAログではありません')
+
         if event == '-BUTTON_LOGINFO-':
             log_detail = 'COCOAログ情報\n'+'\n'.join(cc.COCOA_LOG_INFORMATION)
             value = sg.popup_ok_cancel(log_detail)
@@ -220,32 +402,36 @@ def handle_events(logger, window, merge_df):
 
         if event == '-BUTTON_FILE-' or value['-MENU-'] == 'COCOAログファイルを開く':
             select_cocoa_log_filename(logger, window)
-            refresh_window(logger, window)
+            refresh_window(logger, window, chart)
 
 
     # print('window closed')
     window.close()
 
 
-def main(logger, merge_df):
+def main(logger):
     """GUI main
 
+    ログのヘッダ情報を表示してウィンドウを開き、集計はスレッドで行う
+    集計が終わると -AGGREGATED- イベントで表とグラフを表示する
+
     Args:
         logger (logging): ロガー
-        merge_df (DataFrame): pandas data
 
     Returns:
         None
 
     """
-    status_message = 'Status is Here. . . '
+    headings = []
+    data = []
     if cc.NEED_VALID_COCOA_LOG:
-        headings = []
-        data = []
         status_message = f'正しいCOCOAログが必要です。ファイル選択ボタンで指定してください: tried to open : {cc.COCOA_LOG}'
     else:
-        headings, data = build_table_data(logger, merge_df)
-   
-    window = create_window(logger, headings, data, status_message)
-    handle_events(logger, window, merge_df)
+        status_message = f'集計中です: {cc.COCOA_LOG} ' + ' / '.join(cc.COCOA_LOG_INFORMATION)
+
+    chart = ccht.create_embedded_chart()
+    window = create_window(logger, headings, data, status_message, chart)
+    if not cc.NEED_VALID_COCOA_LOG:
+        window.perform_long_operation(partial(cocoa.update_dataframe, logger), '-AGGREGATED-')
+    handle_events(logger, window, None, chart)
  
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Analysis Server Load Test
+
+    cocoaServer.py に同じcocoa logを並列にアップロードし、
+    ステータス毎の件数とレイテンシ(p50/p95/max)、スループットを表示する
+    503(混雑)はRetry-Afterを待たずに失敗として数える
+
+    Example:
+        python cocoaLoadTest.py -l exposure_data.json -n 200 -c 32 --url http://127.0.0.1:8080
+
+"""
+import argparse
+import os
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+def setup_args():
+    """"コマンドライン引数設定
+
+    Args:
+        None
+
+    Returns:
+        (argparse): parser
+
+    """
+    parser = argparse.ArgumentParser(description='Cocoa Log Analysis Server Load Test')
+    parser.add_argument('-l', '--cocoa_log', metavar='COCOA_LOGFILE', default='exposure_data.json',
+                        help='cocoa log file to upload')
+    parser.add_argument('-n', '--requests', type=int, default=100, help='total requests (default: 100)')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='concurrent clients (default: 16)')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='server url')
+    return parser
+
+
+def upload(url, body, name):
+    """1件アップロードする
+
+    Args:
+        url (str): サーバのurl
+        body (bytes): cocoa log
+        name (str): ログファイル名
+
+    Returns:
+        (int): HTTPステータス 接続エラーは0
+        (float): レイテンシ(秒)
+
+    """
+    request = urllib.request.Request(f'{url}/analyze?name={name}', data=body, method='POST')
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 0
+    return status, time.perf_counter() - start
+
+
+def percentile(values, p):
+    """p (0-100) パーセンタイル"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main(args):
+    """Load Test Main
+
+    Args:
+        args (Namespace): コマンドライン引数
+
+    Returns:
+        None
+
+    """
+    with open(args.cocoa_log, 'rb') as f:
+        body = f.read()
+    name = os.path.basename(args.cocoa_log)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda i: upload(args.url, body, name), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = Counter(status for status, latency in results)
+    latencies = [latency for status, latency in results if status == 200]
+    print(f'requests: {args.requests} concurrency: {args.concurrency} elapsed: {elapsed:.2f}s')
+    print(f'status: {dict(statuses)}')
+    print(f'throughput: {len(latencies) / elapsed:.2f} ok/s')
+    print(f'latency ok p50: {percentile(latencies, 50):.3f}s p95: {percentile(latencies, 95):.3f}s'
+          f' max: {max(latencies, default=0):.3f}s')
+    return
+
+
+if __name__ == '__main__':
+    parser = setup_args()
+    main(parser.parse_args())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Memory Profiler
+
+    --profile_memory を指定した場合に、処理段階毎のメモリ使用量を tracemalloc で計測する
+
+    段階: read_cocoa_log, build_dfs, パイプラインの各段階(parse, merge_df, ...),
+          build_table_data, create_cocoa_excel, グラフの描画
+    - peak_bytes: 段階の実行中に増えたメモリの最大値 (段階の開始時点からの差)
+    - retained_bytes: 段階の終了後も残ったメモリ (開始時点からの差)
+    - top: 段階の前後のスナップショットの差が大きい割り当て箇所 (ファイル:行)
+
+    段階は入れ子になる (ex: parse の中の read_cocoa_log) 外側の peak_bytes は内側を含む
+    tracemalloc はプロセス全体を計測するので、GUIの集計スレッドと同時に動いた段階は互いの割り当てを含む
+    バッチ/フォルダ監視/サーバのワーカープロセスは計測しない
+
+    結果は段階毎にログに出力し、終了時に COCOA_LOG_CHECKER_YYYY-MM-DD-HHMM_memory.json に保存する
+
+"""
+import json
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+import cocoaConfig as cc
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+PROFILE_FRAMES = 1  # 割り当て箇所として記録するスタックの深さ
+PROFILE_TOP_SITES = 10  # 段階毎に記録する割り当て箇所の数
+PROFILE_RESULTS = []  # 計測した段階 (終了した順)
+PROFILE_STACK = threading.local()  # スレッド毎の実行中の段階
+
+
+def site_sizes():
+    """割り当て箇所(ファイル:行)毎の (サイズ, 個数)
+
+    スナップショットは大きいので段階の間は保持せず、箇所毎の集計だけを残す
+    tracemalloc自身とimportの割り当ては除く
+
+    Returns:
+        dict : 割り当て箇所をキーにした (size, count)
+
+    """
+    stats = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    )).statistics('lineno')
+    return {str(stat.traceback[0]): (stat.size, stat.count) for stat in stats}
+
+
+def top_sites(before, after):
+    """段階の前後で増減が大きい割り当て箇所
+
+    Args:
+        before (dict): 段階の開始時の site_sizes
+        after (dict): 段階の終了時の site_sizes
+
+    Returns:
+        list of dict : site, size_diff, count_diff 増減の絶対値が大きい順にPROFILE_TOP_SITES件
+
+    """
+    sites = []
+    for site in before.keys() | after.keys():
+        size0, count0 = before.get(site, (0, 0))
+        size1, count1 = after.get(site, (0, 0))
+        if size1 != size0:
+            sites.append({'site': site, 'size_diff': size1 - size0, 'count_diff': count1 - count0})
+    sites.sort(key=lambda site: abs(site['size_diff']), reverse=True)
+    return sites[:PROFILE_TOP_SITES]
+
+
+def start_stage(name):
+    """段階の計測を開始する
+
+    Args:
+        name (str): 段階名
+
+    Returns:
+        dict : 計測中の段階 end_stageに渡す
+
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILE_FRAMES)
+    stack = PROFILE_STACK.__dict__.setdefault('frames', [])
+    if stack:
+        # reset_peakで外側の段階のピークが消えないように、ここまでのピークを外側に残す
+        stack[-1]['child_peak'] = max(stack[-1]['child_peak'], tracemalloc.get_traced_memory()[1])
+    sites = site_sizes()
+    # スナップショットの一時的な割り当てをピークに含めないように、取った後で計測を始める
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    frame = {'name': name, 'depth': len(stack), 'start': current, 'child_peak': 0,
+             'sites': sites, 'time': time.perf_counter()}
+    stack.append(frame)
+    return frame
+
+
+def end_stage(logger, frame):
+    """段階の計測を終了してPROFILE_RESULTSに追加し、ログに出力する
+
+    Args:
+        logger (logging): ロガー
+        frame (dict): start_stageの戻り値
+
+    Returns:
+        dict : stage, depth, peak_bytes, retained_bytes, elapsed, top
+
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    peak = max(peak, frame['child_peak'])
+    stack = PROFILE_STACK.frames
+    stack.pop()
+    if stack:
+        stack[-1]['child_peak'] = max(stack[-1]['child_peak'], peak)
+    elapsed = time.perf_counter() - frame['time']
+    top = top_sites(frame['sites'], site_sizes())
+    tracemalloc.reset_peak()
+    result = {'stage': frame['name'], 'depth': frame['depth'],
+              'peak_bytes': peak - frame['start'], 'retained_bytes': current - frame['start'],
+              'elapsed': round(elapsed, 6), 'top': top}
+    PROFILE_RESULTS.append(result)
+    logger.info(f"memory: {'  ' * frame['depth']}{frame['name']} peak {result['peak_bytes'] / 2**20:,.1f}MiB"
+                f" retained {result['retained_bytes'] / 2**20:,.1f}MiB")
+    for site in top[:3]:
+        logger.debug(f"memory:   {site['site']} {site['size_diff'] / 2**20:+,.1f}MiB")
+    return result
+
+
+def profiled(name):
+    """cc.PROFILE_MEMORY の場合に関数の実行を段階として計測するデコレータ
+
+    関数の最初の引数はロガー
+
+    Args:
+        name (str): 段階名
+
+    Returns:
+        function : デコレータ
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(logger, *args, **kwargs):
+            if not cc.PROFILE_MEMORY:
+                return func(logger, *args, **kwargs)
+            frame = start_stage(name)
+            try:
+                return func(logger, *args, **kwargs)
+            finally:
+                end_stage(logger, frame)
+        return wrapper
+    return decorator
+
+
+def write_report(logger, basename=None):
+    """計測結果をJSONに保存する 計測していない場合は何もしない
+
+    Args:
+        logger (logging): ロガー
+        basename (str): ファイル名の先頭 default: cc.report_basename()
+
+    Returns:
+        (str): 保存したファイル名 計測していない場合はNone
+
+    """
+    if not PROFILE_RESULTS:
+        return None
+    report = {'cocoa_log': cc.COCOA_LOG, 'frames': PROFILE_FRAMES,
+              'traced_current_bytes': tracemalloc.get_traced_memory()[0], 'stages': PROFILE_RESULTS}
+    filename = cc.unique_filename(f'{basename or cc.report_basename()}_memory', '.json')
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    logger.info(f'メモリ計測結果が保存されました: {filename}')
+    return filename
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Pipeline
+
+    parse -> score -> aggregate -> render の段階ごとの中間結果を、必要になった時に計算してメモ化する
+    出力ごとに必要な段階だけが計算される
+
+    - GUIのログ情報は parse だけ
+    - グラフは daily_totals (距離区分の集計表を作らない)
+    - 表とExcelは merge_df
+    - 時間帯チャートは heatmaps (scoreの配列から直接)
+    - 週毎/月毎の表とグラフは rollups, totals_rollups (日毎の集計から)
+
+    中間結果は cc.COCOA_LOG, cc.COCOA_LOGS (とログファイルのサイズ/更新時刻), cc.ROLLING_WINDOWS
+    が変わると破棄される
+
+    世帯の複数ログ(cc.COCOA_LOGS, zip)は端末毎の表も必要なので parse でまとめて集計する
+
+"""
+import os
+import threading
+
+import cocoa
+import cocoaConfig as cc
+import cocoaMemory as cmem
+import cocoaPlatform as cp
+import cocoaSnapshot as csn
+import cocoaValidate as cv
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+PIPELINE_CACHE = {'key': None, 'values': {}}
+PIPELINE_LOCK = threading.RLock()  # GUIは集計をスレッドで行う
+
+
+def is_household():
+    """複数ログを結合して集計するか"""
+    return len(cc.COCOA_LOGS) > 1 or cc.COCOA_LOG.lower().endswith('.zip')
+
+
+def pipeline_key():
+    """中間結果が有効かを判定するキー
+
+    Returns:
+        tuple : ログファイル名とサイズ/更新時刻, 移動合計の日数
+
+    """
+    files = []
+    for filename in (cc.COCOA_LOGS if is_household() and cc.COCOA_LOGS else [cc.COCOA_LOG]):
+        try:
+            st = os.stat(filename)
+            files.append((filename, st.st_size, st.st_mtime_ns))
+        except OSError:
+            files.append((filename, None, None))
+    return tuple(files), tuple(cc.ROLLING_WINDOWS)
+
+
+def stage(logger, name, key=None):
+    """段階の結果を返す 未計算なら依存する段階から計算してメモ化する
+
+    Args:
+        logger (logging): ロガー
+        name (str): STAGESの段階名 ex: 'parse', 'merge_df', 'daily_totals'
+        key (tuple): pipeline_key 依存する段階の計算では呼び出し元のキーを渡し、ログファイルをstatし直さない
+                     default: 最初の呼び出しで求める
+
+    Returns:
+        段階の結果 正しいログでない場合はNone
+
+    """
+    with PIPELINE_LOCK:
+        if key is None:
+            key = pipeline_key()
+        if PIPELINE_CACHE['key'] != key:
+            PIPELINE_CACHE['key'] = key
+            PIPELINE_CACHE['values'] = {}
+        values = PIPELINE_CACHE['values']
+        if name not in values:
+            func, dependencies = STAGES[name]
+            inputs = [stage(logger, dependency, key) for dependency in dependencies]
+            if any(value is None for value in inputs):
+                values[name] = None
+            else:
+                logger.debug(f'pipeline stage: {name}')
+                values[name] = cmem.profiled(name)(func)(logger, *inputs)
+        return values[name]
+
+
+def parse_log(logger):
+    """parse: ログを読んで検証し、スキャンインスタンスとdaily summaryの列形式配列にする
+
+    スナップショットが有ればJSONは読まない
+
+    Args:
+        logger (logging): ロガー
+
+    Returns:
+        dict : columns, summary_columns (世帯の複数ログは merge_df も) 正しいログでない場合はNone
+
+    """
+    if is_household():
+        merge_df, cc.COCOA_DEVICE_DFS = cocoa.update_household_dataframe(logger, cc.COCOA_LOGS or [cc.COCOA_LOG])
+        if merge_df is None:
+            return None
+        return {'columns': cc.COCOA_SCAN_INSTANCES, 'summary_columns': cc.COCOA_DAILY_SUMMARIES,
+                'merge_df': merge_df}
+
+    cc.COCOA_DEVICE_DFS = {}
+    cc.COCOA_SCAN_INSTANCES = {}
+    cc.COCOA_DAILY_SUMMARIES = {}
+    snapshot = csn.load_snapshot(logger, cc.COCOA_LOG)
+    if snapshot is not None:
+        columns, summary_columns, cc.COCOA_LOG_INFORMATION = snapshot
+    else:
+        exposure = cocoa.read_cocoa_log(logger)
+        adapter = cocoa.verify_cocoa_log(logger, exposure)
+        if adapter is None:
+            cc.NEED_VALID_COCOA_LOG = True
+            return None
+        report = cv.new_report()
+        try:
+            summary_columns = cp.daily_summary_columns(adapter, exposure, report)
+            columns = cp.scan_instance_columns(adapter, exposure, report)
+        except ValueError as ve:
+            # cc.VALIDATION_FAIL_FAST で不正なレコードが有った
+            cc.COCOA_LOG_INFORMATION.append(f'不正なレコードが有ります: {ve}')
+            cc.NEED_VALID_COCOA_LOG = True
+            return None
+        cv.log_report(logger, report, cc.COCOA_LOG_INFORMATION)
+        csn.save_snapshot(logger, cc.COCOA_LOG, columns, summary_columns, cc.COCOA_LOG_INFORMATION)
+    cc.NEED_VALID_COCOA_LOG = False
+    return {'columns': columns, 'summary_columns': summary_columns}
+
+
+def score_instances(logger, parsed):
+    """score: スキャンインスタンスに距離区分とスコアを付ける"""
+    columns = cocoa.add_instance_scores(logger, dict(parsed['columns']))
+    cc.COCOA_SCAN_INSTANCES = columns
+    cc.COCOA_DAILY_SUMMARIES = parsed['summary_columns']
+    return columns
+
+
+def daily_summary_frame(logger, parsed):
+    """aggregate: daily summaryのDataFrame"""
+    return cocoa.build_daily_summary_frame(logger, parsed['summary_columns'])
+
+
+def exposures_frame(logger, columns):
+    """aggregate: スキャンインスタンスのDataFrame"""
+    return cocoa.build_exposures_frame(logger, columns)
+
+
+def events_frame(logger, parsed):
+    """aggregate: exposure windowのDataFrame"""
+    return cocoa.build_events_frame(logger, parsed['columns'])
+
+
+def duration_pivot(logger, exposures_df):
+    """aggregate: 距離区分別の接触時間"""
+    return cocoa.build_duration_pivot(logger, exposures_df)
+
+
+def calculate_score_pivot(logger, exposures_df):
+    """aggregate: 距離区分別の算出スコア"""
+    return cocoa.build_calculate_score_pivot(logger, exposures_df)
+
+
+def events_pivot(logger, events_df):
+    """aggregate: 接触回数"""
+    return cocoa.build_events_pivot(logger, events_df)
+
+
+def cocoa_score_pivot(logger, daily_summary_df):
+    """aggregate: COCOAスコア"""
+    return cocoa.build_cocoa_score_pivot(logger, daily_summary_df)
+
+
+def merge_tables(logger, parsed):
+    """aggregate: 表とExcelのmerge_df 行が無い場合はNone
+
+    世帯の複数ログはparseで集計済みのものを使う
+    """
+    if 'merge_df' in parsed:
+        return parsed['merge_df']
+    key = PIPELINE_CACHE['key']  # stage から呼ばれるので計算中のキー
+    merge_df = cocoa.merge_pivots(logger, stage(logger, 'duration_pv', key), stage(logger, 'events_pv', key),
+                                  stage(logger, 'cocoa_score_pv', key), stage(logger, 'calculate_score_pv', key))
+    cc.NEED_VALID_COCOA_LOG = len(merge_df) == 0
+    return None if cc.NEED_VALID_COCOA_LOG else merge_df
+
+
+def daily_totals(logger, exposures_df, events_df, daily_summary_df):
+    """aggregate: グラフ用の日毎の合計 行が無い場合はNone"""
+    totals_df = cocoa.build_daily_totals(logger, exposures_df, events_df, daily_summary_df)
+    return None if len(totals_df) == 0 else totals_df
+
+
+def rollups(logger, df):
+    """aggregate: 日/週/月の集計 (merge_df または daily_totals から)"""
+    return cocoa.build_rollups(logger, df)
+
+
+def resolution_view(logger, name='rollups', resolution=None):
+    """選んだ単位の集計を返す 単位を切り替えても集計し直さない
+
+    Args:
+        logger (logging): ロガー
+        name (str): rollups(merge_df) / totals_rollups(daily_totals)
+        resolution (str): auto/day/week/month default: cc.RESOLUTION
+
+    Returns:
+        str : day/week/month
+        DataFrame : その単位の集計 正しいログでない場合は (None, None)
+
+    """
+    pyramid = stage(logger, name)
+    if pyramid is None:
+        return None, None
+    resolution = cocoa.select_resolution(pyramid['day'], resolution)
+    return resolution, pyramid[resolution]
+
+
+def heatmaps(logger, columns):
+    """aggregate: 時間帯別の接触時間 (hour_distance_df, weekday_hour_df)"""
+    return cocoa.build_heatmap_data(logger, columns)
+
+
+# 段階名: (関数, 依存する段階) 関数は (logger, *依存する段階の結果) で呼ばれる
+STAGES = {
+    'parse': (parse_log, ()),
+    'score': (score_instances, ('parse',)),
+    'daily_summary_df': (daily_summary_frame, ('parse',)),
+    'exposures_df': (exposures_frame, ('score',)),
+    'events_df': (events_frame, ('parse',)),
+    'duration_pv': (duration_pivot, ('exposures_df',)),
+    'calculate_score_pv': (calculate_score_pivot, ('exposures_df',)),
+    'events_pv': (events_pivot, ('events_df',)),
+    'cocoa_score_pv': (cocoa_score_pivot, ('daily_summary_df',)),
+    'merge_df': (merge_tables, ('parse',)),
+    'daily_totals': (daily_totals, ('exposures_df', 'events_df', 'daily_summary_df')),
+    'heatmaps': (heatmaps, ('score',)),
+    'rollups': (rollups, ('merge_df',)),
+    'totals_rollups': (rollups, ('daily_totals',)),
+}
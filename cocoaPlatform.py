@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Platform Adapter
+
+    exposure_data.jsonはplatform(iOS/Android)やENのバージョンでキー名が異なることがある
+    ヘッダ(platform/en_version)とキーの有無からアダプタを選び、
+    どのバリアントも同じ列形式のスキーマに変換する
+
+    列形式スキーマ:
+        scan instances: millis, db, mindb, duration (スキャンインスタンス毎)
+                        window_millis (exposure window毎)
+        daily summaries: millis, cocoa_score (日毎)
+
+    新しいバリアントは register_adapter でキー名を登録するだけで追加できる
+
+    列形式に変換しながら型と値の範囲を検証する (cocoaValidate)
+
+"""
+from operator import itemgetter
+
+import numpy as np
+
+import cocoaValidate as cv
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+# EN v2 (iOS/Android 共通 COCOA 2.x の出力)
+EN_V2_KEYS = {'windows': 'exposure_windows',
+              'window_millis': 'DateMillisSinceEpoch',
+              'scan_instances': 'ScanInstances',
+              'db': 'TypicalAttenuationDb',
+              'mindb': 'MinAttenuationDb',
+              'duration': 'SecondsSinceLastScan',
+              'summaries': 'daily_summaries',
+              'summary_millis': 'DateMillisSinceEpoch',
+              'day_summary': 'DaySummary',
+              'weighted_duration': 'WeightedDurationSum'}
+
+# Android Exposure Notifications APIのオブジェクトをそのままJSONにしたもの (camelCase)
+ANDROID_CAMEL_KEYS = {'windows': 'exposureWindows',
+                      'window_millis': 'dateMillisSinceEpoch',
+                      'scan_instances': 'scanInstances',
+                      'db': 'typicalAttenuationDb',
+                      'mindb': 'minAttenuationDb',
+                      'duration': 'secondsSinceLastScan',
+                      'summaries': 'dailySummaries',
+                      'summary_millis': 'daysSinceEpoch',
+                      'day_summary': 'summaryData',
+                      'weighted_duration': 'weightedDurationSum'}
+
+MILLIS_PER_DAY = 86400000
+DEVICE_KEYS = ('platform', 'device_type', 'model')  # 同じ端末のログかを判定するヘッダ
+
+ADAPTERS = []
+
+
+def register_adapter(name, keys, platforms=None, en_versions=None, summary_millis_scale=1):
+    """アダプタを登録する 先に登録したものから順に選択される
+
+    Args:
+        name (str): アダプタ名
+        keys (dict): EN_V2_KEYSと同じキーを持つキー名の対応表
+        platforms (tuple of str): 対象のplatform (小文字) Noneは全て
+        en_versions (tuple of str): 対象のen_version Noneは全て
+        summary_millis_scale (int): daily summaryの日付をmillisに変換する係数
+
+    Returns:
+        dict : 登録したアダプタ
+
+    """
+    adapter = {'name': name, 'keys': keys,
+               'platforms': platforms, 'en_versions': en_versions,
+               'summary_millis_scale': summary_millis_scale,
+               'get_instance': itemgetter(keys['db'], keys['mindb'], keys['duration'])}
+    ADAPTERS.append(adapter)
+    return adapter
+
+
+def select_adapter(exposure):
+    """exposureのヘッダとキーから使うアダプタを選ぶ
+
+    Args:
+        exposure (dict): exposure_data.jsonを辞書形式で読み込んだもの
+
+    Returns:
+        dict : アダプタ 該当するものが無い場合はNone
+
+    """
+    platform = str(exposure.get('platform', '')).lower()
+    en_version = str(exposure.get('en_version', ''))
+    for adapter in ADAPTERS:
+        if adapter['platforms'] is not None and platform not in adapter['platforms']:
+            continue
+        if adapter['en_versions'] is not None and en_version not in adapter['en_versions']:
+            continue
+        keys = adapter['keys']
+        if keys['windows'] in exposure and keys['summaries'] in exposure:
+            return adapter
+    return None
+
+
+def windows(adapter, exposure):
+    """exposure windowのリスト"""
+    return exposure[adapter['keys']['windows']]
+
+
+def summaries(adapter, exposure):
+    """daily summaryのリスト"""
+    return exposure[adapter['keys']['summaries']]
+
+
+def scan_instance_columns(adapter, exposure, report=None):
+    """exposure windowsを列形式のスキャンインスタンス配列にする
+
+    まとめて配列にしてから要素毎にdtypeと範囲を確認し、不正な値を含むexposure windowだけを
+    レコード毎に検証して不正なレコードを除く (cocoaValidate.filter_scan_instances)
+    キーが無い等で配列にできない場合だけ、全てのwindowをレコード毎に検証し直す
+
+    Args:
+        adapter (dict): select_adapterで選んだアダプタ
+        exposure (dict): exposure_data.jsonを辞書形式で読み込んだもの
+        report (dict): cocoaValidate.new_reportの検証結果 Noneは記録しない
+
+    Returns:
+        dict : millis, db, mindb, duration, window_millis のnumpy配列
+
+    """
+    if report is None:
+        report = cv.new_report()
+    keys = adapter['keys']
+    get_instance = adapter['get_instance']
+    ews = windows(adapter, exposure)
+    try:
+        window_millis = cv.as_array([ew[keys['window_millis']] for ew in ews])
+        counts = np.array([len(ew[keys['scan_instances']]) for ew in ews], dtype=np.int64)
+        values = cv.as_array([get_instance(si) for ew in ews for si in ew[keys['scan_instances']]]).reshape(-1, 3)
+    except (KeyError, TypeError, ValueError, IndexError):
+        window_millis, counts, values = cv.scan_instance_columns(adapter, ews, report)
+    else:
+        window_millis, counts, values = cv.filter_scan_instances(adapter, ews, window_millis, counts, values, report)
+    window_millis = window_millis.astype(np.int64, copy=False)
+    values = values.astype(np.int64, copy=False)
+    return {'millis': np.repeat(window_millis, counts),
+            'db': values[:, 0],
+            'mindb': values[:, 1],
+            'duration': values[:, 2],
+            'window_millis': window_millis}
+
+
+def daily_summary_columns(adapter, exposure, report=None):
+    """daily summariesを列形式の配列にする 不正なレコードは除く
+
+    Args:
+        adapter (dict): select_adapterで選んだアダプタ
+        exposure (dict): exposure_data.jsonを辞書形式で読み込んだもの
+        report (dict): cocoaValidate.new_reportの検証結果 Noneは記録しない
+
+    Returns:
+        dict : millis, cocoa_score のnumpy配列
+
+    """
+    if report is None:
+        report = cv.new_report()
+    keys = adapter['keys']
+    dss = summaries(adapter, exposure)
+    try:
+        millis = np.array([ds[keys['summary_millis']] for ds in dss])
+        cocoa_score = np.array([ds[keys['day_summary']][keys['weighted_duration']] for ds in dss])
+        valid = (cv.in_range(millis, cv.summary_millis_range(adapter))
+                 and cv.in_range(cocoa_score, cv.WEIGHTED_DURATION_RANGE, kinds='iuf'))
+    except (KeyError, TypeError, ValueError, IndexError):
+        valid = False
+    if not valid:
+        millis, cocoa_score = cv.daily_summary_columns(adapter, dss, report)
+    return {'millis': millis.astype(np.int64, copy=False) * adapter['summary_millis_scale'],
+            'cocoa_score': cocoa_score.astype(np.float64, copy=False)}
+
+
+def window_fingerprint(adapter, ew):
+    """exposure windowの同一性判定用キー バリアントによらず同じ形
+
+    Args:
+        adapter (dict): アダプタ
+        ew (dict): exposure window
+
+    Returns:
+        tuple : (DateMillisSinceEpoch, (db, mindb, duration)のタプル) hash可能
+
+    """
+    keys = adapter['keys']
+    get_instance = adapter['get_instance']
+    return (ew[keys['window_millis']],
+            tuple(get_instance(si) for si in ew[keys['scan_instances']]))
+
+
+def device_key(exposure):
+    """ログを出力した端末のキー (DEVICE_KEYSのヘッダの値のタプル)"""
+    return tuple(str(exposure.get(key, '')).lower() for key in DEVICE_KEYS)
+
+
+def summary_fingerprint(adapter, ds, device=()):
+    """daily summaryの同一性判定用キー
+
+    同じ端末の同じ日のdaily summaryは、エクスポートした時期で値が違っても同じものとする
+
+    Args:
+        adapter (dict): アダプタ
+        ds (dict): daily summary
+        device (tuple): device_key
+
+    Returns:
+        tuple : (端末, 日付) hash可能
+
+    """
+    return (device, ds[adapter['keys']['summary_millis']])
+
+
+def summary_score(adapter, ds):
+    """daily summaryのCOCOAスコア(WeightedDurationSum) 値が不正な場合は-inf"""
+    keys = adapter['keys']
+    try:
+        return float(ds[keys['day_summary']][keys['weighted_duration']])
+    except (KeyError, TypeError, ValueError):
+        return float('-inf')
+
+
+register_adapter('en_v2', EN_V2_KEYS)
+register_adapter('android_camel', ANDROID_CAMEL_KEYS, platforms=('android',),
+                 summary_millis_scale=MILLIS_PER_DAY)
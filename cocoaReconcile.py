@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Reconciliation
+
+    daily summaryのCOCOAスコア(WeightedDurationSum)と、スキャンインスタンスから算出した算出スコア計を
+    日毎に突き合わせ、食い違いが大きい日と端末を見つける
+
+    - 日毎: daily summaryとスキャンインスタンスを日付で外部結合し、無い方は0とする
+        片方にしか無い日(片側)は常に異常とする (アプリ/OSのアップデートで記録が変わった場合に現れる)
+    - 日毎: log比 = log(1 + COCOAスコア) - log(1 + 算出スコア計) と 差 = COCOAスコア - 算出スコア計
+    - 異常な日: 両方有る日のlog比のロバストzスコア(中央値とMADによる)の絶対値が RECONCILE_Z_THRESHOLD を超える日
+    - 異常な端末: ログ毎のlog比の中央値を、全ログの中で同じくロバストzスコアにして判定する
+    - アプリ/OSのバージョン毎のlog比の中央値 (アップデートでスコアの計算が変わった場合に現れる)
+
+    算出スコアの重みはCOCOAアプリと同じではないので、log比が0でないこと自体は異常ではない
+    ログ内や端末間で比がずれていることを見る
+
+    --batch と --reconcile を指定すると、ワーカーがログ毎の結果を作り、
+    COCOA_LOG_CHECKER_YYYY-MM-DD-HHMM_reconcile.xlsx に全ログをまとめて出力する
+
+"""
+import numpy as np
+import pandas as pd
+
+import cocoaConfig as cc
+import cocoaExcel as cex
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+RECONCILE_Z_THRESHOLD = 3.5  # 異常とするロバストzスコアの絶対値 (Iglewicz & Hoaglin)
+MAD_SCALE = 0.6745  # 正規分布でMADを標準偏差に合わせる係数
+MEAN_AD_SCALE = 0.7979  # MADが0の場合に使う平均絶対偏差の係数
+ONLY_SUMMARY = 'summaryのみ'  # daily summaryだけが有る日
+ONLY_SCAN = 'scanのみ'  # スキャンインスタンスだけが有る日
+HEADER_KEYS = ['platform', 'platform_version', 'app_version', 'model', 'en_version']  # 端末とバージョン
+RECONCILE_SHEET_NAMES = ['ログ別整合性', '異常日', 'バージョン別整合性']
+
+
+def robust_z(values):
+    """ロバストzスコア 0.6745 * (x - 中央値) / MAD
+
+    MADが0(半分以上が同じ値)の場合は平均絶対偏差を使い、それも0の場合は全て0とする
+
+    Args:
+        values (ndarray): 値 NaNは結果もNaN
+
+    Returns:
+        ndarray : ロバストzスコア
+
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if np.isnan(values).all():
+        return np.full(values.shape, np.nan)
+    deviation = values - np.nanmedian(values)
+    mad = np.nanmedian(np.abs(deviation))
+    if mad > 0:
+        return MAD_SCALE * deviation / mad
+    mean_ad = np.nanmean(np.abs(deviation))
+    if mean_ad > 0:
+        return MEAN_AD_SCALE * deviation / mean_ad
+    return np.where(np.isnan(values), np.nan, 0.0)
+
+
+def daily_sums(millis, values, name):
+    """日毎(date, dow)の合計"""
+    t = pd.to_datetime(np.asarray(millis), unit='ms', utc=True).tz_convert(cc.TZ)
+    keys = [pd.Index(t.strftime('%Y-%m-%d'), name='date'), pd.Index(t.strftime('%a'), name='dow')]
+    return pd.Series(np.asarray(values, dtype=np.float64), name=name).groupby(keys).sum()
+
+
+def reconcile_days(columns, summary_columns):
+    """日毎のCOCOAスコアと算出スコア計の突き合わせ
+
+    merge_dfは集計表の内部結合で片方にしか無い日を含まないので、列形式配列から外部結合する
+
+    Args:
+        columns (dict): スキャンインスタンスの列形式配列 (millis, score)
+        summary_columns (dict): daily summaryの列形式配列 (millis, cocoa_score)
+
+    Returns:
+        DataFrame : (date, dow)をindexに COCOAスコア, 算出スコア計, 差, log比, 片側, robust_z, 異常
+                    robust_zは両方有る日だけ
+
+    """
+    joined = pd.concat([daily_sums(summary_columns['millis'], summary_columns['cocoa_score'], 'COCOAスコア'),
+                        daily_sums(columns['millis'], columns['score'], '算出スコア計')],
+                       axis=1, join='outer').sort_index()
+    one_side = np.select([joined['算出スコア計'].isna(), joined['COCOAスコア'].isna()],
+                         [ONLY_SUMMARY, ONLY_SCAN], '')
+    joined = joined.fillna(0)
+    cocoa_score = joined['COCOAスコア'].to_numpy()
+    calc_score = joined['算出スコア計'].to_numpy()
+    log_ratio = np.log1p(cocoa_score) - np.log1p(calc_score)
+    z = robust_z(np.where(one_side == '', log_ratio, np.nan))
+    return pd.DataFrame({'COCOAスコア': cocoa_score, '算出スコア計': calc_score,
+                         '差': cocoa_score - calc_score, 'log比': log_ratio, '片側': one_side, 'robust_z': z,
+                         '異常': (one_side != '') | (np.abs(z) > RECONCILE_Z_THRESHOLD)}, index=joined.index)
+
+
+def reconcile_log(filename, exposure, columns, summary_columns):
+    """1つのログの突き合わせ結果 (ワーカープロセスで実行し、親プロセスに返す)
+
+    Args:
+        filename (str): cocoa log ファイル名
+        exposure (dict): cocoa log
+        columns (dict): スキャンインスタンスの列形式配列 cc.COCOA_SCAN_INSTANCES
+        summary_columns (dict): daily summaryの列形式配列 cc.COCOA_DAILY_SUMMARIES
+
+    Returns:
+        dict : summary(ログ毎の集計), anomalies(異常な日のDataFrame)
+
+    """
+    days = reconcile_days(columns, summary_columns)
+    both = days[days['片側'] == '']
+    summary = {'log': filename}
+    summary.update({key: str(exposure.get(key, '')) for key in HEADER_KEYS})
+    summary.update({'days': len(days),
+                    'log比中央値': float(both['log比'].median()) if len(both) > 0 else np.nan,
+                    '差中央値': float(both['差'].median()) if len(both) > 0 else np.nan,
+                    '片側日数': int((days['片側'] != '').sum()), '異常日数': int(days['異常'].sum())})
+    anomalies = days[days['異常']].drop(columns='異常').reset_index()
+    anomalies.insert(0, 'log', filename)
+    return {'summary': summary, 'anomalies': anomalies}
+
+
+def corpus_report(results):
+    """全ログの突き合わせ結果をまとめる
+
+    Args:
+        results (list of dict): reconcile_log の結果
+
+    Returns:
+        DataFrame : ログ毎の集計 端末間のrobust_zと異常端末を追加
+        DataFrame : 全ログの異常な日
+        DataFrame : platform, platform_version, app_version 毎の ログ数, log比中央値, 異常端末数
+
+    """
+    logs_df = pd.DataFrame([result['summary'] for result in results],
+                           columns=['log'] + HEADER_KEYS + ['days', 'log比中央値', '差中央値', '片側日数', '異常日数'])
+    logs_df['robust_z'] = robust_z(logs_df['log比中央値'].to_numpy())
+    logs_df['異常端末'] = logs_df['robust_z'].abs() > RECONCILE_Z_THRESHOLD
+    anomalies = [result['anomalies'] for result in results if len(result['anomalies']) > 0]
+    if anomalies:
+        anomalies_df = pd.concat(anomalies, ignore_index=True).sort_values(['log', 'date'], ignore_index=True)
+    else:
+        anomalies_df = pd.DataFrame(columns=['log', 'date', 'dow', 'COCOAスコア', '算出スコア計', '差', 'log比',
+                                             '片側', 'robust_z'])
+    versions_df = logs_df.groupby(['platform', 'platform_version', 'app_version']).agg(
+        ログ数=('log', 'size'), log比中央値=('log比中央値', 'median'), 異常端末数=('異常端末', 'sum'))
+    return logs_df.sort_values('log'), anomalies_df, versions_df
+
+
+def write_report(logger, results, basename=None):
+    """全ログの突き合わせ結果をExcelに保存する
+
+    Args:
+        logger (logging): ロガー
+        results (list of dict): reconcile_log の結果
+        basename (str): ファイル名の先頭 default: cc.report_basename()
+
+    Returns:
+        (str): 作成したExcelファイル名 結果が無い場合はNone
+
+    """
+    if not results:
+        return None
+    logs_df, anomalies_df, versions_df = corpus_report(results)
+    logger.info(f"reconcile: {len(logs_df)} logs, {int(logs_df['異常端末'].sum())} anomalous devices, "
+                f"{len(anomalies_df)} anomalous days")
+    bookname = cc.unique_filename(f'{basename or cc.report_basename()}_reconcile', '.xlsx')
+    wb = cex.save_to_excel_multi(logger, bookname=bookname, dfs=[logs_df, anomalies_df, versions_df],
+                                 sheets=RECONCILE_SHEET_NAMES, indexes=[False, False, True])
+    cex.shape_a_sheets(logger, wb)
+    cex.save_book(logger, wb, bookname)
+    return bookname
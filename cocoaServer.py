@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Analysis Server
+
+    デスクトップアプリを導入せずにブラウザ/curlからcocoa logを分析するローカルHTTPサービス
+    (標準ライブラリのasyncioのみ 外部サービス不要)
+
+    API:
+        POST /analyze?name=exposure_data.json   body: exposure_data.json (.json.gz/.json.xz/.zipも可)
+            -> 200 {"job", "table", "log_information", "excel", "png"}
+            -> 400 正しいCOCOAログではない / 413 大きすぎる / 503 混雑 (Retry-After)
+        GET /reports/<job>/<file>   作成したExcel/PNG
+        GET /health                 {"pending", "capacity", "workers"}
+
+    分析はプロセスプールで実行し、イベントループはブロックしない (アップロードの保存もスレッドで行う)
+    受付中(実行中+待ち)の件数が上限を超えると503を返して負荷を呼び出し側に戻す
+    ジョブディレクトリは新しい --keep 件だけ残し、古いものと分析に失敗したものは削除する
+
+    Example:
+        python cocoaServer.py --port 8080 --jobs 2 --queue 16
+        curl --data-binary @exposure_data.json 'http://127.0.0.1:8080/analyze?name=exposure_data.json'
+
+"""
+import argparse
+import asyncio
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+
+import cocoaConfig as cc
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+RETRY_AFTER_SECONDS = 5
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def setup_args():
+    """"コマンドライン引数設定
+
+    Args:
+        None
+
+    Returns:
+        (argparse): parser
+
+    """
+    parser = argparse.ArgumentParser(description='Cocoa Log Analysis Server')
+    parser.add_argument('--host', default='127.0.0.1', help='listen address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='listen port (default: 8080)')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                        help='number of worker processes (default: cpu count)')
+    parser.add_argument('-q', '--queue', metavar='N', type=int, default=16,
+                        help='max requests accepted at once, running and waiting (default: 16)')
+    parser.add_argument('-o', '--output_dir', default='cocoa_reports',
+                        help='directory for uploaded logs and reports (default: cocoa_reports)')
+    parser.add_argument('-k', '--keep', metavar='N', type=int, default=64,
+                        help='number of job directories kept for /reports, older ones are removed (default: 64)')
+    return parser
+
+
+def init_worker(rolling_windows, fail_fast=False, max_errors=20, log_levels=None):
+    """ワーカープロセスの初期化 画面の無いバックエンドでグラフを描く
+
+    Args:
+        rolling_windows (list of int): cc.ROLLING_WINDOWS
+        fail_fast (bool): cc.VALIDATION_FAIL_FAST レコードの検証はワーカーで行う
+        max_errors (int): cc.VALIDATION_MAX_ERRORS
+        log_levels (dict): cc.LOG_LEVELS
+
+    Returns:
+        None
+
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    cc.ROLLING_WINDOWS = rolling_windows
+    cc.VALIDATION_FAIL_FAST = fail_fast
+    cc.VALIDATION_MAX_ERRORS = max_errors
+    cc.LOG_LEVELS = dict(log_levels or {})
+    return
+
+
+def analyze_upload(job_dir, upload_name):
+    """アップロードされたcocoa logを分析してExcel/PNGを作成する (ワーカープロセスで実行)
+
+    Args:
+        job_dir (str): アップロードしたログと出力を置くジョブディレクトリ
+        upload_name (str): ジョブディレクトリ内のログファイル名
+
+    Returns:
+        dict : table(日毎の集計), log_information, excel, png のファイル名
+               正しいログでない場合は error
+
+    """
+    import cocoa
+    import cocoaChart as ccht
+    import cocoaExcel as cex
+    import cocoaExport as cexp
+    import cocoaPipeline as cpl
+
+    logger = logging.getLogger(__name__)
+    cc.COCOA_LOG = os.path.join(job_dir, upload_name)
+    cc.COCOA_LOGS = []
+    merge_df = cocoa.update_dataframe(logger)
+    if merge_df is None:
+        return {'error': '正しいCOCOAログではありません', 'log_information': cc.COCOA_LOG_INFORMATION}
+
+    heatmaps = cocoa.build_heatmap_data(logger, cc.COCOA_SCAN_INSTANCES)
+    bookname = cex.create_cocoa_excel(logger, merge_df, heatmaps=heatmaps,
+                                      device_dfs=cc.COCOA_DEVICE_DFS,
+                                      basename=os.path.join(job_dir, 'COCOA_LOG_CHECKER'),
+                                      rollups=cpl.stage(logger, 'rollups'))
+    png = os.path.join(job_dir, 'cocoa_chart.png')
+    resolution, chart_df = cpl.resolution_view(logger)
+    ccht.draw_cocoa_charts(logger, chart_df, filename=png)
+    table = json.loads(cexp.flatten_columns(merge_df).to_json(orient='records', force_ascii=False))
+    return {'table': table, 'log_information': cc.COCOA_LOG_INFORMATION,
+            'excel': os.path.basename(bookname), 'png': os.path.basename(png)}
+
+
+def save_upload(job_dir, upload_name, body):
+    """アップロードされたログをジョブディレクトリに保存する (イベントループの外のスレッドで実行)"""
+    os.makedirs(job_dir)
+    with open(os.path.join(job_dir, upload_name), 'wb') as f:
+        f.write(body)
+    return
+
+
+async def retire_job(state, job, keep=True):
+    """終わったジョブを記録し、state['keep'] 件を超えた古いジョブディレクトリを削除する
+
+    Args:
+        state (dict): サーバの状態
+        job (str): ジョブID
+        keep (bool): Falseの場合は /reports で参照しないのですぐに削除する
+
+    Returns:
+        None
+
+    """
+    expired = [job]
+    if keep:
+        state['finished'].append(job)
+        expired = []
+        while len(state['finished']) > state['keep']:
+            expired.append(state['finished'].popleft())
+    for old in expired:
+        await asyncio.to_thread(shutil.rmtree, os.path.join(state['output_dir'], old), ignore_errors=True)
+    return
+
+
+def create_state(output_dir, jobs=None, capacity=16, keep=64):
+    """サーバの状態 (プロセスプールと受付件数)
+
+    Args:
+        output_dir (str): アップロードしたログと出力のディレクトリ
+        jobs (int): ワーカープロセス数 Noneはcpu数
+        capacity (int): 同時に受け付ける件数(実行中+待ち)
+        keep (int): 残すジョブディレクトリの数
+
+    Returns:
+        dict : output_dir, jobs, capacity, keep, pending, finished(残しているジョブ), executor
+
+    """
+    jobs = jobs or os.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                   initargs=(cc.ROLLING_WINDOWS, cc.VALIDATION_FAIL_FAST,
+                                             cc.VALIDATION_MAX_ERRORS, cc.LOG_LEVELS))
+    return {'output_dir': output_dir, 'jobs': jobs, 'capacity': capacity, 'keep': max(keep, 0),
+            'pending': 0, 'finished': deque(), 'executor': executor}
+
+
+async def handle_client(logger, state, reader, writer):
+    """1接続1リクエストを処理する
+
+    Args:
+        logger (logging): ロガー
+        state (dict): create_stateで作成したサーバの状態
+        reader (StreamReader): 接続のreader
+        writer (StreamWriter): 接続のwriter
+
+    Returns:
+        None
+
+    """
+    try:
+        method, target, headers = await read_request_head(reader)
+        url = urlsplit(target)
+        if url.path == '/analyze':
+            status, body, content_type, extra = await analyze(logger, state, method, url, headers, reader)
+        elif url.path.startswith('/reports/'):
+            status, body, content_type, extra = await report(state, method, url.path)
+        elif url.path == '/health':
+            status, body, content_type, extra = json_response(
+                200, {'pending': state['pending'], 'capacity': state['capacity'], 'workers': state['jobs']})
+        else:
+            status, body, content_type, extra = json_response(404, {'error': 'not found'})
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        status, body, content_type, extra = json_response(400, {'error': f'bad request: {e}'})
+    except Exception as e:
+        stack_trace = traceback.format_exc()
+        logger.info(f"Catch Exception: {e}\nSTACK_TRACE:\n{stack_trace}")
+        status, body, content_type, extra = json_response(500, {'error': str(e)})
+    try:
+        await write_response(writer, status, body, content_type, extra)
+    except ConnectionError:
+        pass
+    return
+
+
+async def analyze(logger, state, method, url, headers, reader):
+    """POST /analyze 混雑時はボディを読まずに503を返す
+
+    Args:
+        logger (logging): ロガー
+        state (dict): サーバの状態
+        method (str): HTTPメソッド
+        url (SplitResult): リクエストURL
+        headers (dict): リクエストヘッダ
+        reader (StreamReader): 接続のreader
+
+    Returns:
+        tuple : (status, body, content_type, extra_headers)
+
+    """
+    if method != 'POST':
+        return json_response(405, {'error': 'POST only'})
+    length = int(headers.get('content-length', '0'))
+    if length <= 0:
+        return json_response(400, {'error': 'empty body'})
+    if length > MAX_UPLOAD_BYTES:
+        return json_response(413, {'error': f'upload larger than {MAX_UPLOAD_BYTES} bytes'})
+    if state['pending'] >= state['capacity']:
+        return json_response(503, {'error': 'busy, retry later'},
+                             {'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+    state['pending'] += 1
+    try:
+        body = await reader.readexactly(length)
+        name = parse_qs(url.query).get('name', ['exposure_data.json'])[0]
+        upload_name = os.path.basename(name) or 'exposure_data.json'
+        job = uuid.uuid4().hex
+        job_dir = os.path.join(state['output_dir'], job)
+        await asyncio.to_thread(save_upload, job_dir, upload_name, body)
+        del body
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(state['executor'], analyze_upload, job_dir, upload_name)
+        except Exception:
+            await retire_job(state, job, keep=False)
+            raise
+    finally:
+        state['pending'] -= 1
+
+    result['job'] = job
+    if 'error' in result:
+        await retire_job(state, job, keep=False)
+        return json_response(400, result)
+    await retire_job(state, job)
+    result['excel'] = f"/reports/{job}/{result['excel']}"
+    result['png'] = f"/reports/{job}/{result['png']}"
+    logger.info(f'analyzed job {job}: {len(result["table"])} days')
+    return json_response(200, result)
+
+
+def load_report(filename):
+    """作成したExcel/PNGを読む (イベントループの外のスレッドで実行) 無い場合はNone"""
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+async def report(state, method, path):
+    """GET /reports/<job>/<file>
+
+    Args:
+        state (dict): サーバの状態
+        method (str): HTTPメソッド
+        path (str): リクエストパス
+
+    Returns:
+        tuple : (status, body, content_type, extra_headers)
+
+    """
+    if method != 'GET':
+        return json_response(405, {'error': 'GET only'})
+    parts = path.split('/')
+    if len(parts) != 4 or not JOB_ID_PATTERN.match(parts[2]) or parts[3] != os.path.basename(parts[3]):
+        return json_response(404, {'error': 'not found'})
+    filename = os.path.join(state['output_dir'], parts[2], parts[3])
+    body = await asyncio.to_thread(load_report, filename)
+    if body is None:
+        return json_response(404, {'error': 'not found'})
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return 200, body, content_type, {}
+
+
+async def serve(logger, state, host, port):
+    """サーバを起動して停止されるまで処理する
+
+    Args:
+        logger (logging): ロガー
+        state (dict): サーバの状態
+        host (str): listen address
+        port (int): listen port
+
+    Returns:
+        None
+
+    """
+    server = await asyncio.start_server(partial(handle_client, logger, state), host, port)
+    logger.info(f"serving on http://{host}:{port} workers: {state['jobs']} capacity: {state['capacity']}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        state['executor'].shutdown(wait=False, cancel_futures=True)
+    return
+
+
+async def read_request_head(reader):
+    """リクエスト行とヘッダを読む
+
+    Args:
+        reader (StreamReader): 接続のreader
+
+    Returns:
+        (str): method
+        (str): target
+        (dict): 小文字のヘッダ名をキーにしたヘッダ
+
+    """
+    request_line = await reader.readline()
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise ValueError('invalid request line')
+    method, target, version = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, sep, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+def json_response(status, data, extra=None):
+    """JSONレスポンスの (status, body, content_type, extra_headers)"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return status, body, 'application/json; charset=utf-8', extra or {}
+
+
+async def write_response(writer, status, body, content_type, extra):
+    """HTTP/1.1 レスポンスを書いて接続を閉じる"""
+    head = [f'HTTP/1.1 {status} {HTTP_STATUS.get(status, "")}',
+            f'Content-Type: {content_type}',
+            f'Content-Length: {len(body)}',
+            'Connection: close']
+    head.extend(f'{key}: {value}' for key, value in extra.items())
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+def main(logger, args):
+    """Cocoa Log Analysis Server Main
+
+    Args:
+        logger (logging): ロガー
+        args (Namespace): コマンドライン引数
+
+    Returns:
+        None
+
+    """
+    state = create_state(args.output_dir, jobs=args.jobs, capacity=args.queue, keep=args.keep)
+    try:
+        asyncio.run(serve(logger, state, args.host, args.port))
+    except KeyboardInterrupt:
+        logger.info('server stopped')
+    return
+
+
+if __name__ == '__main__':
+    logger = cc.create_logger()
+    parser = setup_args()
+    main(logger, parser.parse_args())
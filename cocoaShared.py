@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Shared Columns
+
+    cocoa.build_scan_instance_columns の列形式配列をプロセス間で受け渡す
+
+    配列は multiprocessing.shared_memory のブロックにコピーし、
+    他のプロセスへはブロック名・dtype・shapeだけの小さなハンドルを渡す
+    受け取ったプロセスはコピーせずにnumpy配列としてアタッチする
+
+    ブロックは作成したプロセスが終了しても残るので、全ての利用が終わったら
+    親プロセスが unlink_columns で解放する
+
+    Note:
+        object配列(distance)は固定長のunicode配列にして共有する
+
+"""
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+def ensure_tracker():
+    """プロセスプール作成前に親プロセスでresource trackerを起動する
+
+    ワーカーが親と同じtrackerを使うので、ワーカーで作成したブロックを親がunlinkしても
+    ワーカー終了時にリークとして警告・削除されない
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    """
+    resource_tracker.ensure_running()
+    return
+
+
+def share_columns(columns):
+    """列形式配列を共有メモリにコピーする
+
+    Args:
+        columns (dict): 列名をキーにしたnumpy配列
+
+    Returns:
+        dict : 列名をキーにした (ブロック名, dtype, shape) のハンドル pickle可能
+
+    """
+    handle = {}
+    for name, array in columns.items():
+        array = np.asarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        handle[name] = (shm.name, array.dtype.str, array.shape)
+        shm.close()
+    return handle
+
+
+def attach_columns(handle):
+    """共有メモリの列形式配列にアタッチする (コピーしない)
+
+    Args:
+        handle (dict): share_columnsで作成したハンドル
+
+    Returns:
+        dict : 列名をキーにしたnumpy配列 (共有メモリのビュー)
+        list : SharedMemory 配列を使い終わったら close_blocks で閉じる
+
+    """
+    columns = {}
+    blocks = []
+    for name, (shm_name, dtype, shape) in handle.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        columns[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        blocks.append(shm)
+    return columns, blocks
+
+
+def close_blocks(blocks):
+    """アタッチしたブロックを閉じる 配列(ビュー)の参照は先に削除しておくこと
+
+    Args:
+        blocks (list of SharedMemory): attach_columnsで返されたブロック
+
+    Returns:
+        None
+
+    """
+    for shm in blocks:
+        shm.close()
+    return
+
+
+def unlink_columns(handle):
+    """共有メモリのブロックを解放する
+
+    Args:
+        handle (dict): share_columnsで作成したハンドル
+
+    Returns:
+        None
+
+    """
+    for shm_name, dtype, shape in handle.values():
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+    return
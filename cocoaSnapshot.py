@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Snapshot
+
+    一度読んだcocoa logの列形式配列を、ログと同じフォルダのバイナリファイルに保存する
+    次に同じログを開くときはJSONをデコードせず np.memmap で配列を読み込む
+
+    ファイル名: <cocoa log>.snapshot  ex: exposure_data.json.snapshot
+
+    ファイル形式:
+        SNAPSHOT_MAGIC (8 bytes)
+        header長 (uint32 little endian)
+        header (JSON utf-8)
+            version, source_size, source_mtime_ns, log_information,
+            sections: {名前: [offset, 件数]} offsetはheaderの後のSNAPSHOT_ALIGN境界からの位置
+        scan_instances  SCAN_INSTANCE_DTYPE の固定長構造体配列
+        windows         int64 (exposure windowのDateMillisSinceEpoch)
+        daily_summaries DAILY_SUMMARY_DTYPE の固定長構造体配列
+        各セクションは SNAPSHOT_ALIGN バイト境界から始まる
+
+    ログのサイズと更新時刻がheaderに記録したものと一致する場合だけ使う
+    スコア(distance, score, mindb_score)は保存せず読み込み後に計算する
+
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_MAGIC = b'COCOASNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGN = 64
+SCAN_INSTANCE_DTYPE = np.dtype([('millis', '<i8'), ('db', '<i8'), ('mindb', '<i8'), ('duration', '<i8')])
+WINDOW_DTYPE = np.dtype('<i8')
+DAILY_SUMMARY_DTYPE = np.dtype([('millis', '<i8'), ('cocoa_score', '<f8')])
+
+
+def snapshot_filename(filename):
+    """cocoa logのスナップショットファイル名"""
+    return filename + SNAPSHOT_SUFFIX
+
+
+def aligned(offset):
+    """SNAPSHOT_ALIGNバイト境界に切り上げる"""
+    return -(-offset // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+
+def save_snapshot(logger, filename, columns, summary_columns, log_information):
+    """列形式配列をスナップショットに保存する 保存できない場合は何もしない
+
+    Args:
+        logger (logging): ロガー
+        filename (str): cocoa log ファイル名
+        columns (dict): スキャンインスタンスの列形式配列 millis, db, mindb, duration, window_millis
+        summary_columns (dict): daily summaryの列形式配列 millis, cocoa_score
+        log_information (list of str): cc.COCOA_LOG_INFORMATION
+
+    Returns:
+        (str): 保存したスナップショットファイル名 保存できない場合はNone
+
+    """
+    scans = np.empty(len(columns['millis']), dtype=SCAN_INSTANCE_DTYPE)
+    for name in SCAN_INSTANCE_DTYPE.names:
+        scans[name] = columns[name]
+    windows = np.asarray(columns['window_millis'], dtype=WINDOW_DTYPE)
+    summaries = np.empty(len(summary_columns['millis']), dtype=DAILY_SUMMARY_DTYPE)
+    for name in DAILY_SUMMARY_DTYPE.names:
+        summaries[name] = summary_columns[name]
+    arrays = [('scan_instances', scans), ('windows', windows), ('daily_summaries', summaries)]
+
+    snapname = snapshot_filename(filename)
+    tmpname = f'{snapname}.{os.getpid()}.tmp'
+    try:
+        st = os.stat(filename)
+        header = {'version': SNAPSHOT_VERSION, 'source_size': st.st_size,
+                  'source_mtime_ns': st.st_mtime_ns, 'log_information': log_information}
+        sections = {}
+        offset = 0
+        for name, array in arrays:
+            sections[name] = [offset, len(array)]
+            offset = aligned(offset + array.nbytes)
+        header['sections'] = sections
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_offset = aligned(len(SNAPSHOT_MAGIC) + 4 + len(header_bytes))
+        with open(tmpname, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+            for name, array in arrays:
+                f.seek(data_offset + sections[name][0])
+                f.write(array.tobytes())
+        os.replace(tmpname, snapname)
+    except OSError as e:
+        logger.info(f'スナップショットを保存できません: {snapname} {e}')
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        return None
+    logger.info(f'snapshot saved: {snapname} ({len(scans)} scan instances)')
+    return snapname
+
+
+def read_header(snapname):
+    """スナップショットのheaderを読む
+
+    Args:
+        snapname (str): スナップショットファイル名
+
+    Returns:
+        dict : header data_offset(セクションの開始位置)を追加する 形式が違う場合はNone
+
+    """
+    with open(snapname, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return None
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header.get('version') != SNAPSHOT_VERSION:
+        return None
+    header['data_offset'] = aligned(len(SNAPSHOT_MAGIC) + 4 + header_len)
+    return header
+
+
+def map_section(snapname, header, name, dtype):
+    """セクションをnp.memmapで読み込む (ページは参照されるまで読まれない)"""
+    offset, count = header['sections'][name]
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(snapname, dtype=dtype, mode='r', offset=header['data_offset'] + offset, shape=(count,))
+
+
+def load_snapshot(logger, filename):
+    """cocoa logより新しいスナップショットが有れば列形式配列を読み込む
+
+    Args:
+        logger (logging): ロガー
+        filename (str): cocoa log ファイル名
+
+    Returns:
+        tuple : (columns, summary_columns, log_information)
+                columns: millis, db, mindb, duration, window_millis
+                summary_columns: millis, cocoa_score
+                使えるスナップショットが無い場合はNone
+
+    """
+    snapname = snapshot_filename(filename)
+    try:
+        st = os.stat(filename)
+        if not os.path.exists(snapname):
+            return None
+        header = read_header(snapname)
+        if header is None or (header['source_size'], header['source_mtime_ns']) != (st.st_size, st.st_mtime_ns):
+            logger.info(f'snapshot is stale: {snapname}')
+            return None
+        scans = map_section(snapname, header, 'scan_instances', SCAN_INSTANCE_DTYPE)
+        windows = map_section(snapname, header, 'windows', WINDOW_DTYPE)
+        summaries = map_section(snapname, header, 'daily_summaries', DAILY_SUMMARY_DTYPE)
+    except (OSError, ValueError, KeyError) as e:
+        logger.info(f'スナップショットを読めません: {snapname} {e}')
+        return None
+    columns = {name: scans[name] for name in SCAN_INSTANCE_DTYPE.names}
+    columns['window_millis'] = windows
+    summary_columns = {name: summaries[name] for name in DAILY_SUMMARY_DTYPE.names}
+    logger.info(f'snapshot loaded: {snapname} ({len(scans)} scan instances)')
+    return columns, summary_columns, header['log_information']
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Population Statistics
+
+    多数のcocoa logの日毎の値(COCOAスコア, 算出スコア計, 接触時間計(分))の分布を
+    分位数スケッチで集計し、ある日の値が全体の何パーセンタイルかを求める
+
+    スケッチは対数バケット(DDSketch方式)のヒストグラム
+    - 分位数の相対誤差は STATS_ACCURACY 以内 (バケット数が STATS_MAX_BUCKETS を超えて小さい値のバケットを
+      まとめた場合は、まとめた範囲だけ誤差が大きくなる)
+    - バケットの件数を足すだけでマージできるので、並列のワーカーで作ったスケッチを順序によらず同じ結果にまとめられる
+    - メモリはバケット数で決まり、集計したログや日数によらない
+
+    統計ファイル(JSON):
+        version, logs(集計したログ数), days(集計した日数),
+        metrics: {名前: スケッチ} スケッチは accuracy, count, zero(0以下の件数), min, max,
+                 indexes, counts (バケット番号と件数)
+
+    同じログを2回集計すると2回数える
+
+"""
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+STATS_VERSION = 1
+STATS_ACCURACY = 0.01  # 分位数の相対誤差
+STATS_MAX_BUCKETS = 2048  # スケッチ1つのバケット数の上限
+STATS_MIN_VALUE = 1e-9  # これ以下の値は0として数える
+
+# 分布を集計する値: (名前, merge_dfのカラム, パーセンタイルのカラム)
+STATS_METRICS = [('cocoa_score', ('sum', 'cocoa_score', 'cocoa_score'),
+                  ('percentile', 'cocoa_score', 'COCOAスコア百分位')),
+                 ('calc_score', ('calc_score_sum', 'score', '算出スコア計'),
+                  ('percentile', 'score', '算出スコア百分位')),
+                 ('exposure_minutes', ('exposure_minutes', 'duration', '接触時間計(分)'),
+                  ('percentile', 'duration', '接触時間百分位'))]
+
+
+def new_sketch(accuracy=STATS_ACCURACY):
+    """空のスケッチ
+
+    Args:
+        accuracy (float): 分位数の相対誤差
+
+    Returns:
+        dict : accuracy, count, zero, min, max, buckets(バケット番号をキーにした件数)
+
+    """
+    return {'accuracy': accuracy, 'count': 0, 'zero': 0, 'min': None, 'max': None, 'buckets': {}}
+
+
+def sketch_gamma(sketch):
+    """バケットの幅 (隣のバケットとの値の比)"""
+    return (1 + sketch['accuracy']) / (1 - sketch['accuracy'])
+
+
+def bucket_indexes(sketch, values):
+    """正の値のバケット番号 バケットiは (gamma^(i-1), gamma^i] の値"""
+    return np.ceil(np.log(values) / math.log(sketch_gamma(sketch))).astype(np.int64)
+
+
+def collapse_buckets(sketch):
+    """バケット数が STATS_MAX_BUCKETS を超えた場合は、小さい値のバケットを次のバケットにまとめる"""
+    buckets = sketch['buckets']
+    if len(buckets) <= STATS_MAX_BUCKETS:
+        return
+    indexes = sorted(buckets)
+    excess = len(indexes) - STATS_MAX_BUCKETS
+    target = indexes[excess]
+    for index in indexes[:excess]:
+        buckets[target] += buckets.pop(index)
+    return
+
+
+def update_sketch(sketch, values):
+    """スケッチに値を追加する NaNは除き、STATS_MIN_VALUE以下は0として数える
+
+    Args:
+        sketch (dict): new_sketchで作成したスケッチ
+        values (array like): 値
+
+    Returns:
+        dict : sketch
+
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return sketch
+    positive = values[values > STATS_MIN_VALUE]
+    sketch['count'] += int(values.size)
+    sketch['zero'] += int(values.size - positive.size)
+    low, high = float(values.min()), float(values.max())
+    sketch['min'] = low if sketch['min'] is None else min(sketch['min'], low)
+    sketch['max'] = high if sketch['max'] is None else max(sketch['max'], high)
+    indexes, counts = np.unique(bucket_indexes(sketch, positive), return_counts=True)
+    buckets = sketch['buckets']
+    for index, count in zip(indexes.tolist(), counts.tolist()):
+        buckets[index] = buckets.get(index, 0) + count
+    collapse_buckets(sketch)
+    return sketch
+
+
+def merge_sketch(sketch, other):
+    """otherの件数をsketchに足す (順序によらず同じ結果になる)
+
+    Args:
+        sketch (dict): マージ先のスケッチ
+        other (dict): マージするスケッチ 相対誤差が同じもの
+
+    Returns:
+        dict : sketch
+
+    """
+    if sketch['accuracy'] != other['accuracy']:
+        raise ValueError(f"accuracy mismatch: {sketch['accuracy']} != {other['accuracy']}")
+    sketch['count'] += other['count']
+    sketch['zero'] += other['zero']
+    for key, pick in (('min', min), ('max', max)):
+        if other[key] is not None:
+            sketch[key] = other[key] if sketch[key] is None else pick(sketch[key], other[key])
+    buckets = sketch['buckets']
+    for index, count in other['buckets'].items():
+        buckets[index] = buckets.get(index, 0) + count
+    collapse_buckets(sketch)
+    return sketch
+
+
+def quantile(sketch, q):
+    """分位数
+
+    Args:
+        sketch (dict): スケッチ
+        q (float): 0 ~ 1
+
+    Returns:
+        float : 分位数 (相対誤差 accuracy 以内) 空の場合はNone
+
+    """
+    if sketch['count'] == 0:
+        return None
+    rank = q * (sketch['count'] - 1)
+    if rank < sketch['zero']:
+        return 0.0
+    gamma = sketch_gamma(sketch)
+    seen = sketch['zero']
+    for index in sorted(sketch['buckets']):
+        seen += sketch['buckets'][index]
+        if seen > rank:
+            value = 2 * gamma ** index / (gamma + 1)
+            return min(max(value, sketch['min']), sketch['max'])
+    return sketch['max']
+
+
+def percentile_ranks(sketch, values):
+    """値が分布の何パーセンタイルか (その値以下の割合 * 100)
+
+    Args:
+        sketch (dict): スケッチ
+        values (array like): 値
+
+    Returns:
+        ndarray : 0 ~ 100 スケッチが空の場合とNaNはNaN
+
+    """
+    values = np.asarray(values, dtype=np.float64)
+    ranks = np.full(values.shape, np.nan)
+    if sketch['count'] == 0:
+        return ranks
+    indexes = np.array(sorted(sketch['buckets']), dtype=np.int64)
+    cumulative = np.cumsum([sketch['buckets'][index] for index in indexes.tolist()], dtype=np.float64)
+    valid = ~np.isnan(values)
+    positive = valid & (values > STATS_MIN_VALUE)
+    ranks[valid & ~positive] = sketch['zero']
+    if positive.any() and len(indexes) > 0:
+        position = np.searchsorted(indexes, bucket_indexes(sketch, values[positive]), side='right')
+        below = np.where(position > 0, cumulative[np.maximum(position - 1, 0)], 0.0)
+        ranks[positive] = sketch['zero'] + below
+    elif positive.any():
+        ranks[positive] = sketch['zero']
+    return ranks * 100 / sketch['count']
+
+
+def new_stats():
+    """空の統計 (STATS_METRICS毎のスケッチ)"""
+    return {'version': STATS_VERSION, 'logs': 0, 'days': 0,
+            'metrics': {name: new_sketch() for name, col, percentile_col in STATS_METRICS}}
+
+
+def update_stats(stats, merge_df):
+    """1つのログの日毎の集計を統計に追加する
+
+    Args:
+        stats (dict): new_stats/load_statsの統計
+        merge_df (DataFrame): 日毎のmerge_df または cocoa.build_daily_totals
+
+    Returns:
+        dict : stats
+
+    """
+    for name, col, percentile_col in STATS_METRICS:
+        update_sketch(stats['metrics'][name], merge_df[col].to_numpy(dtype=np.float64))
+    stats['logs'] += 1
+    stats['days'] += len(merge_df)
+    return stats
+
+
+def merge_stats(stats, other):
+    """otherの統計をstatsに足す (ワーカー毎の統計をまとめる)"""
+    for name, col, percentile_col in STATS_METRICS:
+        merge_sketch(stats['metrics'][name], other['metrics'][name])
+    stats['logs'] += other['logs']
+    stats['days'] += other['days']
+    return stats
+
+
+def stats_to_json(stats):
+    """統計をJSONにできる形にする (バケットは番号と件数のリスト)"""
+    metrics = {}
+    for name, sketch in stats['metrics'].items():
+        indexes = sorted(sketch['buckets'])
+        metrics[name] = {key: value for key, value in sketch.items() if key != 'buckets'}
+        metrics[name]['indexes'] = indexes
+        metrics[name]['counts'] = [sketch['buckets'][index] for index in indexes]
+    return {'version': stats['version'], 'logs': stats['logs'], 'days': stats['days'], 'metrics': metrics}
+
+
+def stats_from_json(data):
+    """stats_to_jsonの逆"""
+    metrics = {}
+    for name, sketch in data['metrics'].items():
+        metrics[name] = {key: value for key, value in sketch.items() if key not in ('indexes', 'counts')}
+        metrics[name]['buckets'] = dict(zip(sketch['indexes'], sketch['counts']))
+    return {'version': data['version'], 'logs': data['logs'], 'days': data['days'], 'metrics': metrics}
+
+
+def load_stats(logger, filename):
+    """統計ファイルを読む 無い場合や読めない場合は空の統計
+
+    Args:
+        logger (logging): ロガー
+        filename (str): 統計ファイル名
+
+    Returns:
+        dict : 統計
+
+    """
+    if not os.path.exists(filename):
+        return new_stats()
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != STATS_VERSION:
+            raise ValueError(f"version {data.get('version')}")
+        return stats_from_json(data)
+    except (OSError, ValueError, KeyError) as e:
+        logger.info(f'統計ファイルを読めません: {filename} {e}')
+        return new_stats()
+
+
+def save_stats(logger, stats, filename):
+    """統計ファイルを保存する (一時ファイルに書いてから置き換える)
+
+    Args:
+        logger (logging): ロガー
+        stats (dict): 統計
+        filename (str): 統計ファイル名
+
+    Returns:
+        None
+
+    """
+    tmpname = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname, 'w', encoding='utf-8') as f:
+        json.dump(stats_to_json(stats), f)
+    os.replace(tmpname, filename)
+    summary = ', '.join(f"{name} p50 {quantile(sketch, 0.5) or 0:,.1f} p99 {quantile(sketch, 0.99) or 0:,.1f}"
+                        for name, sketch in stats['metrics'].items())
+    logger.info(f"stats saved: {filename} ({stats['logs']} logs, {stats['days']} days) {summary}")
+    return
+
+
+def add_stats(logger, filename, others):
+    """ワーカーが作成した統計を統計ファイルに追加する
+
+    Args:
+        logger (logging): ロガー
+        filename (str): 統計ファイル名
+        others (list of dict): 追加する統計
+
+    Returns:
+        dict : 追加後の統計
+
+    """
+    stats = load_stats(logger, filename)
+    for other in others:
+        merge_stats(stats, other)
+    save_stats(logger, stats, filename)
+    return stats
+
+
+def percentile_frame(stats, df):
+    """dfの日毎の値のパーセンタイル
+
+    Args:
+        stats (dict): 統計
+        df (DataFrame): 日毎のmerge_df
+
+    Returns:
+        DataFrame : dfと同じindexで STATS_METRICS のパーセンタイルのカラム
+
+    """
+    frame = pd.DataFrame({percentile_col: percentile_ranks(stats['metrics'][name], df[col].to_numpy(dtype=np.float64))
+                          for name, col, percentile_col in STATS_METRICS}, index=df.index)
+    frame.columns = pd.MultiIndex.from_tuples(frame.columns)
+    return frame
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Text Report
+
+    --no_gui の場合に、GUIを開かずに表(merge_df)、ログ情報、閾値越えの日をテキストで出力する
+    ディスプレイの無いサーバ(ssh, コンテナ)で使う
+
+    PySimpleGUI/Tk, matplotlib, openpyxl はimportしない
+    (cocoa.main もこのモードではimportしない 起動時間は cocoaBenchmark.py startup で確認する)
+
+"""
+import sys
+
+import pandas as pd
+
+import cocoaConfig as cc
+import cocoaPipeline as cpl
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+TEXT_STDOUT = '-'  # 出力先が標準出力
+ALERT_COLUMNS = [(('sum', 'cocoa_score', 'cocoa_score'), 'COCOAスコア'),
+                 (('calc_score_sum', 'score', '算出スコア計'), '算出スコア計')]
+
+
+def table_headings(df):
+    """表の見出し (GUIの表と同じく3段目のカラム名)"""
+    headings = {'contact': '接触回数', 'cocoa_score': 'COCOAスコア'}
+    return [headings.get(col[2], col[2]) if isinstance(col, tuple) else col for col in df.columns]
+
+
+def alert_days(merge_df):
+    """COCOAスコアか算出スコア計が cc.COCOA_SCORE_THRESHOLD 以上の日
+
+    Args:
+        merge_df (DataFrame): 日毎のmerge_df
+
+    Returns:
+        DataFrame : (date, dow)をindexに COCOAスコア, 算出スコア計
+
+    """
+    alerts = pd.DataFrame({label: merge_df[col] for col, label in ALERT_COLUMNS}, index=merge_df.index)
+    return alerts[(alerts >= cc.COCOA_SCORE_THRESHOLD).any(axis=1)]
+
+
+def format_report(resolution, view_df, alerts_df, log_information):
+    """テキストのレポート
+
+    Args:
+        resolution (str): day/week/month
+        view_df (DataFrame): 表の集計 (cocoaPipeline.resolution_view)
+        alerts_df (DataFrame): alert_days
+        log_information (list of str): cc.COCOA_LOG_INFORMATION
+
+    Returns:
+        str : レポート
+
+    """
+    table = view_df.set_axis(table_headings(view_df), axis=1)
+    with pd.option_context('display.float_format', '{:,.1f}'.format, 'display.width', 1000,
+                           'display.max_rows', None, 'display.max_columns', None,
+                           'display.unicode.east_asian_width', True):
+        lines = [f'# ログ情報: {cc.COCOA_LOG}', *log_information, '',
+                 f'# 接触履歴 ({resolution})', table.to_string(), '',
+                 f'# スコア{cc.COCOA_SCORE_THRESHOLD}以上の日: {len(alerts_df)}']
+        if len(alerts_df) > 0:
+            lines.append(alerts_df.to_string())
+    return '\n'.join(lines) + '\n'
+
+
+def run_text_report(logger, output=TEXT_STDOUT):
+    """ログを集計してテキストのレポートを出力する
+
+    Args:
+        logger (logging): ロガー
+        output (str): 出力ファイル名 TEXT_STDOUT は標準出力
+
+    Returns:
+        str : レポート 正しいログでない場合はNone
+
+    """
+    resolution, view_df = cpl.resolution_view(logger)
+    if view_df is None:
+        logger.info(f'正しいCOCOAログではありません: {cc.COCOA_LOG}')
+        return None
+    report = format_report(resolution, view_df, alert_days(cpl.stage(logger, 'merge_df')),
+                           cc.COCOA_LOG_INFORMATION)
+    if output == TEXT_STDOUT:
+        sys.stdout.write(report)
+    else:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(report)
+        logger.info(f'レポートが作成されました: {output}')
+    return report
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Validation
+
+    exposure windows, scan instances, daily summaries の型と値の範囲を検証する
+
+    検証は cocoaPlatform で列形式配列を作る走査の中で行う
+    - 正常なログ: 作成した配列のdtypeと範囲を要素毎にまとめて確認するだけ (レコード毎の処理は無い)
+    - 不正な値が有る場合: 配列の確認で不正だった exposure window だけをレコード毎に確認し、
+      JSONパス付きのエラーを集める (正しいwindowは走査し直さない)
+        ex: $.exposure_windows[12].ScanInstances[3].TypicalAttenuationDb: 範囲外の値です -1
+    - キーが無い、オブジェクトでない等で配列にできない場合だけ、全てのレコードを走査し直す
+      (daily summaries は件数が少ないので不正な値が有る場合も全体を確認し直す)
+
+    cc.VALIDATION_FAIL_FAST が True の場合は最初のエラーで ValueError を送出し、
+    False の場合は不正なレコードを除いて集計を続ける
+    エラーは cc.VALIDATION_MAX_ERRORS 件まで記録する (件数は全て数える)
+
+"""
+import math
+
+import numpy as np
+
+import cocoaConfig as cc
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+# 値の範囲 (両端を含む)
+MILLIS_RANGE = (0, 4102444800000)  # 1970-01-01 ~ 2100-01-01
+ATTENUATION_RANGE = (0, 255)  # ENのAttenuationは1バイト
+DURATION_RANGE = (0, 86400)  # SecondsSinceLastScan
+WEIGHTED_DURATION_RANGE = (0.0, math.inf)
+
+
+def new_report(max_errors=None, fail_fast=None):
+    """検証結果
+
+    Args:
+        max_errors (int): 記録するエラーの上限 default: cc.VALIDATION_MAX_ERRORS
+        fail_fast (bool): 最初のエラーでValueErrorを送出する default: cc.VALIDATION_FAIL_FAST
+
+    Returns:
+        dict : errors(記録したエラー), count(エラー件数), skipped(除いたレコード数), max_errors, fail_fast
+
+    """
+    return {'errors': [], 'count': 0, 'skipped': 0,
+            'max_errors': cc.VALIDATION_MAX_ERRORS if max_errors is None else max_errors,
+            'fail_fast': cc.VALIDATION_FAIL_FAST if fail_fast is None else fail_fast}
+
+
+def add_error(report, path, message):
+    """エラーを記録する fail_fastの場合はValueErrorを送出する
+
+    Args:
+        report (dict): new_reportで作成した検証結果
+        path (str): JSONパス
+        message (str): エラー内容
+
+    Returns:
+        None
+
+    """
+    report['count'] += 1
+    if len(report['errors']) < report['max_errors']:
+        report['errors'].append(f'{path}: {message}')
+    if report['fail_fast']:
+        raise ValueError(f'{path}: {message}')
+    return
+
+
+def check_value(report, path, value, value_range, allow_float=False):
+    """1つの値の型と範囲を検証する
+
+    Args:
+        report (dict): 検証結果
+        path (str): JSONパス
+        value : 値
+        value_range (tuple): (最小, 最大)
+        allow_float (bool): 小数を許す
+
+    Returns:
+        bool : 正しい値の場合True
+
+    """
+    types = (int, float) if allow_float else (int,)
+    if isinstance(value, bool) or not isinstance(value, types):
+        add_error(report, path, f'数値ではありません {value!r}')
+        return False
+    if not (value_range[0] <= value <= value_range[1]):
+        add_error(report, path, f'範囲外の値です {value!r}')
+        return False
+    return True
+
+
+def in_range(values, value_range, kinds='iu'):
+    """配列のdtypeと値の範囲をまとめて確認する
+
+    Args:
+        values (ndarray): 配列
+        value_range (tuple): (最小, 最大)
+        kinds (str): 許すdtype.kind ex: 'iu' 整数, 'iuf' 数値
+
+    Returns:
+        bool : 全て正しい場合True
+
+    """
+    if values.size == 0:
+        return True
+    if values.dtype.kind not in kinds:
+        return False
+    return bool(values.min() >= value_range[0] and values.max() <= value_range[1])
+
+
+def as_array(items):
+    """値のリストを配列にする 整数以外が混ざる場合は元の型を残すためobject配列にする"""
+    values = np.array(items)
+    if values.dtype.kind not in 'iu':
+        values = np.array(items, dtype=object)
+    return values
+
+
+def valid_mask(values, value_range):
+    """配列の要素毎に型(整数)と範囲が正しいか
+
+    Args:
+        values (ndarray): as_arrayで作成した配列
+        value_range (tuple): (最小, 最大)
+
+    Returns:
+        ndarray : 要素毎のbool
+    """
+    if values.dtype.kind in 'iu':
+        return (values >= value_range[0]) & (values <= value_range[1])
+    is_int = np.frompyfunc(lambda value: isinstance(value, int) and not isinstance(value, bool), 1, 1)
+    mask = is_int(values).astype(bool)
+    checked = values[mask]
+    mask[mask] = (checked >= value_range[0]) & (checked <= value_range[1])
+    return mask
+
+
+def summary_millis_range(adapter):
+    """daily summaryの日付の範囲 (アダプタの単位)"""
+    scale = adapter['summary_millis_scale']
+    return MILLIS_RANGE[0] // scale, MILLIS_RANGE[1] // scale
+
+
+def scan_instance_columns(adapter, ews, report):
+    """exposure windowsをレコード毎に検証しながら列形式の配列にする
+
+    不正なscan instanceは除き、不正なexposure window(日時, ScanInstancesが不正)は丸ごと除く
+
+    Args:
+        adapter (dict): cocoaPlatformのアダプタ
+        ews (list): exposure windows
+        report (dict): 検証結果
+
+    Returns:
+        ndarray : window_millis
+        list : exposure window毎のscan instance数
+        ndarray : (db, mindb, duration) の2次元配列
+
+    """
+    keys = adapter['keys']
+    root = f"$.{keys['windows']}"
+    window_millis = []
+    counts = []
+    values = []
+    if not isinstance(ews, list):
+        add_error(report, root, 'リストではありません')
+        ews = []
+    for i, ew in enumerate(ews):
+        flags = check_window(adapter, ew, f'{root}[{i}]', report)
+        if flags is None:
+            continue
+        sis = [si for si, flag in zip(ew[keys['scan_instances']], flags) if flag]
+        values.extend((si[keys['db']], si[keys['mindb']], si[keys['duration']]) for si in sis)
+        window_millis.append(ew[keys['window_millis']])
+        counts.append(len(sis))
+    return (np.array(window_millis, dtype=np.int64), counts,
+            np.array(values, dtype=np.int64).reshape(-1, 3))
+
+
+def check_window(adapter, ew, path, report):
+    """1つのexposure windowをレコード毎に検証する
+
+    Args:
+        adapter (dict): cocoaPlatformのアダプタ
+        ew (dict): exposure window
+        path (str): exposure windowのJSONパス
+        report (dict): 検証結果
+
+    Returns:
+        list of bool : scan instance毎の正否 window自体が不正な場合はNone
+
+    """
+    keys = adapter['keys']
+    if not isinstance(ew, dict):
+        add_error(report, path, 'オブジェクトではありません')
+        report['skipped'] += 1
+        return None
+    if keys['window_millis'] not in ew:
+        add_error(report, f"{path}.{keys['window_millis']}", 'ありません')
+        report['skipped'] += 1
+        return None
+    if not check_value(report, f"{path}.{keys['window_millis']}", ew[keys['window_millis']], MILLIS_RANGE):
+        report['skipped'] += 1
+        return None
+    sis = ew.get(keys['scan_instances'])
+    if not isinstance(sis, list):
+        add_error(report, f"{path}.{keys['scan_instances']}", 'リストではありません')
+        report['skipped'] += 1
+        return None
+    fields = (('db', ATTENUATION_RANGE), ('mindb', ATTENUATION_RANGE), ('duration', DURATION_RANGE))
+    flags = []
+    for j, si in enumerate(sis):
+        si_path = f"{path}.{keys['scan_instances']}[{j}]"
+        if not isinstance(si, dict):
+            add_error(report, si_path, 'オブジェクトではありません')
+            report['skipped'] += 1
+            flags.append(False)
+            continue
+        valid = True
+        for name, value_range in fields:
+            if keys[name] not in si:
+                add_error(report, f'{si_path}.{keys[name]}', 'ありません')
+                valid = False
+            elif not check_value(report, f'{si_path}.{keys[name]}', si[keys[name]], value_range):
+                valid = False
+        if not valid:
+            report['skipped'] += 1
+        flags.append(valid)
+    return flags
+
+
+def filter_scan_instances(adapter, ews, window_millis, counts, values, report):
+    """作成済みの配列を要素毎に検証し、不正な値を含むexposure windowだけをレコード毎に検証して除く
+
+    Args:
+        adapter (dict): cocoaPlatformのアダプタ
+        ews (list): exposure windows
+        window_millis (ndarray): as_arrayで作成したexposure window毎の日時
+        counts (ndarray): exposure window毎のscan instance数
+        values (ndarray): as_arrayで作成した (db, mindb, duration) の2次元配列
+        report (dict): 検証結果
+
+    Returns:
+        ndarray : window_millis
+        ndarray : exposure window毎のscan instance数
+        ndarray : (db, mindb, duration) の2次元配列
+
+    """
+    window_ok = valid_mask(window_millis, MILLIS_RANGE)
+    si_ok = valid_mask(values[:, :2], ATTENUATION_RANGE).all(axis=1) & valid_mask(values[:, 2], DURATION_RANGE)
+    if window_ok.all() and si_ok.all():
+        return window_millis, counts, values
+    window_of = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    root = f"$.{adapter['keys']['windows']}"
+    for i in np.union1d(np.flatnonzero(~window_ok), window_of[~si_ok]):
+        flags = check_window(adapter, ews[i], f'{root}[{i}]', report)
+        window_ok[i] = flags is not None
+        if flags is not None:
+            si_ok[starts[i]:starts[i] + counts[i]] = flags
+    keep = si_ok & window_ok[window_of]
+    counts = np.bincount(window_of[keep], minlength=len(counts))[window_ok]
+    return (window_millis[window_ok].astype(np.int64), counts,
+            values[keep].astype(np.int64).reshape(-1, 3))
+
+
+def daily_summary_columns(adapter, dss, report):
+    """daily summariesをレコード毎に検証しながら列形式の配列にする 不正なものは除く
+
+    Args:
+        adapter (dict): cocoaPlatformのアダプタ
+        dss (list): daily summaries
+        report (dict): 検証結果
+
+    Returns:
+        ndarray : 日付 (アダプタの単位 millisに変換する前)
+        ndarray : cocoa_score (WeightedDurationSum)
+
+    """
+    keys = adapter['keys']
+    root = f"$.{keys['summaries']}"
+    millis_range = summary_millis_range(adapter)
+    millis = []
+    scores = []
+    if not isinstance(dss, list):
+        add_error(report, root, 'リストではありません')
+        dss = []
+    for i, ds in enumerate(dss):
+        path = f'{root}[{i}]'
+        if not isinstance(ds, dict):
+            add_error(report, path, 'オブジェクトではありません')
+            report['skipped'] += 1
+            continue
+        day_summary = ds.get(keys['day_summary'])
+        day_path = f"{path}.{keys['day_summary']}"
+        valid = True
+        if keys['summary_millis'] not in ds:
+            add_error(report, f"{path}.{keys['summary_millis']}", 'ありません')
+            valid = False
+        elif not check_value(report, f"{path}.{keys['summary_millis']}", ds[keys['summary_millis']], millis_range):
+            valid = False
+        if not isinstance(day_summary, dict):
+            add_error(report, day_path, 'オブジェクトではありません')
+            valid = False
+        elif keys['weighted_duration'] not in day_summary:
+            add_error(report, f"{day_path}.{keys['weighted_duration']}", 'ありません')
+            valid = False
+        elif not check_value(report, f"{day_path}.{keys['weighted_duration']}",
+                             day_summary[keys['weighted_duration']], WEIGHTED_DURATION_RANGE, allow_float=True):
+            valid = False
+        if not valid:
+            report['skipped'] += 1
+            continue
+        millis.append(ds[keys['summary_millis']])
+        scores.append(day_summary[keys['weighted_duration']])
+    return np.array(millis, dtype=np.int64), np.array(scores, dtype=np.float64)
+
+
+def log_report(logger, report, log_information):
+    """検証結果をログとログ情報に出力する エラーが無い場合は何もしない
+
+    Args:
+        logger (logging): ロガー
+        report (dict): 検証結果
+        log_information (list of str): cc.COCOA_LOG_INFORMATION 件数と記録したエラーを追加する
+
+    Returns:
+        None
+
+    """
+    if report['count'] == 0:
+        return
+    logger.info(f"invalid records: {report['count']} errors, {report['skipped']} records skipped")
+    for error in report['errors']:
+        logger.info(f'invalid: {error}')
+    log_information.append(f"# of invalid records: {report['count']} (skipped {report['skipped']})")
+    log_information.extend(f'invalid: {error}' for error in report['errors'])
+    if report['count'] > len(report['errors']):
+        log_information.append(f"invalid: ... {report['count'] - len(report['errors'])} more")
+    return
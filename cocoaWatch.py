@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cocoa Log Watch Folder
+
+    共有フォルダに置かれたcocoa logを自動で分析し、同じフォルダにExcelを作成する
+
+    - フォルダを定期的に走査する(標準ライブラリのみ inotify等は使わない)
+    - 書き込み途中のファイルは、サイズと更新時刻が WATCH_SETTLE_SECONDS 変化しなくなるまで待つ
+    - 分析は cocoaBatch.build_report をプロセスプールで実行する
+    - 処理済みファイル(パス, サイズ, 更新時刻)は WATCH_RECORD_NAME に追記し、再起動後も再処理しない
+      内容が置き換わった(サイズ/更新時刻が変わった)ファイルは再処理する
+    - 分析中の例外(MemoryError等)で失敗したファイルは error 付きで記録する
+    - ワーカーが異常終了してプロセスプールが壊れた場合は作り直して監視を続ける
+      その時に実行中/待ちだったファイルは巻き添えの可能性があるので記録せず、新しいプールで1つずつ再実行する
+      単独で実行してもプールを壊した(WATCH_MAX_ATTEMPTS 回失敗した)ファイルだけを error 付きで記録する
+
+"""
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cocoaBatch as cb
+import cocoaConfig as cc
+import cocoaStats as cstat
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+WATCH_POLL_SECONDS = 2
+WATCH_SETTLE_SECONDS = 5
+WATCH_RECORD_NAME = '.cocoa_processed.jsonl'
+WATCH_SUFFIXES = ('.json', '.json.gz', '.json.xz', '.zip')
+WATCH_MAX_ATTEMPTS = 2  # プールを壊した回数 1回目は巻き添えの可能性があり、2回目は単独で実行した結果
+
+
+def scan_candidates(directory):
+    """フォルダ内のcocoa logらしいファイルを返す
+
+    Args:
+        directory (str): 監視するフォルダ
+
+    Yields:
+        tuple : (path, size, mtime_ns)
+
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            if not entry.name.lower().endswith(WATCH_SUFFIXES):
+                continue
+            st = entry.stat()
+            yield entry.path, st.st_size, st.st_mtime_ns
+
+
+def load_processed(record_file):
+    """処理済みの記録を読む
+
+    Args:
+        record_file (str): 処理済み記録ファイル
+
+    Returns:
+        set : (path, size, mtime_ns) の集合
+
+    """
+    processed = set()
+    if not os.path.exists(record_file):
+        return processed
+    with open(record_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                processed.add((record['path'], record['size'], record['mtime_ns']))
+            except (ValueError, KeyError):
+                continue  # 書き込み途中で止まった行
+    return processed
+
+
+def is_settled(observed, previous, now_ns):
+    """書き込みが終わったとみなせるか
+
+    前回の走査からサイズと更新時刻が変わっておらず、更新からWATCH_SETTLE_SECONDS経っている
+
+    Args:
+        observed (tuple): 今回の (path, size, mtime_ns)
+        previous (tuple): 前回の (path, size, mtime_ns) 初めて見た場合はNone
+        now_ns (int): 現在時刻 time.time_ns()
+
+    Returns:
+        bool
+
+    """
+    return observed == previous and now_ns - observed[2] >= WATCH_SETTLE_SECONDS * 1_000_000_000
+
+
+def create_executor(jobs=None):
+    """親プロセスのコマンドライン設定を引き継ぐプロセスプール
+
+    Args:
+        jobs (int): ワーカープロセス数 Noneはcpu数
+
+    Returns:
+        (ProcessPoolExecutor): プロセスプール
+
+    """
+    return ProcessPoolExecutor(max_workers=jobs, initializer=cb.init_worker,
+                               initargs=(cc.ROLLING_WINDOWS, cc.EXCEL_DETAIL, (), cc.RESOLUTION,
+                                         cc.STATS_FILE, False, cc.VALIDATION_FAIL_FAST,
+                                         cc.VALIDATION_MAX_ERRORS, cc.LOG_LEVELS))
+
+
+def write_record(record, candidate, bookname, error=None):
+    """処理済みの記録を1行追記する
+
+    Args:
+        record (file): 処理済み記録ファイル
+        candidate (tuple): (path, size, mtime_ns)
+        bookname (str): 作成したExcelファイル名 失敗はNone
+        error (str): ワーカーが異常終了した場合の例外
+
+    Returns:
+        None
+
+    """
+    line = {'path': candidate[0], 'size': candidate[1], 'mtime_ns': candidate[2], 'report': bookname}
+    if error is not None:
+        line['error'] = error
+    record.write(json.dumps(line, ensure_ascii=False) + '\n')
+    record.flush()
+    return
+
+
+def run_watch(logger, directory, jobs=None):
+    """フォルダを監視して新しいcocoa logを分析し続ける (Ctrl-Cで終了)
+
+    Args:
+        logger (logging): ロガー
+        directory (str): 監視するフォルダ
+        jobs (int): ワーカープロセス数 Noneはcpu数
+
+    Returns:
+        None
+
+    """
+    record_file = os.path.join(directory, WATCH_RECORD_NAME)
+    processed = load_processed(record_file)
+    logger.info(f'watching {directory}: {len(processed)} files already processed')
+    observed = {}    # path -> 前回の (path, size, mtime_ns)
+    in_flight = {}   # future -> (path, size, mtime_ns)
+    attempts = {}    # (path, size, mtime_ns) -> プールが壊れて失敗した回数 (再実行待ち)
+    executor = create_executor(jobs)
+    with open(record_file, 'a', encoding='utf-8') as record:
+        try:
+            while True:
+                now_ns = time.time_ns()
+                running = set(in_flight.values())
+                seen = {}
+                ready = []
+                for candidate in scan_candidates(directory):
+                    path = candidate[0]
+                    seen[path] = candidate
+                    if candidate in processed or candidate in running:
+                        continue
+                    if is_settled(candidate, observed.get(path), now_ns):
+                        ready.append(candidate)
+                observed = seen
+                # 置き換わった/削除されたファイルの回数は捨てる
+                attempts = {candidate: n for candidate, n in attempts.items() if seen.get(candidate[0]) == candidate}
+
+                # プールを壊した時のファイルは他のファイルより先に、1つずつ単独で実行する
+                suspects = [candidate for candidate in ready if candidate in attempts]
+                if suspects:
+                    ready = suspects[:1] if not in_flight else []
+                elif any(candidate in attempts for candidate in in_flight.values()):
+                    ready = []
+                broken = False
+                for candidate in ready:
+                    try:
+                        future = executor.submit(cb.build_report, candidate[0], directory)
+                    except BrokenProcessPool:
+                        broken = True  # 投入できなかったファイルは作り直したプールで次回処理する
+                        break
+                    in_flight[future] = candidate
+
+                for future in [f for f in in_flight if f.done()]:
+                    candidate = in_flight.pop(future)
+                    try:
+                        filename, bookname, stats = future.result()
+                    except BrokenProcessPool as e:
+                        # プールが壊れると実行中/待ちの全ファイルが失敗するので、記録せずに再実行する
+                        broken = True
+                        attempts[candidate] = attempts.get(candidate, 0) + 1
+                        if attempts[candidate] < WATCH_MAX_ATTEMPTS:
+                            logger.info(f'retry after broken worker pool: {candidate[0]}')
+                            continue
+                        logger.warning(f'broken worker pool by: {candidate[0]}')
+                        del attempts[candidate]
+                        write_record(record, candidate, None, error=repr(e))
+                        processed.add(candidate)
+                        continue
+                    except Exception as e:
+                        stack_trace = traceback.format_exc()
+                        logger.warning(f"Catch Exception: {e!r} <- {candidate[0]}\nSTACK_TRACE:\n{stack_trace}")
+                        attempts.pop(candidate, None)
+                        write_record(record, candidate, None, error=repr(e))
+                        processed.add(candidate)
+                        continue
+                    attempts.pop(candidate, None)
+                    logger.info(f'processed: {filename} -> {bookname}')
+                    if stats is not None:
+                        cstat.add_stats(logger, cc.STATS_FILE, [stats])
+                    write_record(record, candidate, bookname)
+                    processed.add(candidate)
+
+                if broken:
+                    logger.warning(f'worker pool is broken, restarting: {len(in_flight)} files not finished')
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = create_executor(jobs)
+                time.sleep(WATCH_POLL_SECONDS)
+        except KeyboardInterrupt:
+            logger.info(f'stop watching {directory}: {len(in_flight)} files not finished')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    return
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""cocoa.merge_exposures のテスト (python -m pytest)"""
+import logging
+
+import cocoa
+import cocoaPlatform as cp
+
+__author__ = "hyuasa"
+__version__ = "0.0.1"
+__date__ = "Aug 16 2022"
+
+
+DAY = cp.MILLIS_PER_DAY
+DAY1 = 1659970800000
+DAY2 = DAY1 + DAY
+DAY3 = DAY2 + DAY
+
+
+def summary(millis, weighted_duration):
+    return {'DateMillisSinceEpoch': millis,
+            'DaySummary': {'MaximumScore': 900.0, 'ScoreSum': weighted_duration,
+                           'WeightedDurationSum': weighted_duration},
+            'ConfirmedClinicalDiagnosisSummary': None}
+
+
+def window(millis, duration):
+    return {'DateMillisSinceEpoch': millis, 'ScanInstances': [
+        {'TypicalAttenuationDb': 60, 'MinAttenuationDb': 55, 'SecondsSinceLastScan': duration}]}
+
+
+def export(model, summaries, windows):
+    return {'platform': 'ios', 'device_type': 'iPhone', 'model': model, 'en_version': '2',
+            'app_version': '2.0.1', 'exposure_windows': windows, 'daily_summaries': summaries}
+
+
+def cocoa_scores(merged):
+    return sorted((ds['DateMillisSinceEpoch'], ds['DaySummary']['WeightedDurationSum'])
+                  for ds in merged['daily_summaries'])
+
+
+def test_reexport_keeps_one_summary_per_day():
+    # 再エクスポートでは共有する日(DAY2)のdaily summaryが増えている
+    old = export('iPhone13,2', [summary(DAY1, 600.0), summary(DAY2, 300.0)],
+                 [window(DAY1, 300), window(DAY2, 300)])
+    new = export('iPhone13,2', [summary(DAY2, 900.0), summary(DAY3, 120.0)],
+                 [window(DAY2, 300), window(DAY2 + 3600000, 600), window(DAY3, 120)])
+    merged, n_duplicated, n_skipped = cocoa.merge_exposures(logging.getLogger(__name__), [old, new])
+    assert cocoa_scores(merged) == [(DAY1, 600.0), (DAY2, 900.0), (DAY3, 120.0)]
+    assert n_duplicated == 1
+    assert n_skipped == 0
+    # 順序によらず値が最大のものを残す
+    merged, n_duplicated, n_skipped = cocoa.merge_exposures(logging.getLogger(__name__), [new, old])
+    assert cocoa_scores(merged) == [(DAY1, 600.0), (DAY2, 900.0), (DAY3, 120.0)]
+
+
+def test_other_device_summaries_are_kept():
+    phone1 = export('iPhone13,2', [summary(DAY1, 600.0)], [window(DAY1, 300)])
+    phone2 = export('iPhone14,5', [summary(DAY1, 450.0)], [window(DAY1 + 60000, 300)])
+    merged, n_duplicated, n_skipped = cocoa.merge_exposures(logging.getLogger(__name__), [phone1, phone2])
+    assert cocoa_scores(merged) == [(DAY1, 450.0), (DAY1, 600.0)]
+    assert n_duplicated == 0